@@ -1,99 +1,319 @@
-import serial
-import array
-from pyqtgraph.Qt import QtGui, QtCore
-import pyqtgraph as pg
 import numpy as np
+import threading
 import time
+from numpy.lib.stride_tricks import sliding_window_view
+from acquisition import Acquisition, CMS50DSource
+from instrument import metrics
+
+# the pulseOx sends 9 byte packets: the first byte has its top bit clear, the other 8 have it set
+PACKET_SIZE = 9
+# handshake to tell pulseOx to start transmitting data
+HANDSHAKE = b'\x7d\x81\xa1\x80\x80\x80\x80\x80\x80'
+# bytes to ask the serial port for at a time (at most; a read returns early with whatever arrived before the timeout)
+READ_SIZE = 4096
+
+class CMS50DParser():
+    """
+    Streaming decoder for the CMS50D's serial data. Feed it whatever bytes arrived, in any size of chunk; it finds
+    packet boundaries from the sync bits (so lost bytes only cost the packets they were part of), decodes every
+    complete packet and keeps an unfinished one for the next call
+    """
+    def __init__(self):
+        self.buffer = bytearray()
+        self.packets = 0
+        # bytes thrown away because they weren't part of a well formed packet
+        self.framing_errors = 0
+
+    def feed(self, data):
+        """
+        Returns an (N, 3) array of (bpm, spo2, waveform data), one row per complete packet
+        """
+        self.buffer.extend(data)
+        raw = np.frombuffer(self.buffer, dtype=np.uint8)
+        high = raw >= 0x80
+
+        # a packet starts at a byte with the top bit clear followed by 8 bytes with it set; two such starts can't
+        # overlap, so every match is a packet
+        if len(raw) >= PACKET_SIZE:
+            followed = sliding_window_view(high[1:], PACKET_SIZE - 1).all(axis=1)
+            starts = np.flatnonzero(~high[:len(followed)] & followed)
+        else:
+            starts = np.empty(0, dtype=np.intp)
+        packets = raw[starts[:, None] + np.arange(PACKET_SIZE)]
+
+        # keep the tail if it could still become a packet: a start byte with only top-bit-set bytes after it
+        end = starts[-1] + PACKET_SIZE if len(starts) else 0
+        keep = len(raw)
+        tail_starts = np.flatnonzero(~high[end:])
+        if len(tail_starts) and len(raw) - (end + tail_starts[-1]) < PACKET_SIZE:
+            keep = end + tail_starts[-1]
+        self.framing_errors += keep - len(starts) * PACKET_SIZE
+
+        del raw
+        del self.buffer[:keep]
+        self.packets += len(starts)
+        return decode_packets(packets)
+
+def decode_packets(packets):
+    """
+    packets: (N, 9) array of raw packets. Returns an (N, 3) array of (bpm, spo2, waveform data)
+    """
+    # each value is bits 0-6 of its byte
+    return (packets[:, [5, 6, 3]] & 0x7f).astype(np.int32)
+
+def finger_out(packets):
+    """
+    packets: (N, 3) array of (bpm, spo2, waveform data). Returns a length N bool array, True where the pulseOx has no
+    finger in it. It has no reading then and says so with values a reading can't have: spo2 over 100 (127, all 7 bits
+    set) or a spo2 or bpm of 0
+    """
+    packets = np.asarray(packets)
+    spo2 = packets[:, 1]
+    return (packets[:, 0] == 0) | (spo2 == 0) | (spo2 > 100)
 
 class CMS50D(object):
     """
     Object for CMS50D PulseOx
     """
-    #TODO: Properly decode "finger out" flag, assuming it exists
-    def __init__(self, portstr):
+    def __init__(self, portstr=None, port=None):
         """
         portstr: address of device connection. On RPi, this is "/dev/ttyUSB0"
+        port: already open serial-like object to use instead (eg. emulator.EmulatedCMS50DPort())
         """
-        self.port = serial.Serial(portstr, 115200, timeout=0.01, stopbits=serial.STOPBITS_ONE, parity=serial.PARITY_NONE, bytesize=serial.EIGHTBITS, xonxoff=1)
-        # handshake to tell pulseOx to start transmitting data
-        self.port.write(b'\x7d\x81\xa1\x80\x80\x80\x80\x80\x80')      
+        if port is not None:
+            self.port = port
+        else:
+            # imported here so the rest of the module works on machines without pyserial
+            import serial
+            self.port = serial.Serial(portstr, 115200, timeout=0.01, stopbits=serial.STOPBITS_ONE, parity=serial.PARITY_NONE, bytesize=serial.EIGHTBITS, xonxoff=1)
+        self.parser = CMS50DParser()
+
+        # get_data resends the handshake itself after repeated empty reads, unless a CMS50DSession is looking after it
+        self.auto_handshake = True
+        self.handshakes = 0
+        self.write_lock = threading.Lock()
+
+        # packets already decoded but not yet handed out by get_data
+        self.pending = np.empty((0, 3), dtype=np.int32)
+        self.pending_pos = 0
+
+        self.send_handshake()
+
+    def send_handshake(self):
+        """
+        Tells the pulseOx to (re)start transmitting data. Safe to call from another thread while reading
+        """
+        with self.write_lock:
+            self.port.write(HANDSHAKE)
+        self.handshakes += 1
+        if metrics.enabled:
+            metrics.count('cms50d.handshakes')
+
+    def read_batch(self):
+        """
+        Reads whatever bytes have arrived (waiting up to the port timeout if there are none) and decodes them.
+        Returns an (N, 3) array of (bpm, spo2, waveform data), which is empty if no complete packet came in
+        """
+        if not metrics.enabled:
+            data = self.port.read(min(max(self.port.in_waiting, PACKET_SIZE), READ_SIZE))
+            return self.parser.feed(data)
+
+        start = time.perf_counter()
+        data = self.port.read(min(max(self.port.in_waiting, PACKET_SIZE), READ_SIZE))
+        decode_start = time.perf_counter()
+        framing_errors = self.parser.framing_errors
+        packets = self.parser.feed(data)
+        end = time.perf_counter()
+        # a read that comes back with no packets is (mostly) time spent waiting on the port timeout
+        metrics.add_time('cms50d.serial' if len(packets) else 'cms50d.retry', decode_start - start)
+        metrics.add_time('cms50d.decode', end - decode_start)
+        metrics.count('cms50d.bytes', len(data))
+        if self.parser.framing_errors > framing_errors:
+            metrics.count('cms50d.framing_errors', self.parser.framing_errors - framing_errors)
+        return packets
+
+    def stream(self, max_pending=8, poll=0.01, keepalive=10.0):
+        """
+        Async iterator over (times, packets) tuples, for use in an asyncio event loop (see aio.py):
+
+        async with pulseOx.stream() as stream:
+            async for times, packets in stream:
+                ...
+
+        Reads only what has arrived, so it never blocks the event loop, and resends the handshake every keepalive
+        seconds unless a CMS50DSession is running
+        """
+        from aio import cms50d_stream
+        return cms50d_stream(self, max_pending, poll, keepalive)
 
     def get_data(self):
         """
         Returns tuple (bpm, spo2, waveform data)
         """
-        raw = []
         tries = 0
-        while(len(raw) < 9):
-            # code sends data in chunks of 9
-            raw = self.port.read(9)
+        while self.pending_pos >= len(self.pending):
+            self.pending = self.read_batch()
+            self.pending_pos = 0
 
             tries += 1
             # if we try too many times without getting data, resend handshake
-            if tries >= 3:
-                self.port.write(b'\x7d\x81\xa1\x80\x80\x80\x80\x80\x80')      
-        
-        # get bits 0-6 of byte 3
-        return (raw[5] & 0x7f, raw[6] & 0x7f, raw[3] & 0x7f)
+            if tries >= 3 and not len(self.pending) and self.auto_handshake:
+                self.send_handshake()
+
+        data = self.pending[self.pending_pos]
+        self.pending_pos += 1
+        return tuple(data.tolist())
 
     def get_waveform_data(self):
         """
         Returns a single point of pulse waveform data (an int)
         """
-        raw = []
-        tries = 0
-        while(len(raw) < 9):
-            raw = self.port.read(9)
-
-            tries += 1
-            # if we try too many times without getting data, resend handshake
-            if tries >= 3:
-                self.port.write(b'\x7d\x81\xa1\x80\x80\x80\x80\x80\x80')      
-        
-        return raw[3] & 0x7f
+        return self.get_data()[2]
         
     def plot_waveform(self):
         """
-        adapted from: stackoverflow.com/questions/45046239/python-realtime-plot-using-pyqtgraph
         Gives real-time PPG plot
         """
-        # initializing Qt app
-        app = QtGui.QApplication([])
-        
-        win = pg.GraphicsWindow(title="Transmission PulseOx Data")
-        win.resize(1000, 600)
-        win.setWindowTitle('Waveform Data')
-        
-        p1 = win.addPlot(title='Waveform Data')
-        curve = p1.plot()
-        p1.setRange(yRange=(0, 100))
-        windowWidth = 500
-        data = np.linspace(0, 0, windowWidth)
-        
-        ptr = windowWidth - 1 # pointer to first data point
-        
-        # enable antialiasing
-        pg.setConfigOptions(antialias=True)
-        
-        # realtime data plotting
-        while True:
-            # update data
-            data[ptr] = self.get_waveform_data()
-            
-            # shift entire window to left
-            data[:-1] = data[1:]
-            
-            # update plot
-            curve.setData(data)
-            QtGui.QApplication.processEvents()
-        
-        # closes Qt
-        pg.QtGui.QApplication.exec_()
+        from live_plot import LivePlot
+
+        # acquisition runs in its own thread; the plot redraws from the ring buffer on a timer
+        acq = Acquisition()
+        ring = acq.add('trans', CMS50DSource(self))
+
+        plot = LivePlot(title='Transmission PulseOx Data', window_width=500)
+        plot.plot.setRange(yRange=(0, 100))
+        plot.add_curve(ring, 2)
+
+        acq.start()
+        plot.run()
+        acq.stop()
        
     def close(self):
         self.port.close()
 
 
+class CMS50DSession():
+    """
+    Keeps a CMS50D streaming through long recordings. A background thread resends the handshake every keepalive
+    seconds (left alone, the pulseOx stops sending after ~1700 packets) and watches packet throughput: if the rate
+    drops below stall_fraction of expected_rate it resends right away and counts a reconnect. While the stall lasts
+    (eg. the cable is out) the handshake is retried with a delay that doubles up to keepalive seconds. Reads never
+    wait on handshake retries while a session is running.
+
+    eg.
+    pulseOx = CMS50D('/dev/ttyUSB0')
+    session = CMS50DSession(pulseOx)
+    session.start()
+    ...
+    print(session.metrics())
+    session.stop()
+    """
+    def __init__(self, pulseOx, keepalive=10.0, expected_rate=60, stall_fraction=0.5, check_interval=1.0):
+        """
+        expected_rate: packets per second the pulseOx normally sends
+        """
+        self.pulseOx = pulseOx
+        self.keepalive = keepalive
+        self.expected_rate = expected_rate
+        self.stall_fraction = stall_fraction
+        self.check_interval = check_interval
+
+        self.stopped = threading.Event()
+        self.thread = None
+        self.start_time = None
+        self.last_handshake = None
+        self.last_attempt = None
+        self.last_packet_time = None
+        self.rate = 0
+        self.keepalives = 0
+        self.reconnects = 0
+        # total seconds spent below the stall threshold
+        self.stalled_time = 0
+        self.stalled = False
+        # seconds between handshake retries during the current stall
+        self.retry_delay = check_interval
+
+    def start(self):
+        self.pulseOx.auto_handshake = False
+        self.start_time = time.monotonic()
+        self.last_handshake = self.start_time
+        self.last_attempt = self.start_time
+        self.last_packet_time = self.start_time
+        self.stalled = False
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='CMS50D keepalive', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.pulseOx.auto_handshake = True
+
+    def run(self):
+        last_count = self.pulseOx.parser.packets
+        last_time = time.monotonic()
+        first = True
+        while not self.stopped.wait(self.check_interval):
+            now = time.monotonic()
+            count = self.pulseOx.parser.packets
+            self.rate = (count - last_count) / (now - last_time)
+            if count > last_count:
+                self.last_packet_time = now
+            if first:
+                # the pulseOx is still starting up over the first interval, so its rate only counts from the next one
+                first = False
+                last_count = count
+                last_time = now
+                continue
+
+            if self.rate < self.expected_rate * self.stall_fraction:
+                self.stalled_time += now - last_time
+                if not self.stalled:
+                    # one reconnect per stall, however long it lasts
+                    self.stalled = True
+                    self.reconnects += 1
+                    self.retry_delay = self.check_interval
+                    self.handshake(now)
+                elif now - self.last_attempt >= self.retry_delay:
+                    self.retry_delay = min(2 * self.retry_delay, self.keepalive)
+                    self.handshake(now)
+            else:
+                self.stalled = False
+                if now - self.last_handshake >= self.keepalive:
+                    self.keepalives += 1
+                    self.handshake(now)
+
+            last_count = count
+            last_time = now
+
+    def handshake(self, now):
+        self.last_attempt = now
+        try:
+            self.pulseOx.send_handshake()
+        except OSError:
+            # port trouble; try again later
+            return
+        self.last_handshake = now
+
+    def metrics(self):
+        """
+        Returns dict of uptime (seconds since start), packets, current rate (packets/s), seconds since the last packet,
+        keepalive handshakes, reconnects (handshakes forced by a stall), stalled time and framing errors
+        """
+        now = time.monotonic()
+        return {
+            'uptime' : now - self.start_time,
+            'packets' : self.pulseOx.parser.packets,
+            'rate' : self.rate,
+            'last_packet_age' : now - self.last_packet_time,
+            'keepalives' : self.keepalives,
+            'reconnects' : self.reconnects,
+            'stalled_time' : self.stalled_time,
+            'framing_errors' : self.pulseOx.parser.framing_errors,
+        }
+
 ### Example Usage
 # pulseOx=CMS50D("/dev/ttyUSB0")
 # while True:
@@ -1,13 +1,12 @@
-# NOTE -- interrupt functionality not implemented in class
-# accelerometer functionality not implemented either
+# NOTE -- accelerometer functionality not implemented in class
 
-from smbus import SMBus
 import time
-import csv
+from contextlib import contextmanager
 from datetime import datetime
-from pyqtgraph.Qt import QtGui, QtCore
-import pyqtgraph as pg
 import numpy as np
+from recording import RecordingWriter, REFLECT_FIELDS
+from acquisition import Acquisition, MAX30101Source
+from instrument import metrics
 
 # number of samples we want to read at a time (note 1 sample = 6 bytes in SpO2 mode)
 NUM_SAMPLES = 1
@@ -16,6 +15,26 @@ NUM_SAMPLES = 1
 SPO2_SIZE = 6
 MULTI_SIZE = 9
 
+# the FIFO holds 32 samples, and smbus can move at most 32 bytes per block transfer
+FIFO_DEPTH = 32
+I2C_BLOCK_MAX = 32
+
+# each led channel is an 18-bit ADC value, left-padded to 3 bytes
+ADC_MASK = 0x3FFFF
+
+# what the setting levels stand for: set_sample_rate (Hz), set_sample_avg (samples averaged; 6 and 7 also mean 32),
+# set_pulse_width (us) and set_adc_range (full scale nA)
+SAMPLE_RATES = [50, 100, 200, 400, 800, 1000, 1600, 3200]
+SAMPLE_AVERAGES = [1, 2, 4, 8, 16, 32, 32, 32]
+PULSE_WIDTHS = [69, 118, 215, 411]
+# ADC resolution in bits at each pulse width
+ADC_BITS = [15, 16, 17, 18]
+ADC_RANGES = [2048, 4096, 8192, 16384]
+
+# led current resolution and maximum, in mA
+LED_STEP = 0.2
+LED_MAX = 51
+
 # rpi bus line
 BUS = 1
 
@@ -43,49 +62,255 @@ MULTI_MODE_1 = 0x11
 MULTI_MODE_2 = 0x12
 TEMP_INT = 0x1F
 TEMP_FRAC = 0x20
+REV_ID = 0xFE
+PART_ID = 0xFF
+
+# interrupt bits in INT_STAT_1 / INT_ENABLE_1 (PWR_RDY is status only)
+INT_A_FULL = 0x80
+INT_PPG_RDY = 0x40
+INT_ALC_OVF = 0x20
+INT_PWR_RDY = 0x01
+# interrupt bits in INT_STAT_2 / INT_ENABLE_2
+INT_DIE_TEMP_RDY = 0x02
+
+# mode bits in MODE_CONFIG
+RESET_BIT = 0x40
+MODE_MASK = 0x07
+
+class GPIOInterrupt():
+    """
+    Waits for the MAX30101 INT pin (active low, open drain) to be asserted, using RPi.GPIO.
+
+    Anything with a wait(timeout) method that returns True when woken can be used in its place,
+    eg. a threading.Event for testing without hardware
+    """
+    def __init__(self, pin):
+        """
+        pin: BCM number of the GPIO the INT line is wired to
+        """
+        import RPi.GPIO as GPIO
+
+        self.GPIO = GPIO
+        self.pin = pin
+        GPIO.setmode(GPIO.BCM)
+        GPIO.setup(pin, GPIO.IN, pull_up_down=GPIO.PUD_UP)
+
+    def wait(self, timeout):
+        """
+        Blocks until INT is asserted or timeout (in seconds) runs out. Returns True if INT was asserted
+        """
+        # INT stays low until the status registers are read, so it may already be asserted
+        if self.GPIO.input(self.pin) == 0:
+            return True
+        return self.GPIO.wait_for_edge(self.pin, self.GPIO.FALLING, timeout=int(timeout * 1000)) is not None
+
+    def close(self):
+        self.GPIO.cleanup(self.pin)
+
+def decode_fifo(buf, channels):
+    """
+    Decodes raw FIFO bytes into an (N, channels) uint32 array, where each channel is 3 bytes (MSB first).
+    buf can be bytes, bytearray, memoryview (read without copying) or a list of ints as returned by smbus.
+    Trailing bytes that don't make up a full sample are ignored.
+    """
+    if isinstance(buf, (bytes, bytearray, memoryview)):
+        raw = np.frombuffer(buf, dtype=np.uint8)
+    else:
+        raw = np.asarray(buf, dtype=np.uint8)
+    sample_size = 3 * channels
+    raw = raw[:len(raw) - len(raw) % sample_size].reshape(-1, channels, 3).astype(np.uint32)
+    return ((raw[:, :, 0] << 16) | (raw[:, :, 1] << 8) | raw[:, :, 2]) & ADC_MASK
 
 class MAX30101():
-    def __init__(self, mode='spo2', led=10, adc_range=1, sample_rate=1, pulse_width=3, sample_avg=2):
+    def __init__(self, mode='spo2', led=10, adc_range=1, sample_rate=1, pulse_width=3, sample_avg=2, interrupt=None, fifo_a_full=8, ppg_rdy=False, bus=None):
         """
         set up max30101; there are 2 modes: 'spo2' and 'multi' (for all 3 led's)
+
+        interrupt: optional wait primitive for the INT pin (eg. GPIOInterrupt(pin)). When given, reads sleep until
+        the FIFO almost full interrupt fires (fifo_a_full = number of free FIFO slots left when it fires, 0-15),
+        or every new sample if ppg_rdy is set. Without it, reads poll the FIFO pointers.
+
+        bus: i2c bus number, or smbus-like object to talk to the sensor through (eg. a channel of a
+        sensor_array.I2CMux, or emulator.EmulatedMAX30101Bus()), default SMBus(BUS)
         
         Recommended Settings?
         Finger: LED = 4, adc_range = 3, sample_rate = 1, pulse_width = 3, sample_avg = 2
         Wrist: LED = 14, adc_range = 3, sample_rate = 1, pulse_width = 3, sample_avg = 2
         """
                 
-        self.bus = SMBus(BUS)
-      
-        # set mode
-        if mode == 'spo2' or mode == 'SpO2':
-            self.spo2_mode(led)
-        elif mode == 'multi':
-            self.multi_mode(led)
-        
-        # set settings for PulseOx data
-        self.set_adc_range(adc_range)
-        self.set_sample_rate(sample_rate)
-        self.set_pulse_width(pulse_width)
-        self.set_sample_avg(sample_avg)
-        
-        # turn on data overflow
-        self.set_overflow(1)
-        
+        if bus is None or isinstance(bus, int):
+            # imported here so the rest of the module works on machines without smbus
+            from smbus import SMBus
+            bus = SMBus(BUS if bus is None else bus)
+        self.bus = bus
+        self.interrupt = interrupt
+
+        # kept so recordings can describe how the sensor was set up
+        self.settings = {}
+
+        # shadow copy of the config registers, so setters don't have to read a register before changing part of it.
+        # dirty registers have changed in the shadow but not been written yet (see batch)
+        self.shadow = bytearray(256)
+        self.dirty = set()
+        self.batch_depth = 0
+
+        # number of led channels per sample (set by the mode) and running count of samples lost to FIFO overflow
+        self.channels = 2
+        self.overflow_count = 0
+        # samples read off the FIFO so far, and the monotonic time of the last FIFO pointer read (when the FIFO held
+        # everything up to sample samples_read + overflow_count; see acquisition.SampleClock)
+        self.samples_read = 0
+        self.status_time = None
+
+        # samples already pulled off the FIFO but not yet handed out by read_spo2_data/read_multi_data
+        self.pending = np.empty((0, self.channels), dtype=np.uint32)
+        self.pending_pos = 0
+
+        # set mode and settings for PulseOx data, with data overflow turned on
+        with self.batch():
+            self.configure(mode=mode, led=led, adc_range=adc_range, sample_rate=sample_rate, pulse_width=pulse_width, sample_avg=sample_avg, overflow=1)
+            if interrupt is not None:
+                self.configure(fifo_a_full=fifo_a_full)
+                self.enable_interrupts(a_full=True, ppg_rdy=ppg_rdy)
+
+    @contextmanager
+    def batch(self, verify=False):
+        """
+        Holds back register writes made inside the with block, then writes every changed register at the end, one
+        transfer per run of adjacent registers. With verify, the registers are read back afterwards (see write_registers)
+
+        eg.
+        with pulseOx.batch():
+            pulseOx.set_sample_rate(2)
+            pulseOx.set_pulse_width(1)
+        """
+        self.batch_depth += 1
+        try:
+            yield self
+        finally:
+            self.batch_depth -= 1
+        if self.batch_depth == 0:
+            self.write_registers(verify)
+
+    def update_register(self, register, mask, value):
+        """
+        Sets the bits of register under mask to value. Goes to the shadow copy, and is written out straight away unless
+        inside a batch. Nothing is written if the register already holds that value
+        """
+        new = (self.shadow[register] & ~mask | value & mask) & 0xFF
+        if new == self.shadow[register]:
+            return
+        self.shadow[register] = new
+        self.dirty.add(register)
+        if self.batch_depth == 0:
+            self.write_registers()
+
+    def write_registers(self, verify=False):
+        """
+        Writes out the dirty registers, with one block transfer per run of adjacent registers. With verify, reads them
+        back and raises OSError if the device doesn't hold what was written
+        """
+        registers = sorted(self.dirty)
+        runs = []
+        for register in registers:
+            if runs and register == runs[-1][-1] + 1:
+                runs[-1].append(register)
+            else:
+                runs.append([register])
+
+        for run in runs:
+            values = list(self.shadow[run[0]:run[-1] + 1])
+            if len(run) == 1:
+                self.bus.write_byte_data(PULSEOX_ADDR, run[0], values[0])
+            else:
+                self.bus.write_i2c_block_data(PULSEOX_ADDR, run[0], values)
+        self.dirty = set()
+        if metrics.enabled:
+            metrics.count('max30101.transactions', len(runs))
+            metrics.count('max30101.bytes', sum(len(run) for run in runs))
+
+        if verify:
+            for run in runs:
+                values = list(self.shadow[run[0]:run[-1] + 1])
+                readback = self.bus.read_i2c_block_data(PULSEOX_ADDR, run[0], len(run))
+                if list(readback) != values:
+                    raise OSError(f'MAX30101 register 0x{run[0]:02X}: wrote {values}, read back {list(readback)}')
+
+    def sync_registers(self):
+        """
+        Reloads the shadow copy from the device (interrupt enables through the multi-led slots), eg. if something else
+        has been changing the settings
+        """
+        # two reads, skipping the FIFO registers: the address pointer stops at FIFO_DATA, so a read across it would pop
+        # samples into the settings
+        self.shadow[INT_ENABLE_1:INT_ENABLE_2 + 1] = bytes(self.bus.read_i2c_block_data(PULSEOX_ADDR, INT_ENABLE_1, INT_ENABLE_2 + 1 - INT_ENABLE_1))
+        self.shadow[FIFO_CONFIG:MULTI_MODE_2 + 1] = bytes(self.bus.read_i2c_block_data(PULSEOX_ADDR, FIFO_CONFIG, MULTI_MODE_2 + 1 - FIFO_CONFIG))
+        self.dirty = set()
+
+    def configure(self, verify=False, **settings):
+        """
+        Applies a set of settings in as few bus transfers as possible, eg. configure(led=14, adc_range=3)
+
+        Settings are the __init__ arguments (mode, led, adc_range, sample_rate, pulse_width, sample_avg) and anything
+        with a set_ method (red, ir, green, overflow, fifo_a_full). Changing the mode resets the device, and the
+        earlier settings are applied again along with the new ones. verify reads the registers back afterwards
+        """
+        for key in settings:
+            if key not in ('mode', 'led') and not hasattr(self, 'set_' + key):
+                print('Invalid Input')
+                return
+
+        if 'led' in settings:
+            # a new led current replaces any per-led ones
+            for key in ('red', 'ir', 'green'):
+                if key not in settings:
+                    self.settings.pop(key, None)
+        if 'mode' in settings:
+            settings = dict(self.settings, **settings)
+        self.settings.update(settings)
+
+        with self.batch(verify):
+            if 'mode' in settings:
+                mode = settings['mode']
+                # the reset would turn the interrupts off
+                enables = self.shadow[INT_ENABLE_1:INT_ENABLE_2 + 1]
+                if mode == 'spo2' or mode == 'SpO2':
+                    self.spo2_mode(settings.get('led', 0))
+                elif mode == 'multi':
+                    self.multi_mode(settings.get('led', 0))
+                else:
+                    print('Invalid Input')
+                    return
+                self.update_register(INT_ENABLE_1, 0xFF, enables[0])
+                self.update_register(INT_ENABLE_2, 0xFF, enables[1])
+            elif 'led' in settings:
+                self.set_red(settings['led'])
+                self.set_ir(settings['led'])
+                if self.channels == 3:
+                    self.set_green(settings['led'])
+
+            for key, value in settings.items():
+                if key not in ('mode', 'led'):
+                    getattr(self, 'set_' + key)(value)
+
     def spo2_mode(self, current):
         """
         Sets MAX30101 to SPO2 mode and turns on appropriate LED's. Current specifies desired current of LED
         """
         # reset, mainly to clear stack
         self.reset()
-        
-        # set mode
-        mode_byte = self.bus.read_byte_data(PULSEOX_ADDR, MODE_CONFIG) & 0xFF
-        mode_byte = ((mode_byte | 0x03) & 0xFB)
-        self.bus.write_byte_data(PULSEOX_ADDR, MODE_CONFIG, mode_byte)
-        
-        # set current
-        self.set_red(current)
-        self.set_ir(current)
+
+        self.channels = 2
+        self.pending = np.empty((0, self.channels), dtype=np.uint32)
+        self.pending_pos = 0
+
+        with self.batch():
+            # set mode
+            self.update_register(MODE_CONFIG, MODE_MASK, 0x03)
+
+            # set current
+            self.set_red(current)
+            self.set_ir(current)
         
     def multi_mode(self, current):
         """
@@ -93,176 +318,227 @@ class MAX30101():
         """
         # reset
         self.reset()
-        
-        # set mode
-        mode_byte = self.bus.read_byte_data(PULSEOX_ADDR, MODE_CONFIG) & 0xFF
-        mode_byte = mode_byte | 0x07
-        self.bus.write_byte_data(PULSEOX_ADDR, MODE_CONFIG, mode_byte)
-        
-        # set config
-        register1 = self.bus.read_byte_data(PULSEOX_ADDR, MULTI_MODE_1)
-        register1 |= 0x21
-        self.bus.write_byte_data(PULSEOX_ADDR, MULTI_MODE_1, register1)
-        register2 = self.bus.read_byte_data(PULSEOX_ADDR, MULTI_MODE_2)
-        register2 |= 0x03
-        self.bus.write_byte_data(PULSEOX_ADDR, MULTI_MODE_2, register2)
-        
-        # set current
-        self.set_red(current)
-        self.set_ir(current)
-        self.set_green(current)
-        
+
+        self.channels = 3
+        self.pending = np.empty((0, self.channels), dtype=np.uint32)
+        self.pending_pos = 0
+
+        with self.batch():
+            # set mode
+            self.update_register(MODE_CONFIG, MODE_MASK, 0x07)
+
+            # set config: slot 1 red, slot 2 ir, slot 3 green
+            self.update_register(MULTI_MODE_1, 0x77, 0x21)
+            self.update_register(MULTI_MODE_2, 0x07, 0x03)
+
+            # set current
+            self.set_red(current)
+            self.set_ir(current)
+            self.set_green(current)
+
+    def output_rate(self):
+        """
+        Samples per second coming out of the FIFO, ie. sample rate / samples averaged
+        """
+        return SAMPLE_RATES[(self.shadow[SPO2_CONFIG] >> 2) & 0x07] / SAMPLE_AVERAGES[(self.shadow[FIFO_CONFIG] >> 5) & 0x07]
+
+    def fifo_status(self):
+        """
+        Reads FIFO_WR_PTR, FIFO_OVF and FIFO_RD_PTR in a single block transfer (they are adjacent registers).
+        Returns tuple (number of available samples, number of samples lost to overflow since the last read)
+        """
+        write_ptr, overflow, read_ptr = self.bus.read_i2c_block_data(PULSEOX_ADDR, FIFO_WR_PTR, 3)
+        write_ptr &= 0x1F
+        read_ptr &= 0x1F
+        overflow &= 0x1F
+
+        # number of available samples calculation needs to account for pointer wraparound
+        available_samples = (write_ptr - read_ptr) % FIFO_DEPTH
+        # equal pointers with a nonzero overflow counter means the FIFO is full, not empty
+        if available_samples == 0 and overflow > 0:
+            available_samples = FIFO_DEPTH
+        return (available_samples, overflow)
+
     def is_data_ready(self):
         """
         Check if there is enough data stored in the FIFO for us to read.
         """
-        write_ptr = self.bus.read_byte_data(PULSEOX_ADDR, FIFO_WR_PTR) & 0x1F
-        read_ptr = self.bus.read_byte_data(PULSEOX_ADDR, FIFO_RD_PTR) & 0x1F 
-        
-        # number of available samples calculation needs to account for pointer wraparound
-        if write_ptr >= read_ptr:
-            available_samples = write_ptr - read_ptr
-        else:
-            # the 32 is because the FIFO stores 32 data points
-            available_samples = 32 - read_ptr + write_ptr
+        available_samples, overflow = self.fifo_status()
+        self.overflow_count += overflow
         return (available_samples >= NUM_SAMPLES)
 
+    def read_available(self):
+        """
+        Reads every sample currently waiting in the FIFO, using as few block transfers as smbus allows.
+        Returns an (N, channels) array, columns (red, ir) in SpO2 mode or (red, ir, green) in multi-led mode.
+        Samples lost to overflow are added to self.overflow_count
+        """
+        # checked once, so turning metrics on in the middle of a call can't leave start unset
+        timed = metrics.enabled
+        if timed:
+            start = time.perf_counter()
+        available_samples, overflow = self.fifo_status()
+        self.status_time = time.monotonic()
+        self.overflow_count += overflow
+        self.samples_read += available_samples
+        if timed:
+            metrics.observe('max30101.fifo_fill', available_samples)
+            if overflow:
+                metrics.count('max30101.overflow', overflow)
+        if available_samples == 0:
+            if timed:
+                metrics.add_time('max30101.bus', time.perf_counter() - start)
+                metrics.count('max30101.transactions')
+                metrics.count('max30101.bytes', 3)
+            return np.empty((0, self.channels), dtype=np.uint32)
+
+        sample_size = 3 * self.channels
+        # largest whole number of samples that fits in one block transfer
+        per_transfer = I2C_BLOCK_MAX // sample_size
+
+        data = bytearray()
+        remaining = available_samples
+        while remaining > 0:
+            count = min(remaining, per_transfer)
+            data.extend(self.bus.read_i2c_block_data(PULSEOX_ADDR, FIFO_DATA, count * sample_size))
+            remaining -= count
+
+        if not timed:
+            return decode_fifo(data, self.channels)
+        decode_start = time.perf_counter()
+        metrics.add_time('max30101.bus', decode_start - start)
+        # the status read, then the FIFO data
+        metrics.count('max30101.transactions', 1 + -(-available_samples // per_transfer))
+        metrics.count('max30101.bytes', 3 + len(data))
+        samples = decode_fifo(data, self.channels)
+        metrics.add_time('max30101.decode', time.perf_counter() - decode_start)
+        return samples
+
+    def drain_fifo(self):
+        """
+        Empties the FIFO, also picking up samples that arrived while the first batch was being read.
+        Returns all of the samples as one (N, channels) array (see read_available)
+        """
+        batch = self.read_available()
+        if len(batch):
+            batch = np.concatenate((batch, self.read_available()))
+        return batch
+
+    def read_batch(self, timeout=1.0):
+        """
+        Waits for data, then reads everything in the FIFO. Sleeps on the INT pin if an interrupt source was given,
+        otherwise polls the FIFO pointers. Returns an (N, channels) array, which is empty if timeout (in seconds) runs out
+        """
+        if self.interrupt is not None:
+            if self.interrupt.wait(timeout):
+                # reading the status registers releases the INT pin
+                self.read_interrupt_status()
+            return self.drain_fifo()
+
+        deadline = time.monotonic() + timeout
+        while True:
+            batch = self.drain_fifo()
+            now = time.monotonic()
+            if len(batch) or now >= deadline:
+                return batch
+            # nothing yet: come back when the FIFO should be about half full rather than hammering the bus
+            time.sleep(min(FIFO_DEPTH / 2 / self.output_rate(), deadline - now))
+
+    def stream(self, max_pending=8, poll=None, executor=None):
+        """
+        Async iterator over (times, batch) tuples, for use in an asyncio event loop (see aio.py):
+
+        async with pulseOx.stream() as stream:
+            async for times, batch in stream:
+                ...
+
+        The FIFO is read on an executor thread (sleeping on the INT pin if there's an interrupt source, otherwise
+        every poll seconds), up to max_pending batches ahead of the consumer
+        """
+        from aio import max30101_stream
+        return max30101_stream(self, max_pending, poll, executor)
+
+    def next_sample(self):
+        """
+        Returns the next sample as a numpy row, refilling from the FIFO a whole batch at a time
+        """
+        while self.pending_pos >= len(self.pending):
+            self.pending = self.read_batch()
+            self.pending_pos = 0
+        sample = self.pending[self.pending_pos]
+        self.pending_pos += 1
+        return sample
+
+    def enable_interrupts(self, a_full=True, ppg_rdy=False, alc_ovf=False, die_temp=False):
+        """
+        Sets INT_ENABLE_1 and INT_ENABLE_2 (in one transfer, they are adjacent). Any enabled interrupt pulls INT low
+        until the status registers are read
+        """
+        enable_1 = (INT_A_FULL if a_full else 0) | (INT_PPG_RDY if ppg_rdy else 0) | (INT_ALC_OVF if alc_ovf else 0)
+        enable_2 = INT_DIE_TEMP_RDY if die_temp else 0
+        with self.batch():
+            self.update_register(INT_ENABLE_1, 0xFF, enable_1)
+            self.update_register(INT_ENABLE_2, 0xFF, enable_2)
+
+    def read_interrupt_status(self):
+        """
+        Reads (and so clears) INT_STAT_1 and INT_STAT_2. Returns tuple (status 1, status 2); see the INT_* bits
+        """
+        status_1, status_2 = self.bus.read_i2c_block_data(PULSEOX_ADDR, INT_STAT_1, 2)
+        if metrics.enabled:
+            metrics.count('max30101.transactions')
+            metrics.count('max30101.bytes', 2)
+        return (status_1, status_2)
+
     def read_spo2_data(self):
         """
         Read data from FIFO with processing (ie. separating red and IR led data). Returns tuple (red data, ir data) 
         """
-        # make sure we have enough data to read
-        while not self.is_data_ready():
-            continue
-
-        data = self.bus.read_i2c_block_data(PULSEOX_ADDR, FIFO_DATA, SPO2_SIZE)
-
-        # convert ints to hex format
-        data = list(map(lambda x: "0x{:02x}".format(x), data))
-        # ignore the 0x prefix
-        data = list(map(lambda x : x[x.index('x') + 1:], data))
-        # combine bytes of data
-        red = '0x' + data[0] + data[1] + data[2]
-        ir = '0x' + data[3] + data[4] + data[5]
-        # convert back to int
-        red = int(red, 0)
-        ir = int(ir, 0)
-        
-        return (red, ir)
+        return tuple(self.next_sample()[:2].tolist())
 
     def plot_spo2_waveform(self):
         """
         Real time plot of red, ir led waveforms while in spo2 mode
         """
-        # plot waveform - adapted from stackoverflow.com/questions/45046239/python-realtime-plot-using-pyqtgraph
-        app = QtGui.QApplication([])
-        
-        win = pg.GraphicsWindow(title='PulseOx Data')
-        win.resize(1000,600)
-        win.setWindowTitle('Waveform Data')
-        
-        p1 = win.addPlot(title='Waveform Data')
-        redCurve = p1.plot()
-        irCurve = p1.plot()
+        # plotting (and so Qt) is only loaded when it's used, so headless logging doesn't pay for it
+        from live_plot import LivePlot
 
-        windowWidth = 100
-        redData = np.linspace(0,0,windowWidth)
-        irData = np.linspace(0,0,windowWidth)
-        
-        ptr = windowWidth - 1 # pointer to where data is added to our plot
-        
-        # enable antialiasing
-        pg.setConfigOptions(antialias=True)
-        
-        # realtime data plotting
-        while True:
-            # update data
-            dataPoint = self.read_spo2_data()
-            redData[ptr] = dataPoint[0]
-            irData[ptr] = dataPoint[1]
-            # shift data windows one to the left
-            redData[:-1] = redData[1:]
-            irData[:-1] = irData[1:]
-            
-            # update plot
-            redCurve.setData(redData)
-            irCurve.setData(irData)
-            QtGui.QApplication.processEvents()
-        
-        # close Qt
-        pg.QtGui.QApplication.exec_()
+        # acquisition runs in its own thread; the plot redraws from the ring buffer on a timer
+        acq = Acquisition()
+        ring = acq.add('reflect', MAX30101Source(self))
+
+        plot = LivePlot(window_width=100)
+        plot.add_curve(ring, 0, pen='r')
+        plot.add_curve(ring, 1, pen='m')
+
+        acq.start()
+        plot.run()
+        acq.stop()
 
     def read_multi_data(self):
         """
         Read data from FIFO with processing (ie. separating red and IR and green led data). Returns tuple (red data, ir data, green data)
         """
-        # make sure we have enough data to read
-        while not self.is_data_ready():
-            continue
-
-        data = self.bus.read_i2c_block_data(PULSEOX_ADDR, FIFO_DATA, MULTI_SIZE)
-
-        # convert ints to hex format
-        data = list(map(lambda x: "0x{:02x}".format(x), data))
-        # ignore the 0x prefix
-        data = list(map(lambda x : x[x.index('x') + 1:], data))
-        # combine bytes of data
-        red = '0x' + data[0] + data[1] + data[2]
-        ir = '0x' + data[3] + data[4] + data[5]
-        green = '0x' + data[6] + data[7] + data[8]
-        # convert back to int
-        red = int(red, 0)
-        ir = int(ir, 0)
-        green = int(green, 0)
-
-        return (red, ir, green)
+        return tuple(self.next_sample()[:3].tolist())
 
     def plot_multi_waveform(self):
         """
         Real time plot of red, ir, green led waveforms while in multi-led mode
         """
-        # plot waveform - adapted from stackoverflow.com/questions/45046239/python-realtime-plot-using-pyqtgraph
-        app = QtGui.QApplication([])
-        
-        win = pg.GraphicsWindow(title='PulseOx Data')
-        win.resize(1000,600)
-        win.setWindowTitle('Waveform Data')
-        
-        p1 = win.addPlot(title='Waveform Data')
-        redCurve = p1.plot()
-        irCurve = p1.plot()
-        greenCurve = p1.plot()
-
-        windowWidth = 100
-        redData = np.linspace(0,0,windowWidth)
-        irData = np.linspace(0,0,windowWidth)
-        greenData = np.linspace(0,0,windowWidth)
-        
-        ptr = windowWidth - 1 # pointer to where data is added to our plot
-        
-        # enable antialiasing
-        pg.setConfigOptions(antialias=True)
-        
-        # realtime data plotting
-        while True:
-            # update data
-            dataPoint = self.read_multi_data()
-            redData[ptr] = dataPoint[0]
-            irData[ptr] = dataPoint[1]
-            greenData[ptr] = dataPoint[2]
-            # shift data windows one to the left
-            redData[:-1] = redData[1:]
-            irData[:-1] = irData[1:]
-            greenData[:-1] = greenData[1:]
-            
-            # update plot
-            redCurve.setData(redData)
-            irCurve.setData(irData)
-            greenCurve.setData(greenData)
-            QtGui.QApplication.processEvents()
-        
-        # close Qt
-        pg.QtGui.QApplication.exec_()
+        from live_plot import LivePlot
+
+        # acquisition runs in its own thread; the plot redraws from the ring buffer on a timer
+        acq = Acquisition()
+        ring = acq.add('reflect', MAX30101Source(self))
+
+        plot = LivePlot(window_width=100)
+        plot.add_curve(ring, 0, pen='r')
+        plot.add_curve(ring, 1, pen='m')
+        plot.add_curve(ring, 2, pen='g')
+
+        acq.start()
+        plot.run()
+        acq.stop()
 
     def set_sample_avg(self, level):
         """
@@ -282,20 +558,8 @@ class MAX30101():
             print('Invalid input')
             return
         
-        fifo_config = self.bus.read_byte_data(PULSEOX_ADDR, FIFO_CONFIG)
-        if level == 0:
-            fifo_config &= 0x1F
-        elif level == 1:
-            fifo_config = ((fifo_config | 0x20) & 0x3F)
-        elif level == 2:
-            fifo_config = ((fifo_config | 0x40) & 0x5F)
-        elif level == 3:
-            fifo_config = ((fifo_config | 0x60) & 0x7F)
-        elif level == 5:
-            fifo_config = ((fifo_config | 0x80) & 0x9F)
-        else:
-            fifo_config |= 0xE0
-        self.bus.write_byte_data(PULSEOX_ADDR, FIFO_CONFIG, fifo_config)
+        # SMP_AVE is bits 7:5
+        self.update_register(FIFO_CONFIG, 0xE0, level << 5)
         
     def set_adc_range(self, level):
         """
@@ -311,16 +575,8 @@ class MAX30101():
             print('Invalid input')
             return
 
-        adc_range = self.bus.read_byte_data(PULSEOX_ADDR, SPO2_CONFIG)
-        if level == 0:
-            adc_range &= 0x9F
-        elif level == 1:
-            adc_range = ((adc_range | 0x20) & 0xBF)
-        elif level == 2:
-            adc_range = ((adc_range | 0x40) & 0xDF)
-        else:
-            adc_range |= 0x60
-        self.bus.write_byte_data(PULSEOX_ADDR, SPO2_CONFIG, adc_range)
+        # SPO2_ADC_RGE is bits 6:5
+        self.update_register(SPO2_CONFIG, 0x60, level << 5)
 
     def set_sample_rate(self, level):
         """
@@ -340,25 +596,8 @@ class MAX30101():
             print('Invalid Input')
             return
         
-        rate = self.bus.read_byte_data(PULSEOX_ADDR, SPO2_CONFIG)
-        if level == 0:
-            rate &= 0xE3
-        elif level == 1:
-            rate = ((rate | 0x04) & 0xE7)
-        elif level == 2:
-            rate = ((rate | 0x08) & 0xEB)
-        elif level == 3:
-            rate = ((rate | 0x0C) & 0xEF)
-        elif level == 4:
-            rate = ((rate | 0x10) & 0xF3)
-        elif level == 5:
-            rate = ((rate | 0x14) & 0xF7)
-        elif level == 6:
-            rate = ((rate | 0x18) & 0xFB)
-        else:
-            rate |= 0x1C
-
-        self.bus.write_byte_data(PULSEOX_ADDR, SPO2_CONFIG, rate)
+        # SPO2_SR is bits 4:2
+        self.update_register(SPO2_CONFIG, 0x1C, level << 2)
 
     def set_pulse_width(self, level):
         """
@@ -373,17 +612,8 @@ class MAX30101():
             print('Invalid Input')
             return
 
-        pulse = self.bus.read_byte_data(PULSEOX_ADDR, SPO2_CONFIG)
-        if level == 0:
-            pulse &= 0xFC
-        elif level == 1:
-            pulse = ((pulse | 0x01) & 0xFD)
-        elif level == 2:
-            pulse = ((pulse | 0x02) & 0xFE)
-        else:
-            pulse |= 0x3
-
-        self.bus.write_byte_data(PULSEOX_ADDR, SPO2_CONFIG, pulse)
+        # LED_PW is bits 1:0
+        self.update_register(SPO2_CONFIG, 0x03, level)
 
     def set_red(self, current):
         """
@@ -394,8 +624,8 @@ class MAX30101():
         if current > 51 or current < 0:
             print('Invalid Input')
             return
-        led_reg = int(current / 0.2)
-        self.bus.write_byte_data(PULSEOX_ADDR, LED1_PA, led_reg)
+        led_reg = int(round(current / LED_STEP))
+        self.update_register(LED1_PA, 0xFF, led_reg)
 
     def set_ir(self, current):
         """
@@ -406,8 +636,8 @@ class MAX30101():
         if current > 51 or current < 0:
             print('Invalid Input')
             return
-        led_reg = int(current / 0.2)
-        self.bus.write_byte_data(PULSEOX_ADDR, LED2_PA, led_reg)
+        led_reg = int(round(current / LED_STEP))
+        self.update_register(LED2_PA, 0xFF, led_reg)
         
     def set_green(self, current):
         """
@@ -418,8 +648,19 @@ class MAX30101():
         if current > 51 or current < 0:
             print('Invalid Input')
             return
-        led_reg = int(current / 0.2)
-        self.bus.write_byte_data(PULSEOX_ADDR, LED3_PA, led_reg)
+        led_reg = int(round(current / LED_STEP))
+        self.update_register(LED3_PA, 0xFF, led_reg)
+
+    def set_fifo_a_full(self, level):
+        """
+        Sets when the FIFO almost full interrupt fires: level (0-15) is the number of empty FIFO slots left,
+        ie. it fires once 32 - level samples are waiting
+        """
+        if level not in range(16):
+            print('Invalid Input')
+            return
+
+        self.update_register(FIFO_CONFIG, 0x0F, level)
 
     def set_overflow(self, mode):
         """
@@ -430,35 +671,43 @@ class MAX30101():
             print('Invalid Input')
             return
         
-        rollover = self.bus.read_byte_data(PULSEOX_ADDR, FIFO_CONFIG)
-        if mode == 0:
-            rollover &= 0xEF
-        else:
-            rollover |= 0x10
-        self.bus.write_byte_data(PULSEOX_ADDR, FIFO_CONFIG, rollover)
+        # FIFO_ROLLOVER_EN is bit 4
+        self.update_register(FIFO_CONFIG, 0x10, mode << 4)
 
     def reset(self):
         """
         triggers reset on device, returns all registers to startup conditions (mostly 0x00 for all)
         """
-        reset_byte = self.bus.read_byte_data(PULSEOX_ADDR, MODE_CONFIG)
-        reset_byte |= 0x40
-        self.bus.write_byte_data(PULSEOX_ADDR, MODE_CONFIG, reset_byte)
+        # the reset bit clears every other bit too, so there's nothing to preserve
+        self.bus.write_byte_data(PULSEOX_ADDR, MODE_CONFIG, RESET_BIT)
+        self.shadow = bytearray(256)
+        self.dirty = set()
         
-    def collect_spo2_data(self):
+    def collect_spo2_data(self, size=200):
+        """
+        Records size samples to a binary recording (see recording.py; recording_to_csv converts it to .csv)
+        """
         time.sleep(5)
-        with open(f'data_{datetime.now()}.csv', 'w') as csvfile:
-            fieldnames = ['time', 'Reflect: Red', 'Reflect: IR']
-            writer = csv.DictWriter(csvfile, fieldnames)
-            
-            writer.writeheader()    
-            start_time=time.time()
-            
-            for i in range(200):
-                refData = self.read_spo2_data()
-                
-                writer.writerow({fieldnames[0] : time.time() - start_time, fieldnames[1] : refData[0], fieldnames[2] : refData[1]})
-            csvfile.close()
+        # times come from the sensor's own sample clock, not from when each read happened to return
+        source = MAX30101Source(self)
+        self.drain_fifo()
+        with RecordingWriter(f'data_{datetime.now()}.pox', REFLECT_FIELDS, dict(self.settings, sample_rate_hz=self.output_rate())) as writer:
+            start_time = None
+            count = 0
+            while count < size:
+                times, batch = source.read()
+                batch = batch[:size - count]
+                if not len(batch):
+                    continue
+                if start_time is None:
+                    start_time = times[0]
+
+                records = np.zeros(len(batch), dtype=writer.dtype)
+                records['time'] = times[:len(batch)] - start_time
+                records['red'] = batch[:, 0]
+                records['ir'] = batch[:, 1]
+                writer.write(records)
+                count += len(batch)
         self.reset()
 
 ### SAMPLE USAGE
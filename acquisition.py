@@ -0,0 +1,388 @@
+### background acquisition -- every device runs in its own producer thread and writes into its own ring buffer,
+### so a slow device (or slow disk) never stalls the other one
+import threading
+import time
+from collections import deque
+import numpy as np
+
+# seconds to wait before retrying a source after an error, doubling while the errors keep coming (eg. an unplugged
+# bus or serial port) so the retries don't spin
+ERROR_BACKOFF = (0.01, 1.0)
+
+def error_backoff(delay):
+    """
+    Delay before the next retry, given the last one (0 after a good read)
+    """
+    return min(max(2 * delay, ERROR_BACKOFF[0]), ERROR_BACKOFF[1])
+
+class RingBuffer():
+    """
+    Preallocated, fixed capacity buffer of timestamped rows, written by a single producer thread and read by any
+    number of consumers without locks.
+
+    Every row is stored twice (at i and i + capacity), so any span of up to capacity rows is one contiguous slice
+    and consumers get views instead of copies. The producer fills in rows first and only then advances write_count,
+    so a consumer never sees a half written row. A view stays valid until the producer laps it (capacity rows later);
+    copy it if you need to keep it longer than that.
+    """
+    def __init__(self, capacity, channels, dtype=np.float64):
+        self.capacity = capacity
+        self.channels = channels
+        self.times = np.zeros(2 * capacity)
+        self.data = np.zeros((2 * capacity, channels), dtype=dtype)
+        # total number of rows ever written; slot of row k is k % capacity
+        self.write_count = 0
+        # rows thrown away because a single batch was bigger than the whole buffer
+        self.dropped = 0
+
+    def write(self, times, rows):
+        """
+        Appends a batch. times is a length N array, rows is (N, channels)
+        """
+        n = len(rows)
+        if n > self.capacity:
+            self.dropped += n - self.capacity
+            times = times[-self.capacity:]
+            rows = rows[-self.capacity:]
+            n = self.capacity
+
+        start = self.write_count % self.capacity
+        end = start + n
+        self.times[start:end] = times
+        self.data[start:end] = rows
+
+        # mirror into the other half: slots below capacity go up by capacity, slots past it wrap to the front
+        split = min(end, self.capacity)
+        self.times[start + self.capacity:split + self.capacity] = self.times[start:split]
+        self.data[start + self.capacity:split + self.capacity] = self.data[start:split]
+        self.times[:end - split] = self.times[self.capacity:end]
+        self.data[:end - split] = self.data[self.capacity:end]
+
+        self.write_count += n
+
+    def span(self, first, n):
+        """
+        Returns views (times, data) of n rows starting at absolute row number first. The caller makes sure those
+        rows are still in the buffer
+        """
+        start = first % self.capacity
+        return (self.times[start:start + n], self.data[start:start + n])
+
+    def latest(self, n):
+        """
+        Returns views (times, data) of the most recent n rows (fewer if not that many have been written yet)
+        """
+        count = self.write_count
+        n = min(n, count, self.capacity)
+        return self.span(count - n, n)
+
+    def snapshot(self, n):
+        """
+        Same as latest, but copies the rows so they can be kept around
+        """
+        times, data = self.latest(n)
+        return (times.copy(), data.copy())
+
+class RingReader():
+    """
+    A consumer's cursor into a RingBuffer. Each read returns what was written since the previous read
+    """
+    def __init__(self, ring):
+        self.ring = ring
+        self.position = ring.write_count
+        # rows the producer overwrote before this reader got to them
+        self.overruns = 0
+
+    def available(self):
+        return min(self.ring.write_count - self.position, self.ring.capacity)
+
+    def read(self, max_rows=None):
+        """
+        Returns views (times, data) of new rows, at most max_rows of them
+        """
+        count = self.ring.write_count
+        behind = count - self.position
+        if behind > self.ring.capacity:
+            self.overruns += behind - self.ring.capacity
+            self.position = count - self.ring.capacity
+            behind = self.ring.capacity
+
+        n = behind if max_rows is None else min(behind, max_rows)
+        views = self.ring.span(self.position, n)
+        self.position += n
+        return views
+
+class SampleClock():
+    """
+    Reconstructs when each sample was taken from the device's own sample clock, instead of stamping rows with the time
+    they happened to be read (which is mostly python scheduling jitter).
+
+    Sample k was taken at start + k * period. Every read gives an observation: by time t the device had produced count
+    samples, so sample count - 1 was taken at or before t. period is fitted to those observations over the last window
+    seconds (following the device's clock drift, starting from the nominal rate), and start is set by the tightest
+    observation, ie. the read that came soonest after its newest sample.
+
+    eg.
+    clock = SampleClock(sensor.output_rate())
+    times = clock.stamp(count, len(batch), t)
+    """
+    def __init__(self, rate, window=60.0, interval=0.5, min_span=5.0, tolerance=0.05, resync=0.5):
+        """
+        rate: nominal samples per second
+        window: seconds of observations the period is fitted over
+        interval: observations are thinned to the tightest one per interval seconds
+        min_span: seconds of observations needed before the fitted period is used
+        tolerance: largest believable fractional difference between the real and nominal rate
+        resync: start over if a read comes this many seconds later than its newest sample should have been taken
+        (eg. samples lost without being counted, or the device stopped and started again)
+        """
+        self.rate = rate
+        self.window = window
+        self.interval = interval
+        self.min_span = min_span
+        self.tolerance = tolerance
+        self.resync = resync
+        self.resyncs = 0
+        self.reset()
+
+    def reset(self):
+        self.period = 1 / self.rate
+        # observations are kept relative to the first one, (sample index - origin index, time - origin time)
+        self.origin = None
+        self.points = deque()
+        self.candidate = None
+        self.interval_start = None
+        self.offset = None
+        self.last_time = -np.inf
+
+    def observe(self, count, t):
+        """
+        Records that count samples had been produced by monotonic time t
+        """
+        if count <= 0:
+            return
+        if self.origin is None:
+            self.origin = (count - 1, t)
+        x = count - 1 - self.origin[0]
+        y = t - self.origin[1]
+
+        if self.offset is not None and y - (self.offset + x * self.period) > self.resync:
+            self.resyncs += 1
+            self.reset()
+            self.origin = (count - 1, t)
+            x = 0
+            y = 0.0
+
+        # keep the tightest observation of each interval
+        if self.candidate is not None and y - self.interval_start >= self.interval:
+            self.add_point(self.candidate)
+            self.candidate = None
+        if self.candidate is None:
+            self.interval_start = y
+        if self.candidate is None or y - x * self.period < self.candidate[1] - self.candidate[0] * self.period:
+            self.candidate = (x, y)
+
+        offset = y - x * self.period
+        if self.offset is None or offset < self.offset:
+            self.offset = offset
+
+    def add_point(self, point):
+        """
+        Adds a thinned observation and refits the period and start over the window
+        """
+        self.points.append(point)
+        while self.points[-1][1] - self.points[0][1] > self.window:
+            self.points.popleft()
+        if self.points[-1][1] - self.points[0][1] < self.min_span:
+            return
+
+        x, y = np.array(self.points).T
+        period = np.polyfit(x, y, 1)[0]
+        nominal = 1 / self.rate
+        self.period = min(max(period, nominal * (1 - self.tolerance)), nominal * (1 + self.tolerance))
+        self.offset = np.min(y - x * self.period)
+        if self.candidate is not None:
+            self.offset = min(self.offset, self.candidate[1] - self.candidate[0] * self.period)
+
+    def times(self, first, n):
+        """
+        Monotonic timestamps of samples first .. first + n - 1 (sample numbers as counted in observe)
+        """
+        k = first - self.origin[0] + np.arange(n)
+        times = self.origin[1] + self.offset + k * self.period
+        # refits can move start back by up to the read jitter; never let time run backwards
+        times = np.maximum(times, self.last_time)
+        if n:
+            self.last_time = times[-1]
+        return times
+
+    def stamp(self, count, n, t):
+        """
+        observe(count, t), then returns the timestamps of the n samples up to count (ie. the batch just read)
+        """
+        self.observe(count, t)
+        if n == 0:
+            # nothing read (possibly nothing at all yet, so there's no origin to count from)
+            return np.empty(0)
+        return self.times(count - n, n)
+
+class MAX30101Source():
+    """
+    Producer side adapter for a MAX30101: one FIFO batch per read, sleeping on the interrupt if the sensor has one
+    """
+    dtype = np.uint32
+
+    def __init__(self, sensor, timeout=0.1):
+        self.sensor = sensor
+        self.timeout = timeout
+        self.channels = sensor.channels
+        self.clock = SampleClock(sensor.output_rate())
+
+    def read(self):
+        return self.stamp(self.sensor.read_batch(self.timeout))
+
+    def stamp(self, batch):
+        """
+        Returns tuple (times, batch) for a batch just read from the sensor
+        """
+        if self.clock.rate != self.sensor.output_rate():
+            self.clock = SampleClock(self.sensor.output_rate())
+        # samples lost to overflow still took up their place on the sensor's clock
+        count = self.sensor.samples_read + self.sensor.overflow_count
+        return (self.clock.stamp(count, len(batch), self.sensor.status_time), batch)
+
+    def drops(self):
+        return self.sensor.overflow_count
+
+class CMS50DSource():
+    """
+    Producer side adapter for a CMS50D: every (bpm, spo2, waveform) packet that has arrived, per read
+    """
+    channels = 3
+    dtype = np.int32
+
+    def __init__(self, pulseOx, rate=60):
+        """
+        rate: packets per second the pulseOx sends
+        """
+        self.pulseOx = pulseOx
+        self.clock = SampleClock(rate)
+        self.packets = 0
+
+    def read(self):
+        batch = self.pulseOx.read_batch()
+        return self.stamp(batch, time.monotonic())
+
+    def stamp(self, batch, t):
+        """
+        Returns tuple (times, batch) for a batch of packets that had all arrived by monotonic time t
+        """
+        self.packets += len(batch)
+        return (self.clock.stamp(self.packets + self.drops(), len(batch), t), batch)
+
+    def drops(self):
+        # framing errors are counted in bytes; every 9 of them is (roughly) a lost packet
+        return self.pulseOx.parser.framing_errors // 9
+
+class Producer(threading.Thread):
+    """
+    Thread that keeps reading batches from a source and writing them into a ring buffer until stopped
+    """
+    def __init__(self, name, source, ring):
+        super().__init__(name=name, daemon=True)
+        self.source = source
+        self.ring = ring
+        self.stopped = threading.Event()
+        self.samples = 0
+        # bus/serial errors, counted and skipped so one bad transfer doesn't end the recording
+        self.errors = 0
+
+    def run(self):
+        delay = 0
+        while not self.stopped.is_set():
+            try:
+                times, rows = self.source.read()
+            except OSError:
+                self.errors += 1
+                delay = error_backoff(delay)
+                self.stopped.wait(delay)
+                continue
+            delay = 0
+            if len(rows):
+                self.ring.write(times, rows)
+                self.samples += len(rows)
+
+    def stop(self):
+        self.stopped.set()
+
+class Acquisition():
+    """
+    Runs each device in its own producer thread, feeding its own ring buffer. Consumers (writers, plotters, dsp)
+    attach with reader() and never block the producers.
+
+    eg.
+    acq = Acquisition()
+    acq.add('reflect', MAX30101Source(MAX30101()))
+    acq.add('trans', CMS50DSource(CMS50D('/dev/ttyUSB0')))
+    reflect = acq.reader('reflect')
+    acq.start()
+    times, data = reflect.read()
+    acq.stop()
+    """
+    def __init__(self, capacity=4096):
+        """
+        capacity: default number of rows each device's ring buffer holds
+        """
+        self.capacity = capacity
+        self.sources = {}
+        self.rings = {}
+        self.producers = {}
+        self.readers = {}
+        self.start_time = None
+
+    def add(self, name, source, capacity=None):
+        """
+        Registers a device. source needs read() -> (times, rows), drops() and channels/dtype attributes
+        """
+        ring = RingBuffer(capacity or self.capacity, source.channels, source.dtype)
+        self.sources[name] = source
+        self.rings[name] = ring
+        self.producers[name] = Producer(name, source, ring)
+        self.readers[name] = []
+        return ring
+
+    def reader(self, name):
+        """
+        Returns a new RingReader on the named device, starting from the newest row
+        """
+        reader = RingReader(self.rings[name])
+        self.readers[name].append(reader)
+        return reader
+
+    def start(self):
+        self.start_time = time.monotonic()
+        for producer in self.producers.values():
+            producer.start()
+
+    def stop(self):
+        for producer in self.producers.values():
+            producer.stop()
+        for producer in self.producers.values():
+            producer.join()
+
+    def counters(self):
+        """
+        Returns {device name: {'samples', 'errors', 'device_drops', 'ring_drops', 'overruns'}}, where device_drops
+        are samples the device itself lost (eg. FIFO overflow), ring_drops are batches too big for the ring buffer
+        and overruns are rows overwritten before a reader got to them (summed over readers)
+        """
+        counters = {}
+        for name, producer in self.producers.items():
+            counters[name] = {
+                'samples' : producer.samples,
+                'errors' : producer.errors,
+                'device_drops' : self.sources[name].drops(),
+                'ring_drops' : self.rings[name].dropped,
+                'overruns' : sum(reader.overruns for reader in self.readers[name]),
+            }
+        return counters
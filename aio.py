@@ -0,0 +1,178 @@
+### asyncio counterparts of the acquisition threads -- one event loop can run several sensors, writers and
+### network/ui consumers side by side, each as an async iterator over timestamped batches
+#
+# eg.
+# async def record(pulseOx, transPulseOx):
+#     async with pulseOx.stream() as reflect, transPulseOx.stream() as trans:
+#         async for times, batch in reflect:
+#             ...
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+from acquisition import CMS50DSource, MAX30101Source, error_backoff
+from MAX30101 import FIFO_DEPTH
+
+class AsyncStream():
+    """
+    Async iterator over (times, rows) batches from one device. A reader task keeps reading while the consumer works,
+    up to max_pending batches ahead of it. When the consumer falls that far behind, the reader waits for it
+    (backpressure) and the device's own buffer (FIFO or serial buffer) takes up the slack; anything that overflows
+    there is counted by the device as usual (overflow_count, framing_errors).
+
+    Closing the stream (leaving the async with block, aclose(), or cancelling the task iterating it) cancels the
+    reader. Blocking calls run with short timeouts, so that takes at most one of them.
+    """
+    def __init__(self, read, max_pending=8, close=None):
+        """
+        read: coroutine function returning one (times, rows) batch, possibly empty
+        close: function to call once the reader has stopped (eg. shutting down its executor)
+        """
+        self.read = read
+        self.max_pending = max_pending
+        self.close = close
+        self.queue = None
+        self.task = None
+        self.closed = False
+        self.batches = 0
+        self.samples = 0
+        # bus/serial errors, counted and skipped like in acquisition.Producer
+        self.errors = 0
+        # times the reader had to wait for the consumer
+        self.waits = 0
+
+    def start(self):
+        self.queue = asyncio.Queue(self.max_pending)
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    async def run(self):
+        try:
+            delay = 0
+            while True:
+                try:
+                    times, rows = await self.read()
+                except OSError:
+                    self.errors += 1
+                    delay = error_backoff(delay)
+                    await asyncio.sleep(delay)
+                    continue
+                delay = 0
+                if not len(rows):
+                    continue
+                if self.queue.full():
+                    self.waits += 1
+                await self.queue.put((times, rows))
+                self.batches += 1
+                self.samples += len(rows)
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            # hand it to the consumer instead of losing it in the task; waits if the queue is full, like a batch
+            await self.queue.put(error)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self.closed:
+            raise StopAsyncIteration
+        if self.task is None:
+            self.start()
+        item = await self.queue.get()
+        if isinstance(item, Exception):
+            await self.aclose()
+            raise item
+        return item
+
+    async def aclose(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        if self.close is not None:
+            self.close()
+
+    async def __aenter__(self):
+        if self.task is None:
+            self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+def max30101_stream(sensor, max_pending=8, poll=None, executor=None):
+    """
+    AsyncStream over a MAX30101 (see MAX30101.stream). I2C transfers run on executor, one at a time (default: a
+    thread of its own, shut down when the stream closes; pass a shared single thread executor for sensors on the same
+    bus). With an interrupt source the executor sleeps on the INT pin; without one the event loop sleeps poll seconds
+    between FIFO reads instead of polling the pointers (default: time for half the FIFO to fill)
+    """
+    own_executor = executor is None
+    if own_executor:
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='MAX30101')
+    # short interrupt waits, so a cancelled stream doesn't leave the executor blocked for long
+    source = MAX30101Source(sensor, timeout=0.05)
+
+    async def read():
+        loop = asyncio.get_running_loop()
+        if sensor.interrupt is not None:
+            return await loop.run_in_executor(executor, source.read)
+        await asyncio.sleep(poll or FIFO_DEPTH / 2 / sensor.output_rate())
+        return await loop.run_in_executor(executor, read_now)
+
+    def read_now():
+        return source.stamp(sensor.drain_fifo())
+
+    return AsyncStream(read, max_pending, close=executor.shutdown if own_executor else None)
+
+def cms50d_stream(pulseOx, max_pending=8, poll=0.01, keepalive=10.0, quiet=1.0):
+    """
+    AsyncStream over a CMS50D (see CMS50D.stream). Reads never block: on a real serial port the event loop watches
+    its file descriptor and reads only what has arrived; ports without one (eg. the emulator) are polled every poll
+    seconds. Unless a CMS50DSession is running, the stream itself resends the handshake every keepalive seconds, and
+    whenever nothing has arrived for quiet seconds
+    """
+    source = CMS50DSource(pulseOx)
+    fileno = getattr(pulseOx.port, 'fileno', None)
+    state = {'last_handshake' : time.monotonic(), 'last_data' : time.monotonic()}
+
+    async def wait_readable():
+        """
+        Waits until the port has data, or for quiet seconds
+        """
+        if fileno is None:
+            await asyncio.sleep(poll)
+            return
+        loop = asyncio.get_running_loop()
+        waiter = loop.create_future()
+        def wake():
+            if not waiter.done():
+                waiter.set_result(None)
+        # a plain future rather than wait_for, which can swallow a cancel that lands just as the data does
+        fd = fileno()
+        loop.add_reader(fd, wake)
+        timer = loop.call_later(quiet, wake)
+        try:
+            await waiter
+        finally:
+            loop.remove_reader(fd)
+            timer.cancel()
+
+    async def read():
+        await wait_readable()
+        now = time.monotonic()
+        # only what has arrived, so the read never waits on the port timeout
+        waiting = pulseOx.port.in_waiting
+        if waiting:
+            state['last_data'] = now
+        if pulseOx.auto_handshake and (now - state['last_handshake'] >= keepalive or now - state['last_data'] >= quiet):
+            pulseOx.send_handshake()
+            state['last_handshake'] = now
+            state['last_data'] = now
+        return source.stamp(pulseOx.parser.feed(pulseOx.port.read(waiting) if waiting else b''), now)
+
+    return AsyncStream(read, max_pending)
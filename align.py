@@ -0,0 +1,139 @@
+### lines up independently timestamped streams (eg. the CMS50D at 60 packets/s and the MAX30101 at its own rate)
+### on one timeline, so each device can run at full speed in its own thread
+#
+# eg.
+# aligner = StreamAligner(reference='reflect')
+# aligner.add_stream('reflect')
+# aligner.add_stream('trans', method=['previous', 'previous', 'linear'])
+# aligner.push('trans', transTimes, transRows)
+# aligner.push('reflect', refTimes, refRows)
+# times, rows = aligner.pull()      # rows['trans'][i] is the transmission data at times[i]
+import numpy as np
+
+class AlignedStream():
+    """
+    Buffered samples of one stream, and how to fill in values between them
+    """
+    def __init__(self, method):
+        self.method = method
+        self.times = np.empty(0)
+        self.rows = None
+        # number of output times that were past this stream's newest sample (filled by holding the last value)
+        self.stale = 0
+
+    def push(self, times, rows):
+        rows = np.asarray(rows, dtype=np.float64)
+        if rows.ndim == 1:
+            rows = rows[:, None]
+        if self.rows is None:
+            self.rows = np.empty((0, rows.shape[1]))
+            # which columns are interpolated
+            methods = [self.method] * rows.shape[1] if isinstance(self.method, str) else self.method
+            self.linear = np.array([method == 'linear' for method in methods])
+        self.times = np.concatenate((self.times, times))
+        self.rows = np.concatenate((self.rows, rows))
+
+    def latest(self):
+        return self.times[-1] if len(self.times) else -np.inf
+
+    def sample(self, out):
+        """
+        Values at times out (all at or after this stream's first sample). Columns whose method is 'linear' are
+        interpolated, 'previous' ones hold the last value (eg. bpm and spo2, which only change in whole steps)
+        """
+        t = self.times
+        right = np.searchsorted(t, out, side='right')
+        i0 = np.clip(right - 1, 0, len(t) - 1)
+        i1 = np.clip(right, 0, len(t) - 1)
+        gap = t[i1] - t[i0]
+        weight = np.where(gap > 0, (out - t[i0]) / np.where(gap > 0, gap, 1), 0)[:, None]
+        linear = self.rows[i0] * (1 - weight) + self.rows[i1] * weight
+        self.stale += int(np.sum(out > t[-1]))
+        return np.where(self.linear, linear, self.rows[i0])
+
+    def discard_before(self, t):
+        """
+        Drops samples that no output time at or after t can need (keeps the last one before t to interpolate from)
+        """
+        keep = max(0, np.searchsorted(self.times, t, side='right') - 1)
+        self.times = self.times[keep:]
+        self.rows = self.rows[keep:]
+
+class StreamAligner():
+    """
+    Buffers several timestamped streams and resamples them onto a common timeline, a batch at a time.
+
+    The timeline is either a uniform grid at rate Hz, or the timestamps of the reference stream (so that stream comes
+    out untouched and the others are resampled to it). An output time is ready once every stream has a sample at or
+    after it, so values are interpolated rather than guessed; if a stream falls more than max_latency seconds behind
+    the newest data, the others go on without it and its last value is held (counted in stale).
+
+    Streams have to start before anything comes out: the timeline starts at the latest first sample of any stream.
+    """
+    def __init__(self, rate=None, reference=None, max_latency=0.5):
+        """
+        rate: output rate in Hz for a uniform timeline
+        reference: name of the stream whose timestamps are the timeline (used if rate is None)
+        max_latency: seconds a slow or stalled stream can hold up the output
+        """
+        if rate is None and reference is None:
+            raise ValueError('StreamAligner needs an output rate or a reference stream')
+        self.rate = rate
+        self.reference = reference
+        self.max_latency = max_latency
+        self.streams = {}
+        self.start = None
+        # next output time (uniform timeline)
+        self.next_time = None
+
+    def add_stream(self, name, method='linear'):
+        """
+        method: 'linear' or 'previous' for every column, or a list with one per column
+        """
+        self.streams[name] = AlignedStream(method)
+
+    def push(self, name, times, rows):
+        """
+        Adds a batch of samples to a stream. times must be increasing (eg. from acquisition.SampleClock)
+        """
+        if len(times):
+            self.streams[name].push(np.asarray(times, dtype=np.float64), rows)
+
+    def ready_until(self):
+        """
+        Latest output time that can be produced now
+        """
+        latest = [stream.latest() for stream in self.streams.values()]
+        newest = max(latest)
+        return max(min(latest), newest - self.max_latency)
+
+    def pull(self):
+        """
+        Returns tuple (times, {stream name: (N, columns) array}) of every output time that's ready, oldest first.
+        Returns nothing (N = 0) until every stream has started
+        """
+        streams = self.streams.values()
+        if self.start is None:
+            if any(stream.rows is None or not len(stream.times) for stream in streams):
+                return (np.empty(0), {})
+            self.start = max(stream.times[0] for stream in streams)
+            self.next_time = self.start
+
+        until = self.ready_until()
+        if self.rate is not None:
+            n = int(np.floor((until - self.next_time) * self.rate)) + 1 if until >= self.next_time else 0
+            times = self.next_time + np.arange(max(n, 0)) / self.rate
+            if n > 0:
+                self.next_time = times[-1] + 1 / self.rate
+        else:
+            reference = self.streams[self.reference].times
+            times = reference[(reference >= self.next_time) & (reference <= until)]
+            if len(times):
+                self.next_time = np.nextafter(times[-1], np.inf)
+
+        if not len(times):
+            return (np.empty(0), {})
+        rows = {name : stream.sample(times) for name, stream in self.streams.items()}
+        for stream in streams:
+            stream.discard_before(self.next_time)
+        return (times, rows)
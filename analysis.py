@@ -1,17 +1,30 @@
 ### various experiments to explore the effect of changing settings on PPG signal quality.
 from MAX30101 import *
+from autogain import AutoGain
 
+# collect_spo2_data resets the sensor when it's done, so each run applies the whole profile again (configure only
+# sends the registers that differ from reset)
 def change_led():
+	pulseOx = MAX30101(mode='spo2',led=6 , adc_range=3 , sample_rate=1, pulse_width=3, sample_avg=2)
 	for i in range(6, 21, 2):
-		pulseOx = MAX30101(mode='spo2',led=i , adc_range=3 , sample_rate=1, pulse_width=3, sample_avg=2)
+		pulseOx.configure(mode='spo2', led=i)
 		pulseOx.collect_spo2_data(500)
 
 def change_adc():
+	pulseOx = MAX30101(mode='spo2',led=18 , adc_range=1 , sample_rate=1, pulse_width=3, sample_avg=2)
 	for i in range(1,4):
-		pulseOx = MAX30101(mode='spo2',led=18 , adc_range=i , sample_rate=1, pulse_width=3, sample_avg=2)
+		pulseOx.configure(mode='spo2', adc_range=i)
 		pulseOx.collect_spo2_data(500)
 
 def change_pulse():
+	pulseOx = MAX30101(mode='spo2',led=18 , adc_range=2 , sample_rate=1, pulse_width=0, sample_avg=2)
 	for i in range(4):
-		pulseOx = MAX30101(mode='spo2',led=18 , adc_range=2 , sample_rate=1, pulse_width=i, sample_avg=2)
-		pulseOx.collect_spo2_data(500)
\ No newline at end of file
+		pulseOx.configure(mode='spo2', pulse_width=i)
+		pulseOx.collect_spo2_data(500)
+
+# lets AutoGain (autogain.py) pick the led current, adc range and pulse width in a few seconds, then records with them
+def auto_settings():
+	pulseOx = MAX30101(mode='spo2',led=10 , adc_range=2 , sample_rate=1, pulse_width=3, sample_avg=2)
+	result = AutoGain(pulseOx).tune()
+	print(result['settings'], result['quality'])
+	pulseOx.collect_spo2_data(500)
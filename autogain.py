@@ -0,0 +1,223 @@
+### online auto-gain for the MAX30101 -- adjusts led currents, ADC range and pulse width while the sensor is streaming,
+### from quick signal quality metrics, instead of sweeping every setting (see analysis.py) and judging the plots by eye
+#
+# eg.
+# pulseOx = MAX30101(mode='spo2')
+# result = AutoGain(pulseOx).tune()
+# print(result['settings'], result['quality'])
+#
+# or, online, on batches from a stream that is already running:
+# gain = AutoGain(pulseOx)
+# while True:
+#     batch = pulseOx.read_batch()
+#     gain.update(batch)
+import time
+import numpy as np
+from MAX30101 import ADC_MASK, LED_STEP, LED_MAX, LED1_PA, SPO2_CONFIG, SAMPLE_RATES, PULSE_WIDTHS
+
+# highest sample rate each pulse width allows in spo2 mode (datasheet); with 3 leds per sample they're about halved
+PULSE_WIDTH_MAX_RATE = [3200, 1600, 1000, 400]
+
+# ratio of light collected by each pulse width to the next longer one
+PULSE_WIDTH_SCALE = [PULSE_WIDTHS[i] / PULSE_WIDTHS[i + 1] for i in range(3)]
+
+def signal_metrics(samples, sample_rate, band=(.7, 4)):
+    """
+    Quality metrics of an (N, channels) block of raw ADC samples, one value per channel, as a dict:
+    dc -- mean level as a fraction of ADC full scale
+    headroom -- fraction of full scale left above the highest sample (0 means it clipped)
+    perfusion -- ac/dc perfusion index (std / mean)
+    snr -- power in the pulse band over power above it (nan if the window is too short to tell)
+    """
+    x = np.asarray(samples, dtype=np.float64)
+    dc = x.mean(axis=0)
+    metrics = {
+        'dc' : dc / ADC_MASK,
+        'headroom' : 1 - x.max(axis=0) / ADC_MASK,
+        'perfusion' : x.std(axis=0) / np.maximum(dc, 1),
+    }
+
+    # remove the baseline drift (linear trend) so it doesn't leak into the pulse band
+    t = np.arange(len(x)) - (len(x) - 1) / 2
+    slope = (t @ (x - dc)) / max(t @ t, 1)
+    detrended = x - dc - np.outer(t, slope)
+    power = np.abs(np.fft.rfft(detrended, axis=0)) ** 2
+    freq = np.fft.rfftfreq(len(x), 1 / sample_rate)
+    in_band = (freq >= band[0]) & (freq <= band[1])
+    noise = freq > band[1]
+    if in_band.any() and noise.any():
+        # per bin, so the answer doesn't depend on how wide each band is
+        metrics['snr'] = power[in_band].mean(axis=0) / np.maximum(power[noise].mean(axis=0), 1e-12)
+    else:
+        metrics['snr'] = np.full(x.shape[1], np.nan)
+    return metrics
+
+class AutoGain():
+    """
+    Servoes each led's dc level to target (fraction of ADC full scale) by changing its current. When a current runs
+    into its limits the shared ADC range steps (halving or doubling the counts per nA), and after that the pulse width
+    (longer pulses collect more light). Once the levels are right, a poor SNR moves to a longer pulse width if the
+    sample rate allows it.
+
+    Each step is a single configure() call on the running sensor, so only the changed registers are written.
+    """
+    def __init__(self, sensor, target=0.5, tolerance=0.2, headroom=0.05, window=0.3, quality_window=3.0, min_snr=4.0, min_current=0.4):
+        """
+        target: dc level to aim for, as a fraction of full scale
+        tolerance: relative error in the dc level that's close enough (0.2 = within 20% of target)
+        headroom: fraction of full scale that must stay free above the highest sample
+        window: seconds of data per dc adjustment
+        quality_window: seconds of data for the perfusion/SNR check (needs a few heart beats)
+        min_snr: SNR below which a longer pulse width is tried
+        min_current: lowest led current to use, in mA
+        """
+        self.sensor = sensor
+        self.target = target
+        self.tolerance = tolerance
+        self.headroom = headroom
+        self.window = window
+        self.quality_window = quality_window
+        self.min_snr = min_snr
+        self.min_current = min_current
+
+        self.buffer = []
+        self.buffered = 0
+        # samples from before the last change are still in the FIFO, so the next batch is thrown away
+        self.skip_batch = False
+        self.steps = 0
+        self.converged = False
+        self.quality = None
+
+    def state(self):
+        """
+        Returns tuple (led currents in mA, adc range level, pulse width level), from the sensor's shadow registers
+        """
+        shadow = self.sensor.shadow
+        currents = np.array(shadow[LED1_PA:LED1_PA + self.sensor.channels], dtype=np.float64) * LED_STEP
+        return (currents, (shadow[SPO2_CONFIG] >> 5) & 0x03, shadow[SPO2_CONFIG] & 0x03)
+
+    def max_pulse_width(self):
+        """
+        Longest pulse width level the current sample rate allows
+        """
+        rate = SAMPLE_RATES[(self.sensor.shadow[SPO2_CONFIG] >> 2) & 0x07] * self.sensor.channels / 2
+        return max(level for level in range(4) if PULSE_WIDTH_MAX_RATE[level] >= rate or level == 0)
+
+    def adjust(self, metrics):
+        """
+        Works out new settings from the metrics of one window. Returns a dict for configure(), empty if the levels are
+        already right
+        """
+        currents, adc_range, pulse_width = self.state()
+        dc = np.maximum(metrics['dc'], 1e-3)
+        clipped = metrics['headroom'] < self.headroom
+        off_target = np.abs(dc / self.target - 1) > self.tolerance
+        if not (clipped | off_target).any():
+            return {}
+
+        # counts go up in proportion to led current; a clipped channel's true level is unknown, so halve it
+        wanted = np.where(clipped, currents / 2, currents * np.where(off_target, self.target / dc, 1))
+
+        if wanted.max() > LED_MAX:
+            # too dim even at full current: more counts per nA, or else more light per pulse
+            if adc_range > 0:
+                adc_range -= 1
+                wanted /= 2
+            elif pulse_width < self.max_pulse_width():
+                pulse_width += 1
+                wanted *= PULSE_WIDTH_SCALE[pulse_width - 1]
+        elif wanted.min() < self.min_current:
+            # too bright even at the lowest current: fewer counts per nA, or else less light per pulse
+            if adc_range < 3:
+                adc_range += 1
+                wanted *= 2
+            elif pulse_width > 0:
+                pulse_width -= 1
+                wanted /= PULSE_WIDTH_SCALE[pulse_width]
+
+        # whole register steps, as plain floats so the settings can go in a recording header
+        wanted = np.round(np.clip(wanted, self.min_current, LED_MAX) / LED_STEP) * LED_STEP
+        if (adc_range, pulse_width) == self.state()[1:] and np.all(np.round(wanted / LED_STEP) == np.round(currents / LED_STEP)):
+            # already as close as the settings allow
+            return {}
+        settings = {'adc_range' : adc_range, 'pulse_width' : pulse_width}
+        for name, current in zip(('red', 'ir', 'green'), wanted):
+            settings[name] = round(float(current), 1)
+        return settings
+
+    def apply(self, settings):
+        self.sensor.configure(**settings)
+        self.steps += 1
+        self.converged = False
+        self.quality = None
+        self.buffer = []
+        self.buffered = 0
+        self.skip_batch = True
+
+    def update(self, batch):
+        """
+        Feeds one (N, channels) batch as returned by read_batch. Adjusts the sensor once enough data has built up.
+        Returns True if the settings were changed
+        """
+        if self.skip_batch:
+            self.skip_batch = False
+            return False
+        if not len(batch):
+            return False
+        self.buffer.append(batch)
+        self.buffered += len(batch)
+
+        sample_rate = self.sensor.output_rate()
+        needed = (self.quality_window if self.converged else self.window) * sample_rate
+        if self.buffered < max(needed, 2):
+            return False
+        samples = np.concatenate(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+
+        metrics = signal_metrics(samples, sample_rate)
+        settings = self.adjust(metrics)
+        if settings:
+            self.apply(settings)
+            return True
+
+        if not self.converged:
+            # levels are right; the next window is a longer one for the perfusion/SNR check
+            self.converged = True
+            return False
+
+        self.quality = metrics
+        currents, adc_range, pulse_width = self.state()
+        if np.nanmin(metrics['snr']) < self.min_snr and pulse_width < self.max_pulse_width():
+            # longer pulses for a cleaner signal, with the currents scaled down to keep the same level
+            wanted = np.clip(currents * PULSE_WIDTH_SCALE[pulse_width], self.min_current, LED_MAX)
+            settings = {'pulse_width' : pulse_width + 1}
+            for name, current in zip(('red', 'ir', 'green'), wanted):
+                settings[name] = round(float(current), 1)
+            self.apply(settings)
+            return True
+        return False
+
+    def tune(self, timeout=10.0):
+        """
+        Reads from the sensor and adjusts until the levels are right and the quality check has passed (or can't get
+        better), or until timeout seconds. Returns a dict with the final settings, the last quality metrics, the
+        number of steps taken and the time it took
+        """
+        start = time.monotonic()
+        self.sensor.drain_fifo()
+        while time.monotonic() - start < timeout:
+            batch = self.sensor.read_batch()
+            changed = self.update(batch)
+            if changed:
+                # throw out what was measured under the old settings
+                self.sensor.drain_fifo()
+                self.skip_batch = False
+            elif self.quality is not None:
+                break
+
+        currents, adc_range, pulse_width = self.state()
+        settings = {'adc_range' : adc_range, 'pulse_width' : pulse_width}
+        for name, current in zip(('red', 'ir', 'green'), currents):
+            settings[name] = round(float(current), 1)
+        return {'settings' : settings, 'quality' : self.quality, 'steps' : self.steps, 'seconds' : time.monotonic() - start}
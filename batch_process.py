@@ -0,0 +1,271 @@
+### batch reprocessing of recorded data -- fans recordings (split into chunks if they're long) out across a process
+### pool and writes one results table. Only recordings whose contents or analysis parameters changed get rerun.
+### With --cache, intermediate results are kept on disk (see cache.py) so parameter sweeps only redo changed stages.
+#
+# eg. python batch_process.py processing/data --output results.csv --workers 4 --cache .pulseox_cache
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from scipy import signal
+from cache import ResultCache
+from heart_rate import StreamingHeartRate
+from MAX30101 import ADC_MASK
+from quality import window_quality, records_finger_out
+from recording import load_recording, csv_to_recording, estimate_sample_rate
+from spo2 import rms_ratio, linear_spo2, quadratic_spo2
+from ssa import extract_acdc_batch, bandpass_windows
+
+# bumped whenever the analysis itself changes, so results (and cached stages) from older code get recomputed even
+# when the recording and parameters are the same
+ANALYSIS_VERSION = 3
+
+FIELDNAMES = ['file', 'chunk_start', 'samples', 'duration', 'sample_rate', 'lin_spo2', 'quad_spo2', 'ref_spo2',
+              'heart_rate', 'peak_heart_rate', 'ref_bpm', 'red_perfusion', 'ir_perfusion', 'clipped', 'quality', 'usable']
+
+def file_hash(path):
+    """
+    sha256 of a file's contents
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def params_hash(params):
+    return hashlib.sha256(json.dumps([ANALYSIS_VERSION, params], sort_keys=True).encode()).hexdigest()
+
+def heart_rate(x, sample_rate, window=10, band=(.7, 4)):
+    """
+    Heart rate in bpm: median of StreamingHeartRate's estimates (strongest frequency in the pulse band of a Hann
+    windowed spectrum) over window second stretches, one per second. A single fft of the whole recording is dominated
+    by the slow drift of the dc level and lands on the bottom of the band
+    """
+    window = min(window, len(x) / sample_rate)
+    estimator = StreamingHeartRate(sample_rate, window, hop=1, band=band)
+    _, bpm, _ = estimator.process(x)
+    bpm = bpm[~np.isnan(bpm)]
+    if not len(bpm):
+        return np.nan
+    return np.median(bpm)
+
+def find_beats(x, sample_rate, bpm=None, prominence=0.5):
+    """
+    Indices of the systolic peaks of a bandpassed signal. As in the wrist_heartrate notebook, peaks have to be at least
+    0.9 of the expected beat period (60 / bpm, 240 bpm if it's not known) apart, and they have to stand out by
+    prominence times the signal's spread, so the dicrotic notch doesn't count as a second beat. The spread is the
+    median absolute deviation (scaled to match a standard deviation), since a few motion artifacts inflate np.std
+    enough to hide every real beat
+    """
+    period = 60 / bpm if bpm is not None and np.isfinite(bpm) else 0.25
+    spread = 1.4826 * np.median(np.abs(x - np.median(x)))
+    return signal.find_peaks(x, distance=max(1, 0.9 * period * sample_rate), prominence=prominence * spread)[0]
+
+def peak_heart_rate(peaks, sample_rate):
+    """
+    Heart rate in bpm from the median spacing of detected peaks
+    """
+    if len(peaks) < 2:
+        return np.nan
+    return 60 * sample_rate / np.median(np.diff(peaks))
+
+def signal_quality(red_ir):
+    """
+    Returns tuple (red perfusion index, ir perfusion index, fraction of samples at ADC full scale)
+    """
+    x = red_ir.astype(np.float64)
+    perfusion = np.std(x, axis=0) / np.mean(x, axis=0)
+    clipped = np.mean(red_ir == ADC_MASK)
+    return (perfusion[0], perfusion[1], clipped)
+
+def analyze_chunk(task):
+    """
+    Worker: runs the SpO2/heart rate/signal quality analysis on records [start, end) of one recording (read from
+    source, which is the recording itself or a .pox copy of a .csv one). Every stage goes through the result cache,
+    keyed on the recording's hash. Returns one results row (dict)
+    """
+    path, source, start, end, params, recording_hash, cache_settings = task
+    records = load_recording(source)[start:end]
+    if len(records) < 2:
+        # empty, or cut short before there's anything to analyze
+        return {'file' : path, 'chunk_start' : start, 'samples' : len(records)}
+    cache = ResultCache(*cache_settings)
+    times = np.asarray(records['time'])
+    red_ir = np.column_stack((records['red'], records['ir']))
+    x = red_ir.astype(np.float64)
+    sample_rate = params['sample_rate'] or estimate_sample_rate(times)
+
+    chunk_key = cache.key('chunk', [start, end, ANALYSIS_VERSION], recording_hash)
+    filter_params = {'sample_rate' : sample_rate, 'cutoff' : params['cutoff'], 'order' : params['order']}
+
+    row = {
+        'file' : path,
+        'chunk_start' : start,
+        'samples' : len(records),
+        'duration' : times[-1] - times[0],
+        'sample_rate' : sample_rate,
+        'heart_rate' : heart_rate(x, sample_rate),
+    }
+    row['red_perfusion'], row['ir_perfusion'], row['clipped'] = signal_quality(red_ir)
+
+    filtered_key, filtered = cache.cached('filtered_signal', filter_params, chunk_key,
+        lambda: {'ir' : bandpass_windows(x[:, 1], sample_rate, params['cutoff'], params['order'])})
+    # peak detection on the bandpassed ir channel, spaced by the spectral heart rate
+    peak_params = {'bpm' : row['heart_rate'], 'prominence' : 0.5}
+    _, peaks = cache.cached('peaks', peak_params, filtered_key,
+        lambda: {'index' : find_beats(filtered['ir'], sample_rate, **peak_params)})
+    row['peak_heart_rate'] = peak_heart_rate(peaks['index'], sample_rate)
+
+    if len(records) >= params['window_size']:
+        # score every window first, so SSA (by far the most expensive stage) only runs on the usable ones
+        def window_scores():
+            score, _ = window_quality(red_ir, params['window_size'], records_finger_out(records), sample_rate=sample_rate)
+            return {'score' : score}
+        quality_params = {'window_size' : params['window_size'], 'sample_rate' : sample_rate}
+        quality_key, quality = cache.cached('quality', quality_params, chunk_key, window_scores)
+        usable = np.flatnonzero(quality['score'] >= params['min_quality'])
+        row['quality'] = np.median(quality['score'])
+        row['usable'] = len(usable) / len(quality['score'])
+
+        if len(usable):
+            ssa_params = {'window_size' : params['window_size'], 'L' : params['L'], 'min_quality' : params['min_quality']}
+            # the windows SSA ran on come from the scores, so its results hang off them
+            ssa_key, components = cache.cached('ssa', ssa_params, quality_key,
+                lambda: dict(zip(('dc', 'ac'), extract_acdc_batch(x, params['window_size'], params['L'], windows=usable))))
+            bandpass_key, bandpassed = cache.cached('bandpass', filter_params, ssa_key,
+                lambda: {'ac' : bandpass_windows(components['ac'], sample_rate, params['cutoff'], params['order'])})
+
+            def spo2_series():
+                dc = components['dc']
+                ac = bandpassed['ac']
+                R = rms_ratio(ac[:, 0], dc[:, 0], ac[:, 1], dc[:, 1])
+                return {'lin' : linear_spo2(R), 'quad' : quadratic_spo2(R)}
+            _, spo2 = cache.cached('spo2', {}, bandpass_key, spo2_series)
+            row['lin_spo2'] = np.median(spo2['lin'])
+            row['quad_spo2'] = np.median(spo2['quad'])
+        else:
+            # nothing in the chunk is good enough to estimate SpO2 from
+            row['lin_spo2'] = np.nan
+            row['quad_spo2'] = np.nan
+
+    # reference values from the transmission pulseOx, when the recording has them
+    if 'spo2' in records.dtype.names:
+        row['ref_spo2'] = np.mean(records['spo2'])
+        row['ref_bpm'] = np.mean(records['bpm'])
+    return row
+
+def make_tasks(path, params, recording_hash, cache_settings, work_dir):
+    """
+    Splits one recording into chunks of params['chunk_size'] records. Chunks overlap by one window so that no
+    window is lost at a boundary. A .csv recording is converted to a .pox in work_dir once here, so the workers
+    memory map their chunks instead of each parsing the whole .csv again
+    """
+    source = path
+    if path.endswith('.csv'):
+        source = csv_to_recording(path, os.path.join(work_dir, recording_hash + '.pox'))
+    count = len(load_recording(source))
+    chunk_size = max(params['chunk_size'], params['window_size'])
+    overlap = params['window_size'] - 1
+    tasks = []
+    start = 0
+    while True:
+        end = min(start + chunk_size, count)
+        tasks.append((path, source, start, end, params, recording_hash, cache_settings))
+        if end == count:
+            return tasks
+        start = end - overlap
+
+def find_recordings(paths):
+    """
+    Expands directories and globs into a sorted list of .csv and .pox recordings
+    """
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            found += glob.glob(os.path.join(path, '*.csv')) + glob.glob(os.path.join(path, '*.pox'))
+        else:
+            found += glob.glob(path)
+    return sorted(set(found))
+
+def run(paths, output, params, workers=None, force=False, cache_dir=None, cache_bytes=1 << 30):
+    """
+    Analyzes every recording under paths and writes the results table to output. A manifest next to the output
+    (output + '.json') remembers each recording's content hash and the parameters it was run with; recordings that
+    match are not rerun and keep their old rows, unless force is set. cache_dir turns on the result cache.
+    Returns the number of recordings analyzed
+    """
+    manifest_path = output + '.json'
+    manifest = {}
+    old_rows = []
+    if not force and os.path.exists(manifest_path) and os.path.exists(output):
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        with open(output) as csvfile:
+            old_rows = list(csv.DictReader(csvfile))
+
+    recordings = find_recordings(paths)
+    key = params_hash(params)
+    stale = []
+    new_manifest = {}
+    for path in recordings:
+        entry = {'hash' : file_hash(path), 'params' : key}
+        new_manifest[path] = entry
+        if manifest.get(path) != entry:
+            stale.append(path)
+
+    cache_settings = (cache_dir, cache_bytes)
+    with tempfile.TemporaryDirectory(prefix='pulseox_') as work_dir:
+        tasks = [task for path in stale
+                 for task in make_tasks(path, params, new_manifest[path]['hash'], cache_settings, work_dir)]
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            new_rows = list(pool.map(analyze_chunk, tasks))
+
+    # keep rows for recordings that are unchanged and still present
+    rows = [row for row in old_rows if row['file'] in new_manifest and row['file'] not in stale] + new_rows
+    rows.sort(key=lambda row: (row['file'], int(row['chunk_start'])))
+
+    with open(output, 'w') as csvfile:
+        writer = csv.DictWriter(csvfile, FIELDNAMES)
+        writer.writeheader()
+        writer.writerows(rows)
+    with open(manifest_path, 'w') as f:
+        json.dump(new_manifest, f, indent=1)
+    return len(stale)
+
+def main():
+    parser = argparse.ArgumentParser(description='Batch SpO2/heart rate/signal quality analysis of recordings')
+    parser.add_argument('paths', nargs='+', help='recordings, globs or directories of .csv/.pox files')
+    parser.add_argument('--output', default='results.csv', help='results table (.csv)')
+    parser.add_argument('--workers', type=int, default=None, help='worker processes (default: one per cpu)')
+    parser.add_argument('--window-size', type=int, default=100, help='samples per SpO2 window')
+    parser.add_argument('--L', type=int, default=None, help='SSA window (default: half of window size)')
+    parser.add_argument('--sample-rate', type=float, default=None, help='effective sample rate in Hz (default: from the time column)')
+    parser.add_argument('--cutoff', type=float, nargs=2, default=[.7, 4], help='bandpass cutoffs in Hz')
+    parser.add_argument('--order', type=int, default=4, help='bandpass order')
+    parser.add_argument('--min-quality', type=float, default=0.5, help='signal quality a window needs for SpO2 (0: use every window)')
+    parser.add_argument('--chunk-size', type=int, default=20000, help='records per task for long recordings')
+    parser.add_argument('--force', action='store_true', help='rerun everything, even unchanged recordings')
+    parser.add_argument('--cache', default=None, help='directory for cached intermediate results (default: no cache)')
+    parser.add_argument('--cache-size', type=float, default=1024, help='cache size limit in MB')
+    args = parser.parse_args()
+
+    params = {
+        'window_size' : args.window_size,
+        'L' : args.L or args.window_size // 2,
+        'sample_rate' : args.sample_rate,
+        'cutoff' : args.cutoff,
+        'order' : args.order,
+        'min_quality' : args.min_quality,
+        'chunk_size' : args.chunk_size,
+    }
+    count = run(args.paths, args.output, params, args.workers, args.force, args.cache, int(args.cache_size * (1 << 20)))
+    print(f'analyzed {count} recordings, results in {args.output}')
+
+if __name__ == '__main__':
+    main()
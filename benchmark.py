@@ -0,0 +1,364 @@
+### acquisition benchmarks -- how fast the read paths and writers actually go, as machine readable results
+#
+# Runs read_spo2_data/read_multi_data over a grid of sample rates, averaging levels and modes, CMS50D.get_data, and
+# the csv and .pox writers. Each result is one json line with samples/sec, per-call latency percentiles, cpu time,
+# i2c transactions and drop counts, so runs can be kept and compared to catch regressions.
+#
+# By default the sensors are emulated (see emulator.py), with --i2c-speed to include the bus's bandwidth limit; pass
+# --hardware to benchmark the real devices.
+#
+# eg. python benchmark.py --output bench.jsonl --sample-rates 0 1 4 7 --averages 0 2
+import argparse
+import csv
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+import numpy as np
+from MAX30101 import MAX30101, SAMPLE_RATES, SAMPLE_AVERAGES
+from CMS50D import CMS50D
+from recording import RecordingWriter, SPO2_FIELDS, CSV_NAMES
+from heart_rate import StreamingHeartRate
+from emulator import synthetic_ppg
+
+class TimedBus():
+    """
+    Wraps an smbus-like object, counting transactions and bytes and the wall time spent in them
+    """
+    def __init__(self, bus):
+        self.bus = bus
+        self.transactions = 0
+        self.bytes = 0
+        self.time = 0.0
+
+    def call(self, method, size, *args):
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self.time += time.perf_counter() - start
+            self.transactions += 1
+            self.bytes += size
+
+    def read_byte_data(self, addr, register):
+        return self.call(self.bus.read_byte_data, 1, addr, register)
+
+    def write_byte_data(self, addr, register, value):
+        return self.call(self.bus.write_byte_data, 1, addr, register, value)
+
+    def read_i2c_block_data(self, addr, register, length=32):
+        return self.call(self.bus.read_i2c_block_data, length, addr, register, length)
+
+    def write_i2c_block_data(self, addr, register, values):
+        return self.call(self.bus.write_i2c_block_data, len(values), addr, register, values)
+
+    def reset_counts(self):
+        self.transactions = 0
+        self.bytes = 0
+        self.time = 0.0
+
+def latency_stats(latencies):
+    """
+    Percentiles of a list of per-call latencies (seconds), in microseconds
+    """
+    if not latencies:
+        return {}
+    us = np.asarray(latencies) * 1e6
+    p50, p90, p99 = np.percentile(us, [50, 90, 99])
+    return {'latency_p50_us' : p50, 'latency_p90_us' : p90, 'latency_p99_us' : p99, 'latency_max_us' : us.max()}
+
+def timed_loop(read, duration):
+    """
+    Calls read() for duration seconds. Returns tuple (calls, wall seconds, cpu seconds, per-call latencies)
+    """
+    latencies = []
+    cpu_start = time.process_time()
+    start = end = time.perf_counter()
+    while end - start < duration:
+        read()
+        now = time.perf_counter()
+        latencies.append(now - end)
+        end = now
+    return (len(latencies), end - start, time.process_time() - cpu_start, latencies)
+
+def bench_max30101(mode, sample_rate, sample_avg, duration, hardware=False, interrupt_pin=None, i2c_speed=None):
+    """
+    Reads the reflection pulseOx one sample at a time (read_spo2_data or read_multi_data) for duration seconds
+    """
+    if hardware:
+        from smbus import SMBus
+        from MAX30101 import BUS, GPIOInterrupt
+        bus = TimedBus(SMBus(BUS))
+        interrupt = GPIOInterrupt(interrupt_pin) if interrupt_pin is not None else None
+    else:
+        from emulator import EmulatedMAX30101Bus, EmulatedInterrupt
+        emulated = EmulatedMAX30101Bus(bus_speed=i2c_speed)
+        bus = TimedBus(emulated)
+        interrupt = EmulatedInterrupt(emulated) if interrupt_pin is not None else None
+
+    sensor = MAX30101(mode=mode, sample_rate=sample_rate, sample_avg=sample_avg, interrupt=interrupt, bus=bus)
+    read = sensor.read_spo2_data if sensor.channels == 2 else sensor.read_multi_data
+    # start from an empty FIFO
+    sensor.drain_fifo()
+    sensor.overflow_count = 0
+    bus.reset_counts()
+
+    calls, wall, cpu, latencies = timed_loop(read, duration)
+    expected = sensor.output_rate()
+    result = {
+        'benchmark' : 'max30101',
+        'mode' : mode,
+        'sample_rate' : SAMPLE_RATES[sample_rate],
+        'sample_avg' : SAMPLE_AVERAGES[sample_avg],
+        'interrupt' : interrupt is not None,
+        'expected_samples_per_sec' : expected,
+        'samples' : calls,
+        'samples_per_sec' : calls / wall,
+        'wall_time' : wall,
+        'cpu_time' : cpu,
+        'cpu_fraction' : cpu / wall,
+        'i2c_transactions' : bus.transactions,
+        'i2c_transactions_per_sample' : bus.transactions / max(calls, 1),
+        'i2c_bytes' : bus.bytes,
+        'i2c_time' : bus.time,
+        'overflows' : sensor.overflow_count,
+        'drop_fraction' : sensor.overflow_count / max(calls + sensor.overflow_count, 1),
+    }
+    result.update(latency_stats(latencies))
+    if interrupt is not None:
+        interrupt.close()
+    return result
+
+def bench_cms50d(duration, hardware=False, portstr='/dev/ttyUSB0'):
+    """
+    Reads the transmission pulseOx one packet at a time (get_data) for duration seconds
+    """
+    if hardware:
+        pulseOx = CMS50D(portstr)
+    else:
+        from emulator import EmulatedCMS50DPort
+        pulseOx = CMS50D(port=EmulatedCMS50DPort())
+
+    packets = 0
+    def read():
+        nonlocal packets
+        if pulseOx.get_data() is not None:
+            packets += 1
+
+    calls, wall, cpu, latencies = timed_loop(read, duration)
+    result = {
+        'benchmark' : 'cms50d',
+        'expected_samples_per_sec' : 60,
+        'samples' : packets,
+        'calls' : calls,
+        'samples_per_sec' : packets / wall,
+        'wall_time' : wall,
+        'cpu_time' : cpu,
+        'cpu_fraction' : cpu / wall,
+        'framing_errors' : pulseOx.parser.framing_errors,
+        'handshakes' : pulseOx.handshakes,
+    }
+    result.update(latency_stats(latencies))
+    pulseOx.close()
+    return result
+
+def bench_writer(kind, rows):
+    """
+    Writes rows SpO2 records one at a time, either as csv (the csv.DictWriter path collect_data used to take) or
+    through RecordingWriter
+    """
+    names = [name for name, _ in SPO2_FIELDS]
+    row = (1.0, 72, 97, 64, 123456, 234567)
+    latencies = []
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'bench.' + kind)
+        cpu_start = time.process_time()
+        start = end = time.perf_counter()
+        if kind == 'csv':
+            with open(path, 'w') as csvfile:
+                writer = csv.DictWriter(csvfile, [CSV_NAMES[name] for name in names])
+                writer.writeheader()
+                for i in range(rows):
+                    writer.writerow({CSV_NAMES[name] : value for name, value in zip(names, row)})
+                    now = time.perf_counter()
+                    latencies.append(now - end)
+                    end = now
+        else:
+            with RecordingWriter(path, SPO2_FIELDS) as writer:
+                for i in range(rows):
+                    writer.append(row)
+                    now = time.perf_counter()
+                    latencies.append(now - end)
+                    end = now
+        # include the final flush and close
+        end = time.perf_counter()
+        wall = end - start
+        cpu = time.process_time() - cpu_start
+        size = os.path.getsize(path)
+
+    result = {
+        'benchmark' : 'writer',
+        'format' : kind,
+        'samples' : rows,
+        'samples_per_sec' : rows / wall,
+        'wall_time' : wall,
+        'cpu_time' : cpu,
+        'bytes' : size,
+        'bytes_per_sample' : size / rows,
+    }
+    result.update(latency_stats(latencies))
+    return result
+
+def bench_heart_rate(sample_rate, seconds=60, batch=24):
+    """
+    Runs StreamingHeartRate over seconds of synthetic 3 channel data at sample_rate, batch samples at a time (a FIFO
+    almost full read). Reports the processing cost per sample and the fraction of one cpu it would take in real time
+    """
+    x = synthetic_ppg(np.arange(0, seconds, 1 / sample_rate), seed=0) * 1e5
+    estimator = StreamingHeartRate(sample_rate)
+    latencies = []
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    for i in range(0, len(x), batch):
+        call_start = time.perf_counter()
+        estimator.process(x[i:i + batch])
+        latencies.append(time.perf_counter() - call_start)
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+
+    result = {
+        'benchmark' : 'heart_rate',
+        'sample_rate' : sample_rate,
+        'samples' : len(x),
+        'samples_per_sec' : len(x) / wall,
+        'wall_time' : wall,
+        'cpu_time' : cpu,
+        'us_per_sample' : cpu / len(x) * 1e6,
+        'realtime_cpu_fraction' : cpu / seconds,
+    }
+    result.update(latency_stats(latencies))
+    return result
+
+# modules that headless logging has to import without pulling in a gui or the analysis stack
+HEADLESS_MODULES = ['MAX30101', 'CMS50D', 'acquisition', 'recording', 'collect_data', 'reset_MAX30101']
+GUI_MODULES = ['PyQt5', 'PyQt6', 'PySide2', 'PySide6', 'pyqtgraph', 'matplotlib', 'scipy', 'pandas']
+
+# run in a fresh interpreter, so nothing is already imported
+IMPORT_PROBE = """
+import json, resource, sys, time
+before = set(sys.modules)
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+loaded = sorted(set(name.split('.')[0] for name in sys.modules if name not in before))
+try:
+    # peak of this process image; ru_maxrss would include whatever ran before the exec (ie. the benchmark)
+    with open('/proc/self/status') as f:
+        max_rss_kb = int([line for line in f if line.startswith('VmHWM')][0].split()[1])
+except OSError:
+    max_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(json.dumps({{'seconds' : seconds, 'max_rss_kb' : max_rss_kb, 'loaded' : loaded}}))
+"""
+
+def bench_import(module, repeats=3):
+    """
+    Imports module in a fresh interpreter (best of repeats). Reports the import time, peak memory of the process
+    minus that of a bare interpreter, and which gui/analysis packages came in with it
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    def probe(name):
+        code = IMPORT_PROBE.format(module=name)
+        runs = [json.loads(subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, cwd=here,
+                                          check=True).stdout) for _ in range(repeats)]
+        return min(runs, key=lambda run: run['seconds'])
+
+    baseline = probe('os')
+    run = probe(module)
+    return {
+        'benchmark' : 'import',
+        'module' : module,
+        'import_ms' : run['seconds'] * 1e3,
+        'rss_mb' : (run['max_rss_kb'] - baseline['max_rss_kb']) / 1024,
+        'gui_modules' : [name for name in run['loaded'] if name in GUI_MODULES],
+        'loaded' : run['loaded'],
+    }
+
+def run_info(hardware):
+    """
+    Describes the machine and code version, stored with every result so runs can be compared later
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    return {
+        'date' : datetime.now().isoformat(),
+        'commit' : commit,
+        'host' : platform.node(),
+        'machine' : platform.machine(),
+        'python' : platform.python_version(),
+        'backend' : 'hardware' if hardware else 'emulated',
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the pulseOx read paths and writers')
+    parser.add_argument('--output', default=None, help='append json lines here (default: print them)')
+    parser.add_argument('--duration', type=float, default=2.0, help='seconds per read benchmark')
+    parser.add_argument('--modes', nargs='+', default=['spo2', 'multi'], help='MAX30101 modes')
+    parser.add_argument('--sample-rates', type=int, nargs='+', default=list(range(8)), help='set_sample_rate levels (0-7)')
+    parser.add_argument('--averages', type=int, nargs='+', default=[0, 2], help='set_sample_avg levels (0-5)')
+    parser.add_argument('--interrupt', type=int, default=None, metavar='PIN', help='wait on the INT pin (BCM number; any value when emulated)')
+    parser.add_argument('--i2c-speed', type=int, default=None, help='emulated i2c clock in Hz (default: instant transfers)')
+    parser.add_argument('--writer-rows', type=int, default=100000, help='records per writer benchmark')
+    parser.add_argument('--skip', nargs='+', default=[], choices=['max30101', 'cms50d', 'writer', 'heart_rate', 'imports'], help='benchmarks to leave out')
+    parser.add_argument('--hardware', action='store_true', help='use the real devices instead of the emulator')
+    parser.add_argument('--port', default='/dev/ttyUSB0', help='CMS50D serial port (with --hardware)')
+    args = parser.parse_args()
+
+    results = []
+    if 'imports' not in args.skip:
+        for module in HEADLESS_MODULES:
+            results.append(bench_import(module))
+    if 'max30101' not in args.skip:
+        for mode in args.modes:
+            for sample_rate in args.sample_rates:
+                for sample_avg in args.averages:
+                    results.append(bench_max30101(mode, sample_rate, sample_avg, args.duration, args.hardware,
+                                                  args.interrupt, args.i2c_speed))
+    if 'cms50d' not in args.skip:
+        results.append(bench_cms50d(args.duration, args.hardware, args.port))
+    if 'heart_rate' not in args.skip:
+        for sample_rate in sorted(set(SAMPLE_RATES[level] / SAMPLE_AVERAGES[average] for level in args.sample_rates for average in args.averages)):
+            results.append(bench_heart_rate(sample_rate))
+    if 'writer' not in args.skip:
+        for kind in ('csv', 'pox'):
+            results.append(bench_writer(kind, args.writer_rows))
+
+    info = run_info(args.hardware)
+    lines = [json.dumps(dict(info, **result)) for result in results]
+    if args.output:
+        with open(args.output, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+        for result in results:
+            name = ' '.join(str(result[key]) for key in ('benchmark', 'module', 'mode', 'sample_rate', 'sample_avg', 'format') if key in result)
+            if result['benchmark'] == 'import':
+                print(f"{name:<28} {result['import_ms']:>10.1f} ms  {result['rss_mb']:>6.1f} MB  {' '.join(result['gui_modules'])}")
+            else:
+                print(f"{name:<28} {result['samples_per_sec']:>10.1f} samples/s  p99 {result.get('latency_p99_us', 0):>8.1f} us")
+    else:
+        print('\n'.join(lines))
+
+    # a headless module that drags in a gui is a regression
+    leaks = [result['module'] for result in results if result['benchmark'] == 'import' and result['gui_modules']]
+    if leaks:
+        print('gui/analysis modules imported by: ' + ', '.join(leaks), file=sys.stderr)
+        return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,115 @@
+### on-disk, content addressed cache for analysis results
+#
+# every stage's result is stored under a key made from the stage name, its parameters and the key of whatever it was
+# computed from (ultimately the recording's content hash). Changing a late stage's parameters (eg. the bandpass
+# cutoff) therefore reuses every earlier stage, and the least recently used results are evicted once the cache grows
+# past its size limit. Writes are atomic, so worker processes can share one cache directory.
+import hashlib
+import json
+import os
+import numpy as np
+
+class ResultCache():
+    """
+    eg.
+    cache = ResultCache('.pulseox_cache')
+    ssa_key, ssa = cache.cached('ssa', {'window_size' : 100}, recording_hash, lambda: {'dc' : dc, 'ac' : ac})
+    filter_key, filtered = cache.cached('bandpass', {'cutoff' : [.7, 4]}, ssa_key, lambda: ...)
+
+    A cache with directory=None stores nothing, so callers don't need a separate uncached code path
+    """
+    def __init__(self, directory='.pulseox_cache', max_bytes=1 << 30):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, stage, params, upstream):
+        """
+        Key of a stage's result: hash of the stage name, its parameters and the upstream key
+        """
+        text = json.dumps([stage, params, upstream], sort_keys=True, default=str)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def get(self, key):
+        """
+        Returns the stored dict of arrays, or None if it isn't cached
+        """
+        if self.directory is None:
+            return None
+        path = self.path(key)
+        try:
+            with np.load(path) as data:
+                result = dict(data)
+        except (OSError, ValueError):
+            return None
+        # bump the modification time, which is what eviction goes by
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return result
+
+    def put(self, key, result):
+        """
+        Stores a dict of arrays under key
+        """
+        if self.directory is None:
+            return
+        # write to a temporary name and rename, so readers never see a half written file
+        temp = os.path.join(self.directory, f'{key}.{os.getpid()}.tmp.npz')
+        np.savez(temp, **result)
+        os.replace(temp, self.path(key))
+        self.evict()
+
+    def cached(self, stage, params, upstream, compute):
+        """
+        Returns tuple (key, result) for a stage, calling compute() (which returns a dict of arrays) only on a miss
+        """
+        key = self.key(stage, params, upstream)
+        result = self.get(key)
+        if result is not None:
+            self.hits += 1
+            return (key, result)
+        self.misses += 1
+        result = compute()
+        self.put(key, result)
+        return (key, result)
+
+    def size(self):
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.name.endswith('.npz'))
+
+    def evict(self):
+        """
+        Deletes least recently used results until the cache fits in max_bytes
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npz') and '.tmp.' not in entry.name:
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        entries.sort()
+        for _, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                # another process got to it first
+                pass
+            total -= size
+
+    def clear(self):
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith('.npz'):
+                os.remove(entry.path)
@@ -1,68 +1,77 @@
-from MAX30101 import *
-from CMS50D import *
-import csv
+from MAX30101 import MAX30101
+from CMS50D import CMS50D, CMS50DSession
+from acquisition import Acquisition, CMS50DSource, MAX30101Source
+from align import StreamAligner
+from recording import RecordingWriter, SPO2_FIELDS, MULTI_FIELDS
 import time
+import numpy as np
 from datetime import datetime
 
 def real_time_plot():    
     """
     Gives real-time plot of data from transmission and reflection pulseOx on the same graph
     """
-    # plot waveform - adapted from stackoverflow.com/questions/45046239/python-realtime-plot-using-pyqtgraph
-    app = QtGui.QApplication([])
+    # the plotting (and Qt) is only loaded here, so the recording functions run headless
+    from live_plot import LivePlot
 
-    win = pg.GraphicsWindow(title='PulseOx Data')
-    win.resize(1000,600)
-    win.setWindowTitle('Waveform Data')
+    # initialize data collection; each pulseOx gets its own acquisition thread and the plot redraws on a timer
+    acq = Acquisition()
+    transRing = acq.add('trans', CMS50DSource(CMS50D('/dev/ttyUSB0')))
+    refRing = acq.add('reflect', MAX30101Source(MAX30101()))
 
-    p1 = win.addPlot(title='Waveform Data')
-    transCurve = p1.plot()
-    refRedCurve = p1.plot()
-    refIrCurve = p1.plot()
-    # p1.setRange(yRange=(0,100))
-    windowWidth = 500
-    transData = np.linspace(0,0,windowWidth)
-    refRedData = np.linspace(0,0,windowWidth)
-    refIrData = np.linspace(0,0,windowWidth)
+    plot = LivePlot(window_width=500)
+    plot.add_curve(transRing, 2)
+    # data from reflection PulseOx needs to be noramlized since it is so much larger than transmission data
+    # 20600 is just filler value, change as needed
+    plot.add_curve(refRing, 0, offset=20600, pen='r')
+    plot.add_curve(refRing, 1, offset=20600, pen='m')
 
-    ptr = windowWidth - 1 # pointer to where data is added to our plot
-    
-    # enable antialiasing
-    pg.setConfigOptions(antialias=True)
+    acq.start()
+    plot.run()
+    acq.stop()
 
-    # initialize data collection
-    refPulseOx = MAX30101()
-    transPulseOx = CMS50D('/dev/ttyUSB0')
-
-    # realtime data plotting
-    while True:
-        # update data
-        transData[ptr] = transPulseOx.get_waveform_data()
-
-        # data from reflection PulseOx needs to be noramlized since it is so much larger than transmission data
-        refRedDataPoint = 0
-        refIrDataPoint = 0
-        refDataPoint = refPulseOx.read_data()
-        # 20600 is just filler value, change as needed
-        refRedData[ptr] = max(0, refDataPoint[0] - 20600)
-        refIrData[ptr] = max(0, refDataPoint[1] - 20600)
-        # shift data windows one to the left
-        transData[:-1] = transData[1:]
-        refRedData[:-1] = refRedData[1:]
-        refIrData[:-1] = refIrData[1:]
-        
-        # update plot
-        transCurve.setData(transData)
-        refRedCurve.setData(refRedData)
-        refIrCurve.setData(refIrData)
-        QtGui.QApplication.processEvents()
+def paired_rows(transPulseOx, refPulseOx, size):
+    """
+    Reads both pulseOx's in their own acquisition threads, so neither one (nor the file writer) can stall the other.
+    Yields size rows of (time, transmission data, reflection data): one per reflection sample, with the transmission
+    data resampled to that sample's time (see align.py). bpm and spo2 hold their last value, the waveform is
+    interpolated
+    """
+    acq = Acquisition()
+    acq.add('trans', CMS50DSource(transPulseOx))
+    acq.add('reflect', MAX30101Source(refPulseOx))
+    trans = acq.reader('trans')
+    reflect = acq.reader('reflect')
+    aligner = StreamAligner(reference='reflect')
+    aligner.add_stream('reflect')
+    aligner.add_stream('trans', method=['previous', 'previous', 'linear'])
+    # keeps the transmission pulseOx sending for long recordings
+    session = CMS50DSession(transPulseOx)
+    session.start()
+    acq.start()
 
-    # close Qt
-    pg.QtGui.QApplication.exec_()
+    count = 0
+    try:
+        while count < size:
+            aligner.push('trans', *trans.read())
+            aligner.push('reflect', *reflect.read())
+            times, rows = aligner.pull()
+            if not len(times):
+                time.sleep(0.005)
+                continue
+            # the transmission pulseOx only sends whole numbers
+            transRows = np.rint(rows['trans']).astype(int)
+            for t, transData, refData in zip(times[:size - count], transRows, rows['reflect']):
+                yield (t - acq.start_time, transData, refData)
+            count += len(times)
+    finally:
+        acq.stop()
+        session.stop()
 
 def collect_spo2_data(size):
     """
-    Collects data from both pulseOx's while the reflection pulseOx is in SpO2 mode, and saves the data to a .csv file
+    Collects data from both pulseOx's while the reflection pulseOx is in SpO2 mode, and saves the data to a binary
+    recording (see recording.py; recording_to_csv converts it to .csv)
 
     Inputs:
     size -- the number of data points we want to collect
@@ -71,26 +80,16 @@ def collect_spo2_data(size):
     # 5 second delay is so that user has time to set up
     time.sleep(5)
 
-    with open(f'data_{datetime.now()}.csv', 'w') as csvfile:
-        fieldnames = ['time', 'bpm', 'spo2','Trans: Wave', 'Reflect: Red', 'Reflect: IR']
-        writer = csv.DictWriter(csvfile, fieldnames)
-        
-        writer.writeheader()    
-        refPulseOx = MAX30101(mode='spo2',led=18 , adc_range=2 , sample_rate=1, pulse_width=3, sample_avg=2)
-        start_time=time.time()
-        
-        # if we collect data for any longer than around 1700 times, the transmission pulseOx stops feeding data -- not sure why. The handshake may need to be sent periodically, easy fix
-        for i in range(size):
-            transData = transPulseOx.get_data()
-            refData = refPulseOx.read_spo2_data()
-            
-            writer.writerow({fieldnames[0] : time.time() - start_time, fieldnames[1] : transData[0], fieldnames[2] : transData[1], fieldnames[3] : transData[2], fieldnames[4] : refData[0], fieldnames[5] : refData[1]})
-        csvfile.close()
+    refPulseOx = MAX30101(mode='spo2',led=18 , adc_range=2 , sample_rate=1, pulse_width=3, sample_avg=2)
+    with RecordingWriter(f'data_{datetime.now()}.pox', SPO2_FIELDS, refPulseOx.settings) as writer:
+        for t, transData, refData in paired_rows(transPulseOx, refPulseOx, size):
+            writer.append((t, transData[0], transData[1], transData[2], refData[0], refData[1]))
     refPulseOx.reset()
 
 def collect_multi_data(size):
     """
-    Collects data from both pulseOx's while the reflection pulseOx is in multi mode, and saves the data to a .csv file
+    Collects data from both pulseOx's while the reflection pulseOx is in multi mode, and saves the data to a binary
+    recording (see recording.py; recording_to_csv converts it to .csv)
 
     Inputs:
     size -- the number of data points we want to collect
@@ -99,20 +98,10 @@ def collect_multi_data(size):
     # 5 second delay is so that user has time to set up
     time.sleep(5)
 
-    with open(f'data_{datetime.now()}.csv', 'w') as csvfile:
-        fieldnames = ['time', 'bpm', 'spo2','Trans: Wave', 'Reflect: Red', 'Reflect: IR', 'Reflect: Green']
-        writer = csv.DictWriter(csvfile, fieldnames)
-        
-        writer.writeheader()    
-        refPulseOx = MAX30101('multi')
-        start_time=time.time()
-        
-        for i in range(size):
-            transData = transPulseOx.get_data()
-            refData = refPulseOx.read_multi_data()
-            
-            writer.writerow({fieldnames[0] : time.time() - start_time, fieldnames[1] : transData[0], fieldnames[2] : transData[1], fieldnames[3] : transData[2], fieldnames[4] : refData[0], fieldnames[5] : refData[1], fieldnames[6]: refData[2]})
-        csvfile.close()
+    refPulseOx = MAX30101('multi')
+    with RecordingWriter(f'data_{datetime.now()}.pox', MULTI_FIELDS, refPulseOx.settings) as writer:
+        for t, transData, refData in paired_rows(transPulseOx, refPulseOx, size):
+            writer.append((t, transData[0], transData[1], transData[2], refData[0], refData[1], refData[2]))
     refPulseOx.reset()
             
 ### EXAMPLE USE
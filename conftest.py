@@ -0,0 +1 @@
+# pytest puts this directory on sys.path (for the conftest), so the tests can import the modules here directly
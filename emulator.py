@@ -0,0 +1,476 @@
+### hardware-free stand-ins for the MAX30101 (smbus) and CMS50D (serial port), for benchmarking and testing on any
+### linux box
+#
+# eg.
+# bus = EmulatedMAX30101Bus()
+# refPulseOx = MAX30101(bus=bus, interrupt=EmulatedInterrupt(bus))
+# transPulseOx = CMS50D(port=EmulatedCMS50DPort())
+#
+# several sensors at the same address behind a multiplexer (see sensor_array.py):
+# mux = EmulatedI2CMux({0 : EmulatedMAX30101Bus(), 1 : EmulatedMAX30101Bus()})
+#
+# Both take a clock (default time.monotonic). Pass a ManualClock to step simulated time by hand, eg. for repeatable
+# benchmarks that don't depend on how busy the machine is.
+import time
+import numpy as np
+# the register map and lookup tables come from the driver, so the two can't drift apart
+from MAX30101 import (PULSEOX_ADDR, INT_STAT_1, INT_STAT_2, INT_ENABLE_1, INT_ENABLE_2, FIFO_WR_PTR, FIFO_OVF,
+                      FIFO_RD_PTR, FIFO_DATA, FIFO_CONFIG, MODE_CONFIG, SPO2_CONFIG, LED1_PA, LED2_PA, LED3_PA, REV_ID,
+                      PART_ID, INT_A_FULL, INT_PPG_RDY, INT_PWR_RDY, FIFO_DEPTH, ADC_MASK, SAMPLE_RATES,
+                      SAMPLE_AVERAGES, ADC_RANGES, ADC_BITS, PULSE_WIDTHS)
+
+class ManualClock():
+    """
+    Clock that only moves when told to. Call it for the current time, like time.monotonic
+    """
+    def __init__(self, start=0.0):
+        self.now = start
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+def synthetic_ppg(t, heart_rate=72, spo2=97, perfusion=0.02, noise=0.002, seed=None):
+    """
+    Synthetic PPG over times t (seconds). Returns an (N, 3) array of relative red, ir, green light levels around 1.0.
+    The red/ir ac amplitudes are picked so the linear R ratio calibration gives back spo2
+    """
+    t = np.asarray(t, dtype=np.float64)
+    phase = 2 * np.pi * heart_rate / 60 * t
+    # systolic upstroke plus a smaller dicrotic wave
+    pulse = np.sin(phase) + 0.35 * np.sin(2 * phase + 0.8) + 0.1 * np.sin(3 * phase + 1.6)
+    # slow breathing drift in the baseline
+    baseline = 1 + 0.003 * np.sin(2 * np.pi * 0.25 * t)
+
+    R = (104 - spo2) / 17
+    amplitude = np.array([perfusion * R, perfusion, 1.5 * perfusion])
+    rng = np.random.default_rng(seed)
+    return baseline[:, None] * (1 + pulse[:, None] * amplitude) + rng.normal(0, noise, (len(t), 3))
+
+class EmulatedMAX30101Bus():
+    """
+    Register level MAX30101 emulator with the smbus interface (read_byte_data, write_byte_data, read_i2c_block_data,
+    write_i2c_block_data). It has a real 32 sample FIFO with read/write pointers, overflow counter and rollover, and
+    produces samples at the rate set in SPO2_CONFIG/FIFO_CONFIG as the clock advances.
+
+    Samples come from a simple optical model of synthetic_ppg (so led current, adc range and pulse width all change
+    the readings, up to saturation), or are replayed from a recording with replay=records.
+
+    transactions, bytes_read and bytes_written count bus traffic.
+    """
+    def __init__(self, clock=time.monotonic, clock_error=0.0, replay=None, heart_rate=72, spo2=97, perfusion=0.02,
+                 photocurrent=(40, 50, 20), bus_speed=None, seed=0):
+        """
+        bus_speed: i2c clock in Hz (eg. 100000, the RPi default). When set, every transfer takes as long as it would on
+        the wire, so benchmarks see the bus bandwidth limit; otherwise transfers are instant
+        clock_error: fractional error of the chip's sample clock, eg. 0.01 runs it 1% fast
+        replay: structured array of records (see recording.load_recording) to play back instead of synthetic data
+        photocurrent: dc photodiode current in nA per mA of led current (at the longest pulse width), for red, ir, green
+        """
+        self.clock = clock
+        self.clock_error = clock_error
+        self.replay = replay
+        self.heart_rate = heart_rate
+        self.spo2 = spo2
+        self.perfusion = perfusion
+        self.photocurrent = np.array(photocurrent, dtype=np.float64)
+        self.rng = np.random.default_rng(seed)
+        self.bus_speed = bus_speed
+
+        self.transactions = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.reset()
+
+    def reset(self):
+        """
+        Power on reset: all registers back to their defaults and the FIFO emptied
+        """
+        self.registers = bytearray(256)
+        self.registers[INT_STAT_1] = INT_PWR_RDY
+        self.registers[REV_ID] = 0x03
+        self.registers[PART_ID] = 0x15
+        self.fifo = []
+        # next byte of the oldest sample to hand out, FIFO_DATA reads can stop mid-sample
+        self.byte_pos = 0
+        self.produced = 0
+        self.epoch = self.clock()
+
+    def mode_channels(self):
+        mode = self.registers[MODE_CONFIG] & 0x07
+        if mode == 0x02:
+            return 1
+        if mode == 0x03:
+            return 2
+        if mode == 0x07:
+            slots = [self.registers[0x11] & 0x07, (self.registers[0x11] >> 4) & 0x07,
+                     self.registers[0x12] & 0x07, (self.registers[0x12] >> 4) & 0x07]
+            return max(1, sum(1 for slot in slots if slot))
+        return 0
+
+    def effective_rate(self):
+        """
+        Samples per second going into the FIFO (sample rate / samples averaged), including the clock error
+        """
+        rate = SAMPLE_RATES[(self.registers[SPO2_CONFIG] >> 2) & 0x07]
+        average = SAMPLE_AVERAGES[(self.registers[FIFO_CONFIG] >> 5) & 0x07]
+        return rate / average * (1 + self.clock_error)
+
+    def time_until(self, count):
+        """
+        Seconds of clock time until count more samples have been produced
+        """
+        rate = self.effective_rate()
+        due = (self.produced + count) / rate
+        return max(0.0, self.epoch + due - self.clock())
+
+    def sample_values(self, first, n, channels):
+        """
+        ADC codes of samples first .. first + n - 1, an (n, channels) array
+        """
+        if self.replay is not None:
+            columns = [self.replay[name] for name in ('red', 'ir', 'green') if name in self.replay.dtype.names]
+            index = np.arange(first, first + n) % len(self.replay)
+            values = np.column_stack([column[index] for column in columns]).astype(np.int64)
+            values = np.pad(values, ((0, 0), (0, max(0, channels - values.shape[1]))))
+            return values[:, :channels] & ADC_MASK
+
+        t = np.arange(first, first + n) / self.effective_rate()
+        light = synthetic_ppg(t, self.heart_rate, self.spo2, self.perfusion, seed=self.rng.integers(1 << 32))
+        currents = np.array([self.registers[LED1_PA], self.registers[LED2_PA], self.registers[LED3_PA]]) * 0.2
+        full_scale = ADC_RANGES[(self.registers[SPO2_CONFIG] >> 5) & 0x03]
+        bits = ADC_BITS[self.registers[SPO2_CONFIG] & 0x03]
+
+        # the photodiode charge is integrated over the led pulse, so longer pulses read higher
+        pulse_width = PULSE_WIDTHS[self.registers[SPO2_CONFIG] & 0x03]
+        nanoamps = light * self.photocurrent * currents * pulse_width / PULSE_WIDTHS[-1]
+        codes = np.clip(nanoamps / full_scale * (ADC_MASK + 1), 0, ADC_MASK).astype(np.int64)
+        # shorter pulse widths give fewer bits of resolution (the low bits read as 0)
+        codes &= ~((1 << (18 - bits)) - 1)
+        return codes[:, :channels]
+
+    def update(self):
+        """
+        Moves the sample clock forward to now, pushing new samples into the FIFO
+        """
+        channels = self.mode_channels()
+        rate = self.effective_rate()
+        due = int((self.clock() - self.epoch) * rate)
+        new = due - self.produced
+        if new <= 0 or channels == 0 or self.registers[MODE_CONFIG] & 0x80:
+            self.produced = max(self.produced, due)
+            return
+
+        rollover = self.registers[FIFO_CONFIG] & 0x10
+        if rollover:
+            # anything older than the last FIFO_DEPTH new samples would just be pushed straight back out
+            skipped = max(0, new - FIFO_DEPTH)
+            first = self.produced + skipped
+        else:
+            # a full FIFO takes nothing new, so everything after the free slots is lost
+            skipped = max(0, new - (FIFO_DEPTH - len(self.fifo)))
+            first = self.produced
+        if skipped:
+            self.overflow(skipped, rollover)
+        values = self.sample_values(first, new - skipped, channels)
+        self.produced = due
+
+        for row in values:
+            if len(self.fifo) == FIFO_DEPTH:
+                if not rollover:
+                    self.overflow(1, rollover)
+                    continue
+                self.fifo.pop(0)
+                self.byte_pos = 0
+                self.registers[FIFO_RD_PTR] = (self.registers[FIFO_RD_PTR] + 1) % FIFO_DEPTH
+                self.overflow(1, rollover)
+            self.fifo.append(b''.join(int(v).to_bytes(3, 'big') for v in row))
+            self.registers[FIFO_WR_PTR] = (self.registers[FIFO_WR_PTR] + 1) % FIFO_DEPTH
+
+        # interrupt flags
+        self.registers[INT_STAT_1] |= INT_PPG_RDY
+        if len(self.fifo) >= FIFO_DEPTH - (self.registers[FIFO_CONFIG] & 0x0F):
+            self.registers[INT_STAT_1] |= INT_A_FULL
+
+    def overflow(self, count, rollover):
+        self.registers[FIFO_OVF] = min(0x1F, self.registers[FIFO_OVF] + count)
+
+    def interrupt_asserted(self):
+        return bool(self.registers[INT_STAT_1] & self.registers[INT_ENABLE_1] & (INT_A_FULL | INT_PPG_RDY))
+
+    def check_address(self, addr, size):
+        """
+        Starts a transfer of size bytes on the wire (address, register and data bytes)
+        """
+        self.transactions += 1
+        if self.bus_speed:
+            # 9 clocks per byte (8 bits + ack)
+            delay = 9 * size / self.bus_speed
+            if isinstance(self.clock, ManualClock):
+                self.clock.advance(delay)
+            else:
+                time.sleep(delay)
+        if addr != PULSEOX_ADDR:
+            # what smbus raises when nothing acknowledges the address
+            raise OSError(121, 'Remote I/O error')
+        self.update()
+
+    def read_register(self, register):
+        if register == FIFO_DATA:
+            if not self.fifo:
+                return 0
+            value = self.fifo[0][self.byte_pos]
+            self.byte_pos += 1
+            if self.byte_pos == len(self.fifo[0]):
+                self.fifo.pop(0)
+                self.byte_pos = 0
+                self.registers[FIFO_RD_PTR] = (self.registers[FIFO_RD_PTR] + 1) % FIFO_DEPTH
+                # reading the FIFO clears the overflow counter and the almost full flag
+                self.registers[FIFO_OVF] = 0
+                self.registers[INT_STAT_1] &= ~INT_A_FULL & 0xFF
+            return value
+
+        value = self.registers[register]
+        if register == INT_STAT_1 or register == INT_STAT_2:
+            # status registers clear on read
+            self.registers[register] = 0
+        return value
+
+    def write_register(self, register, value):
+        if register == MODE_CONFIG and value & 0x40:
+            self.reset()
+            return
+        self.registers[register] = value & 0xFF
+        if register in (FIFO_WR_PTR, FIFO_RD_PTR):
+            # the pointers are normally only written to clear the FIFO
+            self.fifo = []
+            self.byte_pos = 0
+
+    def read_byte_data(self, addr, register):
+        self.check_address(addr, 4)
+        self.bytes_read += 1
+        return self.read_register(register)
+
+    def write_byte_data(self, addr, register, value):
+        self.check_address(addr, 3)
+        self.bytes_written += 1
+        self.write_register(register, value)
+
+    def read_i2c_block_data(self, addr, register, length=32):
+        self.check_address(addr, 3 + length)
+        if length > 32:
+            raise ValueError('smbus block transfers are limited to 32 bytes')
+        self.bytes_read += length
+        data = []
+        for i in range(length):
+            data.append(self.read_register(register))
+            # the register address auto-increments, except on FIFO_DATA
+            if register != FIFO_DATA:
+                register = (register + 1) & 0xFF
+        return data
+
+    def write_i2c_block_data(self, addr, register, values):
+        self.check_address(addr, 2 + len(values))
+        if len(values) > 32:
+            raise ValueError('smbus block transfers are limited to 32 bytes')
+        self.bytes_written += len(values)
+        for value in values:
+            self.write_register(register, value)
+            register = (register + 1) & 0xFF
+
+class EmulatedI2CMux():
+    """
+    TCA9548A style I2C multiplexer with an EmulatedMAX30101Bus on some of its channels, used as the bus for several
+    sensors at the same address (see sensor_array.I2CMux). write_byte to the mux address sets which channels are
+    connected; every other transfer goes to the one device on the connected channels.
+
+    selects counts channel changes
+    """
+    def __init__(self, devices, address=0x70):
+        """
+        devices: {channel (0-7): EmulatedMAX30101Bus}
+        """
+        self.devices = devices
+        self.address = address
+        self.selected = 0
+        self.selects = 0
+
+    def write_byte(self, addr, value):
+        if addr != self.address:
+            raise OSError(121, 'Remote I/O error')
+        self.selected = value & 0xFF
+        self.selects += 1
+
+    def read_byte(self, addr):
+        if addr != self.address:
+            raise OSError(121, 'Remote I/O error')
+        return self.selected
+
+    def device(self):
+        connected = [device for channel, device in self.devices.items() if self.selected >> channel & 1]
+        if len(connected) != 1:
+            # nothing there to acknowledge, or two chips answering at once
+            raise OSError(121 if not connected else 5, 'Remote I/O error' if not connected else 'Input/output error')
+        return connected[0]
+
+    def read_byte_data(self, addr, register):
+        return self.device().read_byte_data(addr, register)
+
+    def write_byte_data(self, addr, register, value):
+        self.device().write_byte_data(addr, register, value)
+
+    def read_i2c_block_data(self, addr, register, length=32):
+        return self.device().read_i2c_block_data(addr, register, length)
+
+    def write_i2c_block_data(self, addr, register, values):
+        self.device().write_i2c_block_data(addr, register, values)
+
+class EmulatedInterrupt():
+    """
+    INT pin for an EmulatedMAX30101Bus: wait() blocks (or, with a ManualClock, steps the clock) until an enabled
+    interrupt is flagged
+    """
+    def __init__(self, bus):
+        self.bus = bus
+
+    def wait(self, timeout):
+        bus = self.bus
+        bus.update()
+        if bus.interrupt_asserted():
+            return True
+
+        enabled = bus.registers[INT_ENABLE_1]
+        if enabled & INT_PPG_RDY:
+            needed = 1
+        elif enabled & INT_A_FULL:
+            needed = max(1, FIFO_DEPTH - (bus.registers[FIFO_CONFIG] & 0x0F) - len(bus.fifo))
+        else:
+            needed = None
+
+        delay = timeout if needed is None else min(timeout, bus.time_until(needed))
+        if isinstance(bus.clock, ManualClock):
+            bus.clock.advance(delay)
+        else:
+            time.sleep(delay)
+        bus.update()
+        return bus.interrupt_asserted()
+
+    def close(self):
+        pass
+
+class EmulatedCMS50DPort():
+    """
+    Serial port stand-in for a CMS50D: after a handshake it sends 9 byte live data packets at 60 per second, from
+    synthetic_ppg or replayed from a recording (replay=records with bpm, spo2 and trans_wave fields).
+
+    Like the real device, it stops after stop_after packets unless the handshake is sent again (None never stops).
+    byte_loss drops that fraction of bytes at random, to exercise resynchronization. finger_out is a list of
+    (start, end) seconds after the first handshake during which there's no finger in it (see CMS50D.finger_out).
+    """
+    def __init__(self, clock=time.monotonic, rate=60, timeout=0.01, replay=None, heart_rate=72, spo2=97,
+                 stop_after=1700, byte_loss=0.0, finger_out=(), seed=0):
+        self.clock = clock
+        self.rate = rate
+        self.timeout = timeout
+        self.replay = replay
+        self.heart_rate = heart_rate
+        self.spo2 = spo2
+        self.stop_after = stop_after
+        self.byte_loss = byte_loss
+        self.finger_out = finger_out
+        self.rng = np.random.default_rng(seed)
+
+        self.buffer = bytearray()
+        self.streaming = False
+        self.epoch = None
+        self.produced = 0
+        # packets sent since the last handshake
+        self.since_handshake = 0
+        self.bytes_read = 0
+        self.handshakes = 0
+
+    def packets(self, first, n):
+        """
+        Raw packets first .. first + n - 1 as bytes
+        """
+        if self.replay is not None:
+            index = np.arange(first, first + n) % len(self.replay)
+            bpm = self.replay['bpm'][index]
+            spo2 = self.replay['spo2'][index]
+            wave = self.replay['trans_wave'][index]
+        else:
+            t = np.arange(first, first + n) / self.rate
+            # the transmission waveform is a 0-100 scaled version of the ir light level
+            light = synthetic_ppg(t, self.heart_rate, self.spo2, perfusion=0.3, noise=0.01, seed=self.rng.integers(1 << 32))
+            wave = np.clip(50 + 100 * (light[:, 1] - 1), 0, 100)
+            bpm = np.full(n, self.heart_rate)
+            spo2 = np.full(n, self.spo2)
+        if self.finger_out:
+            t = np.arange(first, first + n) / self.rate
+            out = np.zeros(n, dtype=bool)
+            for start, end in self.finger_out:
+                out |= (t >= start) & (t < end)
+            # no reading: bpm 0, spo2 127 and a flat waveform
+            bpm = np.where(out, 0, bpm)
+            spo2 = np.where(out, 127, spo2)
+            wave = np.where(out, 0, wave)
+
+        packets = np.full((n, 9), 0x80, dtype=np.uint8)
+        packets[:, 0] = 0x01
+        packets[:, 1] = 0xE0
+        packets[:, 3] |= np.asarray(wave, dtype=np.uint8) & 0x7F
+        packets[:, 5] |= np.asarray(bpm, dtype=np.uint8) & 0x7F
+        packets[:, 6] |= np.asarray(spo2, dtype=np.uint8) & 0x7F
+        data = packets.tobytes()
+        if self.byte_loss:
+            keep = self.rng.random(len(data)) >= self.byte_loss
+            data = bytes(np.frombuffer(data, dtype=np.uint8)[keep])
+        return data
+
+    def update(self):
+        if not self.streaming:
+            return
+        due = int((self.clock() - self.epoch) * self.rate)
+        new = due - self.produced
+        if self.stop_after is not None:
+            new = min(new, self.stop_after - self.since_handshake)
+        if new > 0:
+            self.buffer.extend(self.packets(self.produced, new))
+            self.since_handshake += new
+        self.produced = due
+
+    @property
+    def in_waiting(self):
+        self.update()
+        return len(self.buffer)
+
+    def read(self, size=1):
+        """
+        Returns up to size bytes, waiting up to timeout (like pyserial) for them
+        """
+        self.update()
+        if len(self.buffer) < size and self.timeout and self.streaming:
+            if isinstance(self.clock, ManualClock):
+                self.clock.advance(self.timeout)
+            else:
+                time.sleep(self.timeout)
+            self.update()
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self.bytes_read += len(data)
+        return data
+
+    def write(self, data):
+        if data[:3] == b'\x7d\x81\xa1':
+            self.handshakes += 1
+            if not self.streaming:
+                self.streaming = True
+                self.epoch = self.clock()
+                self.produced = 0
+            self.since_handshake = 0
+        return len(data)
+
+    def close(self):
+        self.streaming = False
@@ -0,0 +1,132 @@
+### streaming bandpass filters with persistent state
+#
+# the notebooks bandpass each window on its own (hp.filter_signal / filtfilt): the filter is designed again every
+# window, every window is filtered forwards and backwards in full, and both ends of every window carry start up
+# transients. StreamingBandpass designs its filter once and carries the filter state from one batch to the next, so
+# a batch costs O(batch) and there are no edges except at the very start.
+import functools
+import time
+import numpy as np
+from scipy import signal
+from instrument import metrics
+
+@functools.lru_cache(maxsize=None)
+def design_bandpass(sample_rate, cutoff=(.7, 4), order=4):
+    """
+    Butterworth bandpass as second order sections, designed once per (sample rate, cutoff, order). The returned array
+    is shared between callers, so don't change it
+    """
+    return signal.butter(order, cutoff, btype='bandpass', fs=sample_rate, output='sos')
+
+def settling_samples(sos, tol=1e-3):
+    """
+    Number of samples until the impulse response has died down to tol of its peak
+    """
+    length = 64
+    while True:
+        impulse = np.zeros(length)
+        impulse[0] = 1
+        h = np.abs(signal.sosfilt(sos, impulse))
+        above = np.nonzero(h > tol * h.max())[0]
+        # make sure the tail really has died down, not just dipped through a zero crossing
+        if above[-1] < length // 2:
+            return int(above[-1]) + 1
+        length *= 2
+
+class StreamingBandpass():
+    """
+    Bandpasses batches of samples (all channels at once, eg. red, ir, green as an (N, 3) array) as they arrive.
+
+    mode='causal': plain forward filtering. Every batch comes straight back filtered, with no added latency, but with
+    the phase lag of the Butterworth filter (a few samples around the pulse frequency).
+
+    mode='zero_phase': forward-backward filtering like filtfilt (same |H|^2 response, no phase distortion), delayed by
+    delay samples. The forward pass runs on every batch; the backward pass runs over each block of finished samples
+    plus the next delay samples, which is long enough for its start up transient to die out. Returns only the samples
+    that are finished, so output lags input by delay to delay + block samples; flush() returns the rest.
+
+    eg.
+    bandpass = StreamingBandpass(25, mode='zero_phase')
+    while True:
+        filtered = bandpass.process(pulseOx.read_batch())
+    """
+    def __init__(self, sample_rate, cutoff=(.7, 4), order=4, mode='causal', delay=None, block=None):
+        """
+        sample_rate: effective sample rate in Hz (sample rate / samples averaged)
+        delay: zero_phase lookahead in samples (default: until the filter's impulse response has died down to 0.1%)
+        block: zero_phase samples per backward pass (default: delay, so the backward pass at most doubles the cost)
+        """
+        if mode not in ('causal', 'zero_phase'):
+            raise ValueError(f'unknown mode {mode!r}')
+        self.sos = design_bandpass(sample_rate, tuple(cutoff), order)
+        self.mode = mode
+        self.delay = settling_samples(self.sos) if delay is None else delay
+        self.block = block or max(1, self.delay)
+        self.zi = None
+        # zero_phase: forward filtered samples not yet handed out, oldest first
+        self.pending = None
+        self.emitted = 0
+
+    def reset_state(self, first):
+        """
+        Starts the forward filter in steady state at the first sample, so there's no step transient at the start
+        """
+        self.zi = signal.sosfilt_zi(self.sos)[:, :, None] * first
+        self.pending = np.empty((0, len(first)))
+
+    def backward(self, forward):
+        """
+        Backward pass over forward filtered samples, starting in steady state at the newest one
+        """
+        reverse = forward[::-1]
+        zi = signal.sosfilt_zi(self.sos)[:, :, None] * reverse[0]
+        out, _ = signal.sosfilt(self.sos, reverse, axis=0, zi=zi)
+        return out[::-1]
+
+    def process(self, batch):
+        """
+        batch: (N, channels) array (or a 1-D array for one channel)
+
+        Returns the filtered samples: all N of them in causal mode, or the ones finished so far in zero_phase mode
+        (emitted counts how many have been returned in total, so output i always lines up with input i)
+        """
+        timed = metrics.enabled
+        if timed:
+            start = time.perf_counter()
+        x = np.asarray(batch, dtype=np.float64)
+        squeeze = x.ndim == 1
+        if squeeze:
+            x = x[:, None]
+        if len(x) == 0:
+            out = np.empty((0, x.shape[1]))
+            return out[:, 0] if squeeze else out
+        if self.zi is None:
+            self.reset_state(x[0])
+
+        forward, self.zi = signal.sosfilt(self.sos, x, axis=0, zi=self.zi)
+        if self.mode == 'causal':
+            out = forward
+        else:
+            self.pending = np.concatenate((self.pending, forward))
+            ready = len(self.pending) - self.delay
+            if ready >= self.block:
+                out = self.backward(self.pending)[:ready]
+                self.pending = self.pending[ready:]
+            else:
+                out = np.empty((0, x.shape[1]))
+        self.emitted += len(out)
+        if timed:
+            metrics.add_time('filter.bandpass', time.perf_counter() - start)
+        return out[:, 0] if squeeze else out
+
+    def flush(self):
+        """
+        zero_phase: returns the samples still held back (the backward pass over them starts at the newest sample,
+        like filtfilt at the end of a signal)
+        """
+        if self.pending is None or len(self.pending) == 0 or self.mode == 'causal':
+            return np.empty((0, 0 if self.pending is None else self.pending.shape[1]))
+        out = self.backward(self.pending)
+        self.pending = self.pending[:0]
+        self.emitted += len(out)
+        return out
@@ -0,0 +1,189 @@
+### streaming heart rate from the reflection pulseOx's channels, so the live pipeline doesn't have to rely on the
+### CMS50D's bpm
+#
+# the wrist_heartrate notebook takes the strongest frequency of a full fft over the whole series. StreamingHeartRate
+# keeps the same spectrum over a sliding window, but only the bins in the pulse band, and updates them per sample with
+# a sliding dft instead of recomputing the fft, so each sample costs O(bins) no matter how long the window is
+import numpy as np
+from quality import SignalQuality
+
+class StreamingHeartRate():
+    """
+    Incremental heart rate estimator. Feed it batches of samples (any number of channels, eg. red, ir, green) and it
+    emits a heart rate and a confidence every hop seconds, from the last window seconds of data.
+
+    The spectrum of each channel is Hann windowed (in the frequency domain), normalized and summed over channels; the
+    heart rate is the peak in the pulse band, refined by parabolic interpolation between bins. Confidence is the
+    fraction of band power in the peak (1 for a clean pulse, small for noise).
+
+    With min_quality set, the same windows are scored by a quality.SignalQuality as well, and the estimate is skipped
+    (NaN heart rate, 0 confidence) for windows scoring below it, eg. with the sensor off the finger or moving.
+    """
+    def __init__(self, sample_rate=25, window=10, hop=1, band=(.7, 4), refresh=None, min_quality=None):
+        """
+        sample_rate: effective sample rate in Hz (sample rate / samples averaged)
+        window: seconds of data each estimate covers (frequency resolution is 1 / window Hz before interpolation)
+        hop: seconds between estimates
+        band: pulse band in Hz (.7-4 Hz is 42-240 bpm)
+        refresh: samples between exact recomputes of the spectrum, which stop rounding errors building up in the
+        sliding updates (default: one window)
+        min_quality: signal quality score a window needs for an estimate (default: estimate every window). Samples have
+        to be raw ADC values for this
+        """
+        self.sample_rate = sample_rate
+        self.N = int(round(window * sample_rate))
+        self.hop = max(1, int(round(hop * sample_rate)))
+        self.refresh = refresh or self.N
+
+        # band bins, plus one either side for the Hann window and the interpolation
+        resolution = sample_rate / self.N
+        first = max(1, int(np.floor(band[0] / resolution)) - 1)
+        last = min(self.N // 2 - 1, int(np.ceil(band[1] / resolution)) + 1)
+        self.bins = np.arange(first, last + 1)
+        self.in_band = (self.bins >= band[0] / resolution) & (self.bins <= band[1] / resolution)
+        self.in_band[[0, -1]] = False
+        # twiddle factors w^e = exp(2j pi k e / N), for every exponent e a batch can need
+        self.powers = np.exp(2j * np.pi * np.outer(np.arange(self.N), self.bins) / self.N)
+
+        self.quality = None
+        if min_quality is not None:
+            self.quality = SignalQuality(sample_rate, window=self.N / sample_rate, hop=self.hop / sample_rate,
+                                         threshold=min_quality)
+        self.X = None
+        self.count = 0
+
+    def reset_state(self, first):
+        channels = len(first)
+        # the first sample is subtracted from everything to keep the numbers (and rounding errors) small
+        self.offset = first.copy()
+        self.history = np.zeros((self.N, channels))
+        self.pos = 0
+        self.X = np.zeros((len(self.bins), channels), dtype=np.complex128)
+        self.since_refresh = 0
+
+    def slide(self, x):
+        """
+        Moves the window forward over x (at most one window of samples)
+        """
+        m = len(x)
+        index = (self.pos + np.arange(m)) % self.N
+        d = x - self.history[index]
+        self.history[index] = x
+        self.pos = (self.pos + m) % self.N
+        # X <- w^m X + sum over i of d[i] w^(m - i)
+        self.X = self.powers[m % self.N][:, None] * self.X + self.powers[(m - np.arange(m)) % self.N].T @ d
+        self.since_refresh += m
+        if self.since_refresh >= self.refresh:
+            self.recompute()
+
+    def recompute(self):
+        """
+        Exact dft of the current window (oldest sample first), same as the sliding updates would give without rounding
+        """
+        window = np.roll(self.history, -self.pos, axis=0)
+        self.X = self.powers[(self.N - np.arange(self.N)) % self.N].T @ window
+        self.since_refresh = 0
+
+    def estimate(self):
+        """
+        Returns tuple (heart rate in bpm, confidence) for the current window
+        """
+        X = self.X
+        # Hann window applied in the frequency domain
+        Y = 0.5 * X[1:-1] - 0.25 * (X[:-2] + X[2:])
+        power = np.abs(Y) ** 2
+        in_band = self.in_band[1:-1]
+        total = power[in_band].sum(axis=0)
+        power = (power / np.maximum(total, 1e-300)).sum(axis=1)
+
+        band_power = np.where(in_band, power, 0)
+        peak = int(np.argmax(band_power))
+        if band_power[peak] <= 0:
+            return (np.nan, 0.0)
+        # parabolic interpolation of the log power around the peak
+        shift = 0.0
+        if 0 < peak < len(power) - 1:
+            a, b, c = np.log(np.maximum(power[peak - 1:peak + 2], 1e-300))
+            if a - 2 * b + c < 0:
+                shift = np.clip(0.5 * (a - c) / (a - 2 * b + c), -0.5, 0.5)
+        freq = (self.bins[1 + peak] + shift) * self.sample_rate / self.N
+
+        # the Hann main lobe is 2 bins either side of the peak
+        lobe = band_power[max(0, peak - 2):peak + 3].sum()
+        confidence = lobe / max(band_power.sum(), 1e-300)
+        return (60 * freq, confidence)
+
+    def process(self, batch, finger_out=None):
+        """
+        batch: (N, channels) array of samples (or a 1-D array for a single channel)
+        finger_out: the transmission pulseOx's finger out flag for each sample, for the quality gate
+
+        Returns tuple (sample index, heart rate in bpm, confidence), one entry per estimate emitted during the batch.
+        The sample index counts samples since the start (the estimate covers the window ending there). Heart rate is NaN
+        and confidence 0 until one window of samples has gone by
+        """
+        x = np.asarray(batch, dtype=np.float64)
+        if x.ndim == 1:
+            x = x[:, None]
+        if self.X is None and len(x):
+            self.reset_state(x[0])
+        usable = None
+        if self.quality is not None:
+            # scores land on the same sample indices as the estimates
+            q_index, score, _ = self.quality.process(x, finger_out)
+            usable = dict(zip(q_index.tolist(), score >= self.quality.threshold))
+        index = []
+        bpm = []
+        confidence = []
+
+        i = 0
+        while i < len(x):
+            # up to the next hop boundary, so estimates land on exactly every hop samples
+            step = min(len(x) - i, self.hop - self.count % self.hop, self.N)
+            self.slide(x[i:i + step] - self.offset)
+            self.count += step
+            i += step
+            if self.count % self.hop == 0:
+                index.append(self.count)
+                if self.count >= self.N and (usable is None or usable[self.count]):
+                    rate, conf = self.estimate()
+                else:
+                    rate, conf = (np.nan, 0.0)
+                bpm.append(rate)
+                confidence.append(conf)
+        return (np.array(index, dtype=np.int64), np.array(bpm), np.array(confidence))
+
+def heart_rate_from_recording(path, sample_rate=None, window=10, hop=1, chunk_size=4096, min_quality=None):
+    """
+    Runs StreamingHeartRate over the red and ir channels of a .pox or .csv recording. Returns tuple (time, heart rate
+    in bpm, confidence), one entry per hop. sample_rate overrides the recording's own (see
+    recording.recording_sample_rate); min_quality is as for spo2.spo2_from_recording
+    """
+    from recording import load_recording, recording_sample_rate
+    from quality import records_finger_out
+    records = load_recording(path)
+    if sample_rate is None:
+        sample_rate = recording_sample_rate(path, records)
+
+    estimator = StreamingHeartRate(sample_rate, window, hop, min_quality=min_quality)
+    index = []
+    bpm = []
+    confidence = []
+    for i in range(0, len(records), chunk_size):
+        chunk = records[i:i + chunk_size]
+        results = estimator.process(np.column_stack((chunk['red'], chunk['ir'])), records_finger_out(chunk))
+        index.append(results[0])
+        bpm.append(results[1])
+        confidence.append(results[2])
+    times = np.asarray(records['time'])[np.concatenate(index) - 1]
+    return (times, np.concatenate(bpm), np.concatenate(confidence))
+
+def heart_rate_from_sensor(sensor, window=10, hop=1):
+    """
+    Generator over a live MAX30101: yields (heart rate in bpm, confidence) every hop seconds
+    """
+    estimator = StreamingHeartRate(sensor.output_rate(), window, hop)
+    while True:
+        index, bpm, confidence = estimator.process(sensor.read_batch())
+        for rate, conf in zip(bpm, confidence):
+            yield (rate, conf)
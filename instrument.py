@@ -0,0 +1,158 @@
+### opt-in instrumentation of the hot paths -- stage timings, bus/serial counters and FIFO fill levels, to find out
+### where time goes (and where things stall) in a real capture
+#
+# Off by default. The instrumented code checks metrics.enabled before doing anything, so when it's off each hot path
+# pays for one attribute check.
+#
+# eg.
+# from instrument import metrics, MetricsDumper
+# metrics.enable()
+# dumper = MetricsDumper('metrics.jsonl', interval=10)
+# dumper.start()
+# ... record as usual ...
+# dumper.stop()
+# print(metrics.query('max30101.*'))
+#
+# names in use:
+# max30101.bus, max30101.decode (timings); max30101.transactions, max30101.bytes, max30101.overflow (counters);
+# max30101.fifo_fill (histogram of samples waiting at each FIFO read)
+# cms50d.serial, cms50d.decode, cms50d.retry (timings, retry is time spent in reads that came back empty);
+# cms50d.bytes, cms50d.handshakes, cms50d.framing_errors (counters)
+# filter.bandpass, recording.write (timings)
+import fnmatch
+import json
+import threading
+import time
+
+class Timing():
+    """
+    Count, total and max of one stage's durations, plus a histogram of them in power of 2 microsecond buckets
+    (bucket b holds durations from 2^(b-1) to 2^b us), enough for rough percentiles without keeping every value
+    """
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.buckets = [0] * 32
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+        self.buckets[min(int(seconds * 1e6).bit_length(), 31)] += 1
+
+    def percentile(self, q):
+        """
+        Upper edge of the bucket holding the q-th percentile, in us
+        """
+        target = q / 100 * self.count
+        seen = 0
+        for b, n in enumerate(self.buckets):
+            seen += n
+            if n and seen >= target:
+                return float(1 << b)
+        return 0.0
+
+    def summary(self):
+        return {
+            'count' : self.count,
+            'total_s' : self.total,
+            'mean_us' : self.total / self.count * 1e6 if self.count else 0.0,
+            'p50_us' : self.percentile(50),
+            'p99_us' : self.percentile(99),
+            'max_us' : self.max * 1e6,
+        }
+
+class Metrics():
+    """
+    In-process registry of counters, stage timings and histograms of small integer values (eg. FIFO fill levels).
+    Safe to update from several threads
+    """
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.reset()
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.timings = {}
+            self.histograms = {}
+            self.start_time = time.monotonic()
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                timing = self.timings[name] = Timing()
+            timing.add(seconds)
+
+    def observe(self, name, value):
+        with self.lock:
+            histogram = self.histograms.setdefault(name, {})
+            histogram[value] = histogram.get(value, 0) + 1
+
+    def snapshot(self):
+        """
+        Returns a dict of everything recorded since the last reset (json serializable)
+        """
+        with self.lock:
+            return {
+                'time' : time.time(),
+                'uptime' : time.monotonic() - self.start_time,
+                'counters' : dict(self.counters),
+                'timings' : {name : timing.summary() for name, timing in self.timings.items()},
+                'histograms' : {name : {str(value) : n for value, n in sorted(histogram.items())}
+                                for name, histogram in self.histograms.items()},
+            }
+
+    def query(self, pattern='*'):
+        """
+        Returns {name: value} of every counter, timing summary and histogram whose name matches pattern (fnmatch
+        style, eg. 'max30101.*')
+        """
+        snapshot = self.snapshot()
+        found = {}
+        for kind in ('counters', 'timings', 'histograms'):
+            for name, value in snapshot[kind].items():
+                if fnmatch.fnmatch(name, pattern):
+                    found[name] = value
+        return found
+
+# the registry the instrumented modules report to
+metrics = Metrics()
+
+class MetricsDumper(threading.Thread):
+    """
+    Appends a snapshot of metrics to path, one json line every interval seconds (and a last one on stop)
+    """
+    def __init__(self, path, interval=10.0, registry=metrics):
+        super().__init__(name='metrics dump', daemon=True)
+        self.path = path
+        self.interval = interval
+        self.registry = registry
+        self.stopped = threading.Event()
+
+    def dump(self):
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(self.registry.snapshot()) + '\n')
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.dump()
+        self.dump()
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
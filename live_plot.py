@@ -0,0 +1,100 @@
+### real time plotting of ring buffers (see acquisition.py) -- redraws on a fixed rate timer, independent of the
+### sample rate, so plotting never holds up acquisition
+#
+# set headless=True (or QT_QPA_PLATFORM=offscreen) to render without a display, eg. for benchmarking
+import os
+import time
+import numpy as np
+
+def decimate_minmax(y, max_points):
+    """
+    Shrinks y to at most max_points points by keeping the min and max of each bucket, so narrow peaks still show up
+    """
+    if len(y) <= max_points:
+        return y
+    bucket = int(np.ceil(2 * len(y) / max_points))
+    # drop the oldest few samples so the rest splits into whole buckets
+    buckets = y[len(y) % bucket:].reshape(-1, bucket)
+    out = np.empty((len(buckets), 2), dtype=y.dtype)
+    out[:, 0] = buckets.min(axis=1)
+    out[:, 1] = buckets.max(axis=1)
+    return out.ravel()
+
+class LivePlot():
+    """
+    Plots the newest window_width samples of one or more ring buffer columns, redrawn fps times a second.
+    Ring buffers are read in place (no shifting or copying of the data window).
+
+    eg.
+    acq = Acquisition()
+    ring = acq.add('reflect', MAX30101Source(MAX30101()))
+    plot = LivePlot(window_width=100)
+    plot.add_curve(ring, 0, pen='r')
+    acq.start()
+    plot.run()
+    """
+    def __init__(self, title='PulseOx Data', window_width=500, fps=30, max_points=2000, headless=False):
+        if headless:
+            os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+        from pyqtgraph.Qt import QtGui, QtCore
+        import pyqtgraph as pg
+
+        self.QtGui = QtGui
+        self.QtCore = QtCore
+        self.window_width = window_width
+        self.fps = fps
+        self.max_points = max_points
+        self.curves = []
+
+        self.app = QtGui.QApplication.instance() or QtGui.QApplication([])
+        # enable antialiasing
+        pg.setConfigOptions(antialias=True)
+        self.win = pg.GraphicsWindow(title=title)
+        self.win.resize(1000, 600)
+        self.win.setWindowTitle('Waveform Data')
+        self.plot = self.win.addPlot(title='Waveform Data')
+        self.timer = None
+
+    def add_curve(self, ring, column, offset=0, pen=None):
+        """
+        Plots column of ring, minus offset (eg. to bring reflection data down to transmission data's scale)
+        """
+        curve = self.plot.plot(pen=pen)
+        self.curves.append((ring, column, offset, curve))
+        return curve
+
+    def update(self):
+        """
+        Redraws every curve from the newest data in its ring buffer
+        """
+        for ring, column, offset, curve in self.curves:
+            times, data = ring.latest(self.window_width)
+            y = data[:, column].astype(np.float64)
+            if offset:
+                y = np.maximum(y - offset, 0)
+            curve.setData(decimate_minmax(y, self.max_points))
+
+    def start(self):
+        """
+        Starts the redraw timer (needs a running Qt event loop, see run)
+        """
+        self.timer = self.QtCore.QTimer()
+        self.timer.timeout.connect(self.update)
+        self.timer.start(int(1000 / self.fps))
+
+    def run(self):
+        """
+        Starts redrawing and blocks in the Qt event loop until the window is closed
+        """
+        self.start()
+        self.app.exec_()
+
+    def benchmark(self, frames=300):
+        """
+        Renders frames redraws back to back (no timer) and returns the average seconds per frame
+        """
+        start = time.perf_counter()
+        for i in range(frames):
+            self.update()
+            self.app.processEvents()
+        return (time.perf_counter() - start) / frames
@@ -0,0 +1,209 @@
+### streaming signal quality index -- a cheap score per window, so the expensive estimators (SSA, peak detection,
+### SpO2) can skip or downgrade windows where the sensor is detached, clipping or moving
+#
+# eg.
+# quality = SignalQuality(25)
+# index, score, flags = quality.process(batch)
+# usable = score >= quality.threshold
+import numpy as np
+from filters import StreamingBandpass
+from MAX30101 import ADC_MASK
+
+# reasons a window scored low, as bits of the flags returned by SignalQuality.process
+FINGER_OUT = 0x01
+LOW_DC = 0x02
+LOW_PERFUSION = 0x04
+MOTION = 0x08
+CLIPPED = 0x10
+ARTIFACT = 0x20
+
+FLAG_NAMES = {
+    FINGER_OUT : 'finger_out',
+    LOW_DC : 'low_dc',
+    LOW_PERFUSION : 'low_perfusion',
+    MOTION : 'motion',
+    CLIPPED : 'clipped',
+    ARTIFACT : 'artifact',
+}
+
+def flag_names(flags):
+    """
+    Names of the bits set in one window's flags
+    """
+    return [name for bit, name in FLAG_NAMES.items() if flags & bit]
+
+def records_finger_out(records):
+    """
+    Finger out flag of each record of a recording, from its CMS50D bpm and spo2 columns (see CMS50D.finger_out), or
+    None if it has no transmission pulseOx data
+    """
+    if 'spo2' not in records.dtype.names:
+        return None
+    from CMS50D import finger_out
+    return finger_out(np.column_stack((records['bpm'], records['spo2'])))
+
+def above(value, limit):
+    """
+    0-1 margin for a value that has to be above limit: 0.5 at the limit, 1 from twice the limit up
+    """
+    return np.clip(value / (2 * limit), 0, 1)
+
+def below(value, limit):
+    """
+    0-1 margin for a value that has to be below limit: 0.5 at the limit, 1 at 0 and 0 from twice the limit up
+    """
+    return np.clip(1 - value / (2 * limit), 0, 1)
+
+class SignalQuality():
+    """
+    Scores the last window seconds of reflectance samples every hop seconds, from:
+    dc -- mean level as a fraction of ADC full scale (a detached sensor only sees a little ambient light)
+    perfusion -- pulse band ac (rms of the bandpassed signal) over dc; too low is no pulse, too high is motion
+    clipped -- fraction of samples at the top of the ADC range
+    skew -- skewness of the bandpassed signal; spikes and steps make it large
+    finger_out -- fraction of the window the transmission pulseOx reported no finger (if it's given)
+
+    Each is turned into a 0-1 margin (0.5 right at its limit) and the score is the smallest one over all metrics and
+    channels, so a window is usable (score >= threshold, 0.5 by default) only if it passes every check. A window the
+    transmission pulseOx reports any finger out in scores 0.
+
+    The default limits come from the recordings in processing/data: pulse band perfusion is about 2e-4 - 1.5e-3 on the
+    strong and trial recordings and about 1e-4 on the weak_signal ones (red channel), so min_perfusion sits between
+    them. 4 s windows of the strong and trial recordings score 90-97% usable and weak_signal 10-30%.
+
+    Every metric comes from running sums over the window (of x, the bandpassed signal and its square and cube), updated
+    per batch and recomputed exactly once per window, so each sample costs O(1) however long the window is.
+    """
+    def __init__(self, sample_rate=25, window=4, hop=1, min_dc=0.05, min_perfusion=1.25e-4, max_perfusion=0.02,
+                 max_clipped=0.01, max_skew=2.0, clip_level=0.98, threshold=0.5):
+        """
+        sample_rate: effective sample rate in Hz (sample rate / samples averaged)
+        window: seconds per scored window
+        hop: seconds between scores (0 scores every sample)
+        """
+        self.sample_rate = sample_rate
+        self.N = max(2, int(round(window * sample_rate)))
+        self.hop = max(1, int(round(hop * sample_rate)))
+        self.min_dc = min_dc
+        self.min_perfusion = min_perfusion
+        self.max_perfusion = max_perfusion
+        self.max_clipped = max_clipped
+        self.max_skew = max_skew
+        self.clip_level = clip_level * ADC_MASK
+        self.threshold = threshold
+
+        self.bandpass = StreamingBandpass(sample_rate)
+        self.history = None
+        self.count = 0
+        # metrics of the windows scored by the last process call, one entry per score
+        self.metrics = {}
+
+    def reset_state(self, channels):
+        # per sample terms of the running sums: x, clipped, f, f^2, f^3 per channel, then finger out
+        self.history = np.zeros((self.N, 5 * channels + 1))
+        self.totals = np.zeros(5 * channels + 1)
+        self.pos = 0
+        self.since_refresh = 0
+
+    def terms(self, x, finger_out):
+        f = self.bandpass.process(x)
+        clipped = (x >= self.clip_level).astype(np.float64)
+        return np.column_stack((x, clipped, f, f ** 2, f ** 3, finger_out))
+
+    def score(self, sums, channels):
+        """
+        Score, flags and metrics of windows from their (windows, terms) sums
+        """
+        n = self.N
+        x, clipped, f, f2, f3 = (sums[:, i * channels:(i + 1) * channels] / n for i in range(5))
+        finger_out = sums[:, -1] / n
+
+        dc = np.maximum(x, 1e-12)
+        var = np.maximum(f2 - f ** 2, 0)
+        std = np.sqrt(var)
+        perfusion = std / dc
+        # a flat signal (nothing but rounding error in the pulse band) has no meaningful skew
+        flat = std <= 1e-9 * dc
+        skew = np.where(flat, 0, (f3 - 3 * f * f2 + 2 * f ** 3) / np.where(flat, 1, std ** 3))
+
+        margins = {
+            LOW_DC : above(dc / ADC_MASK, self.min_dc),
+            LOW_PERFUSION : above(perfusion, self.min_perfusion),
+            MOTION : below(perfusion, self.max_perfusion),
+            CLIPPED : below(clipped, self.max_clipped),
+            ARTIFACT : below(np.abs(skew), self.max_skew),
+        }
+        score = np.min([margin.min(axis=1) for margin in margins.values()], axis=0)
+        flags = np.zeros(len(sums), dtype=np.int64)
+        for bit, margin in margins.items():
+            flags |= np.where((margin < 0.5).any(axis=1), bit, 0)
+        out = finger_out > 0
+        score[out] = 0
+        flags[out] |= FINGER_OUT
+
+        metrics = {'dc' : x / ADC_MASK, 'perfusion' : perfusion, 'clipped' : clipped, 'skew' : skew, 'finger_out' : finger_out}
+        return (score, flags, metrics)
+
+    def process(self, batch, finger_out=None):
+        """
+        batch: (N, channels) array of raw ADC samples (or a 1-D array for one channel)
+        finger_out: the transmission pulseOx's finger out flag for each sample (see CMS50D.finger_out), or one value
+        for the whole batch
+
+        Returns tuple (sample index, score, flags), one entry per window scored during the batch. The sample index
+        counts samples since the start (the window ends there); flags are the FINGER_OUT, LOW_DC, ... bits of the
+        checks that failed. Scores are NaN until one window of samples has gone by
+        """
+        x = np.asarray(batch, dtype=np.float64)
+        if x.ndim == 1:
+            x = x[:, None]
+        m = len(x)
+        if m == 0:
+            return (np.empty(0, dtype=np.int64), np.empty(0), np.empty(0, dtype=np.int64))
+        channels = x.shape[1]
+        if self.history is None:
+            self.reset_state(channels)
+        out = np.broadcast_to(np.asarray(finger_out if finger_out is not None else 0, dtype=np.float64), (m,))
+
+        # windows ending in this batch, by position in it
+        ends = np.arange(self.hop - self.count % self.hop, m + 1, self.hop)
+        terms = self.terms(x, out)
+        sums = np.empty((len(ends), len(self.totals)))
+
+        # a batch longer than the window goes through in window sized steps, so the samples leaving are in history
+        for start in range(0, m, self.N):
+            step = terms[start:start + self.N]
+            index = (self.pos + np.arange(len(step))) % self.N
+            # running sums after each sample of the step: add the new sample, drop the one a window earlier
+            running = self.totals + np.cumsum(step - self.history[index], axis=0)
+            self.history[index] = step
+            self.pos = (self.pos + len(step)) % self.N
+            self.totals = running[-1]
+            in_step = (ends > start) & (ends <= start + len(step))
+            sums[in_step] = running[ends[in_step] - start - 1]
+
+            self.since_refresh += len(step)
+            if self.since_refresh >= self.N:
+                # exact sums, so rounding errors in the running ones don't build up
+                self.totals = self.history.sum(axis=0)
+                self.since_refresh = 0
+
+        index = self.count + ends
+        self.count += m
+        if not len(ends):
+            return (index.astype(np.int64), np.empty(0), np.empty(0, dtype=np.int64))
+        score, flags, self.metrics = self.score(sums, channels)
+        score[index < self.N] = np.nan
+        flags[index < self.N] = 0
+        return (index.astype(np.int64), score, flags)
+
+def window_quality(samples, window_size, finger_out=None, **settings):
+    """
+    Score and flags of every sliding window of a whole (N, channels) array of samples, ie. window i covers
+    samples[i:i + window_size] (same windows as ssa.iter_acdc). settings are as for SignalQuality (window and hop
+    are set from window_size)
+    """
+    sample_rate = settings.pop('sample_rate', 25)
+    quality = SignalQuality(sample_rate, window=window_size / sample_rate, hop=0, **settings)
+    index, score, flags = quality.process(samples, finger_out)
+    return (score[window_size - 1:], flags[window_size - 1:])
@@ -0,0 +1,216 @@
+### compact binary recording format, written in large buffered blocks and read back through np.memmap
+#
+# layout: 8 byte magic, 4 byte little endian header length, json header (padded with spaces so the records start on a
+# 64 byte boundary), then fixed size little endian records back to back until the end of the file. The record count
+# isn't stored anywhere, so files are append only and a recording cut short still reads back fine.
+import csv
+import json
+import time
+from datetime import datetime
+import numpy as np
+from instrument import metrics
+
+MAGIC = b'PULSEOX\x01'
+ALIGNMENT = 64
+
+# record layouts -- field name and numpy type
+SPO2_FIELDS = [('time', '<f8'), ('bpm', 'u1'), ('spo2', 'u1'), ('trans_wave', 'u1'), ('red', '<u4'), ('ir', '<u4')]
+MULTI_FIELDS = SPO2_FIELDS + [('green', '<u4')]
+REFLECT_FIELDS = [('time', '<f8'), ('red', '<u4'), ('ir', '<u4')]
+
+# column names used in the .csv files
+CSV_NAMES = {
+    'time' : 'time',
+    'bpm' : 'bpm',
+    'spo2' : 'spo2',
+    'trans_wave' : 'Trans: Wave',
+    'red' : 'Reflect: Red',
+    'ir' : 'Reflect: IR',
+    'green' : 'Reflect: Green',
+}
+
+class RecordingWriter():
+    """
+    Appends records to a recording file, buffering chunk_size records in memory between writes.
+
+    eg.
+    with RecordingWriter('data.pox', SPO2_FIELDS, settings) as writer:
+        writer.append((t, bpm, spo2, wave, red, ir))
+    """
+    def __init__(self, path, fields, settings=None, chunk_size=4096):
+        """
+        fields: record layout, eg. SPO2_FIELDS
+        settings: dict describing the sensor settings, stored in the header
+        """
+        self.dtype = np.dtype(fields)
+        self.buffer = np.zeros(chunk_size, dtype=self.dtype)
+        self.count = 0
+
+        header = {
+            'fields' : fields,
+            'settings' : settings or {},
+            'created' : datetime.now().isoformat(),
+        }
+        header = json.dumps(header).encode()
+        # pad so that the records start on an aligned offset
+        padding = -(len(MAGIC) + 4 + len(header)) % ALIGNMENT
+        header += b' ' * padding
+
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+        self.file.write(len(header).to_bytes(4, 'little'))
+        self.file.write(header)
+
+    def append(self, row):
+        """
+        Adds one record, given as a tuple in field order
+        """
+        self.buffer[self.count] = row
+        self.count += 1
+        if self.count == len(self.buffer):
+            self.flush()
+
+    def write(self, records):
+        """
+        Adds a structured array of records (same layout as the file)
+        """
+        if self.count:
+            self.flush()
+        timed = metrics.enabled
+        if timed:
+            start = time.perf_counter()
+        records.astype(self.dtype, copy=False).tofile(self.file)
+        if timed:
+            metrics.add_time('recording.write', time.perf_counter() - start)
+
+    def flush(self):
+        timed = metrics.enabled
+        if timed:
+            start = time.perf_counter()
+        self.buffer[:self.count].tofile(self.file)
+        self.count = 0
+        self.file.flush()
+        if timed:
+            metrics.add_time('recording.write', time.perf_counter() - start)
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def read_header(path):
+    """
+    Returns tuple (header dict, offset of the first record)
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a pulseOx recording')
+        length = int.from_bytes(f.read(4), 'little')
+        header = json.loads(f.read(length))
+    return (header, len(MAGIC) + 4 + length)
+
+def read_recording(path):
+    """
+    Maps a recording into memory without reading it. Returns tuple (records, header dict), where records is a
+    read-only structured np.memmap, eg. records['red']
+    """
+    header, offset = read_header(path)
+    dtype = np.dtype([tuple(field) for field in header['fields']])
+    with open(path, 'rb') as f:
+        size = f.seek(0, 2)
+    # ignore a partly written record at the end
+    count = (size - offset) // dtype.itemsize
+    if count == 0:
+        return (np.zeros(0, dtype=dtype), header)
+    return (np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(count,)), header)
+
+def csvfile_has_rows(csv_path):
+    """
+    True if a .csv has anything after its header line (np.loadtxt can't tell how many columns an empty one has)
+    """
+    with open(csv_path) as csvfile:
+        next(csvfile, None)
+        return any(line.strip() for line in csvfile)
+
+def read_csv_records(csv_path):
+    """
+    Reads a .csv recording (time, bpm, spo2, Trans: Wave, Reflect: Red, Reflect: IR[, Reflect: Green], or just the
+    time and Reflect columns) into a structured array with the same layout as the binary format.
+
+    Older recordings were written before the driver masked the FIFO data, so they carry junk above the 18 ADC bits;
+    the Reflect columns are masked here, giving the same values decode_fifo does
+    """
+    from MAX30101 import ADC_MASK
+    with open(csv_path) as csvfile:
+        columns = next(csv.reader(csvfile))
+    names = {csv_name : name for name, csv_name in CSV_NAMES.items()}
+    fields = [(names[column], dict(MULTI_FIELDS)[names[column]]) for column in columns]
+
+    if not csvfile_has_rows(csv_path):
+        return np.zeros(0, dtype=fields)
+    values = np.loadtxt(csv_path, delimiter=',', skiprows=1, ndmin=2)
+    records = np.zeros(len(values), dtype=fields)
+    for i, (name, _) in enumerate(fields):
+        if name in ('red', 'ir', 'green'):
+            records[name] = values[:, i].astype(np.int64) & ADC_MASK
+        else:
+            records[name] = values[:, i]
+    return records
+
+def load_recording(path):
+    """
+    Returns the records of a .pox (memory mapped) or .csv (read into memory) recording as a structured array
+    """
+    if path.endswith('.csv'):
+        return read_csv_records(path)
+    return read_recording(path)[0]
+
+def estimate_sample_rate(times):
+    """
+    Effective sample rate from a time column (median spacing, so the odd scheduling hiccup doesn't matter)
+    """
+    return 1 / np.median(np.diff(times))
+
+def recording_sample_rate(path, records=None):
+    """
+    Effective sample rate of a recording in Hz: the sample_rate_hz stored in a .pox header, otherwise estimated from
+    the time column (records, if they're already loaded, saves reading them again)
+    """
+    if not path.endswith('.csv'):
+        rate = read_header(path)[0]['settings'].get('sample_rate_hz')
+        if rate:
+            return rate
+    if records is None:
+        records = load_recording(path)
+    return estimate_sample_rate(np.asarray(records['time']))
+
+def csv_to_recording(csv_path, path=None, settings=None):
+    """
+    Converts a .csv recording to the binary format. Returns the path of the new file
+    """
+    if path is None:
+        path = csv_path.rsplit('.', 1)[0] + '.pox'
+
+    records = read_csv_records(csv_path)
+    with RecordingWriter(path, records.dtype.descr, settings) as writer:
+        writer.write(records)
+    return path
+
+def recording_to_csv(path, csv_path=None):
+    """
+    Converts a binary recording back to the .csv schema. Returns the path of the new file
+    """
+    if csv_path is None:
+        csv_path = path.rsplit('.', 1)[0] + '.csv'
+
+    records, header = read_recording(path)
+    with open(csv_path, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile)
+        writer.writerow([CSV_NAMES[name] for name in records.dtype.names])
+        writer.writerows(records.tolist())
+    return csv_path
@@ -1,5 +1,3 @@
-from smbus import SMBus
-
 BUS = 1
 
 # slave addresses per i2cdetect
@@ -9,11 +7,15 @@ PULSEOX_ADDR = 0x57
 MODE_CONFIG = 0x09
 
 class MAX30101():
-    def __init__(self):
+    def __init__(self, bus=None):
         """
         set up for pulseOx mode
+        bus: smbus-like object, default SMBus(BUS)
         """
-        self.bus = SMBus(BUS)
+        if bus is None:
+            from smbus import SMBus
+            bus = SMBus(BUS)
+        self.bus = bus
 
     def reset(self):
         """
@@ -23,5 +25,6 @@ class MAX30101():
         reset_byte |= 0x40
         self.bus.write_byte_data(PULSEOX_ADDR, MODE_CONFIG, reset_byte) 
         
-dev = MAX30101()
-dev.reset()
\ No newline at end of file
+if __name__ == '__main__':
+    dev = MAX30101()
+    dev.reset()
\ No newline at end of file
@@ -0,0 +1,266 @@
+### several MAX30101s at once -- the chip's i2c address is fixed (0x57), so each sensor needs a bus of its own or a
+### channel of an i2c multiplexer (TCA9548A). One worker thread per bus drains its sensors' FIFOs in turn, and the
+### buses run in parallel
+#
+# eg.
+# array = SensorArray()
+# array.open('finger', bus=1, mode='spo2')
+# mux = array.mux(3)
+# array.open('wrist', bus=mux.channel(0), mode='spo2')
+# array.open('forearm', bus=mux.channel(1), mode='spo2')
+# merged = array.merged()
+# array.start()
+# times, rows = merged.read()      # rows['wrist'][i] is the wrist sample at times[i]
+# array.stop()
+import threading
+import time
+import numpy as np
+from acquisition import MAX30101Source, RingBuffer, RingReader
+from align import StreamAligner
+from MAX30101 import MAX30101, FIFO_DEPTH
+
+# default address of a TCA9548A
+MUX_ADDR = 0x70
+
+class I2CMux():
+    """
+    TCA9548A i2c multiplexer: up to 8 downstream channels, each of which can have its own device at the same address.
+    channel(n) returns an smbus-like object for channel n that connects it before every transfer (skipped if it's
+    already the connected one). Transfers through the mux are serialized with a lock, so the channel can't change in
+    the middle of one
+    """
+    def __init__(self, bus, address=MUX_ADDR):
+        """
+        bus: smbus-like object for the bus the mux sits on
+        """
+        self.bus = bus
+        self.address = address
+        self.lock = threading.Lock()
+        self.selected = None
+        self.selects = 0
+
+    def select(self, channel):
+        if channel != self.selected:
+            # invalidated first, so a failed write gets retried next time
+            self.selected = None
+            self.bus.write_byte(self.address, 1 << channel)
+            self.selected = channel
+            self.selects += 1
+
+    def channel(self, channel):
+        if not 0 <= channel <= 7:
+            raise ValueError('TCA9548A channels are 0-7')
+        return MuxChannel(self, channel)
+
+class MuxChannel():
+    """
+    smbus-like view of one channel of an I2CMux
+    """
+    def __init__(self, mux, channel):
+        self.mux = mux
+        self.channel = channel
+        # the physical bus, shared with every other channel of the mux
+        self.bus = mux.bus
+
+    def read_byte_data(self, addr, register):
+        with self.mux.lock:
+            self.mux.select(self.channel)
+            return self.bus.read_byte_data(addr, register)
+
+    def write_byte_data(self, addr, register, value):
+        with self.mux.lock:
+            self.mux.select(self.channel)
+            self.bus.write_byte_data(addr, register, value)
+
+    def read_i2c_block_data(self, addr, register, length=32):
+        with self.mux.lock:
+            self.mux.select(self.channel)
+            return self.bus.read_i2c_block_data(addr, register, length)
+
+    def write_i2c_block_data(self, addr, register, values):
+        with self.mux.lock:
+            self.mux.select(self.channel)
+            self.bus.write_i2c_block_data(addr, register, values)
+
+class ArraySensor():
+    """
+    One sensor in a SensorArray: its timestamping source, ring buffer and drain schedule
+    """
+    def __init__(self, name, sensor, capacity):
+        self.name = name
+        self.sensor = sensor
+        self.source = MAX30101Source(sensor)
+        self.ring = RingBuffer(capacity, sensor.channels, MAX30101Source.dtype)
+        self.readers = []
+        # monotonic time of the next drain
+        self.due = 0.0
+        self.samples = 0
+        self.errors = 0
+        # FIFO fill level (samples) found at each drain, as counts per level
+        self.fill = np.zeros(FIFO_DEPTH + 1, dtype=np.int64)
+
+class BusWorker(threading.Thread):
+    """
+    Drains every sensor on one bus. Each sensor is read when its FIFO should be about fill of the way full (judged
+    from its output rate and when it was last read), so slow and fast sensors share the bus without any of them
+    overflowing and without polling the empty ones
+    """
+    def __init__(self, name, sensors, fill=0.5):
+        super().__init__(name=name, daemon=True)
+        self.sensors = sensors
+        self.fill = fill
+        self.stopped = threading.Event()
+        self.drains = 0
+
+    def drain(self, entry):
+        sensor = entry.sensor
+        try:
+            times, rows = entry.source.stamp(sensor.read_available())
+        except OSError:
+            entry.errors += 1
+            # try again once there's a little more data
+            entry.due = time.monotonic() + 0.1 * FIFO_DEPTH * self.fill / sensor.output_rate()
+            return
+        self.drains += 1
+        entry.fill[min(len(rows), FIFO_DEPTH)] += 1
+        if len(rows):
+            entry.ring.write(times, rows)
+            entry.samples += len(rows)
+        entry.due = sensor.status_time + FIFO_DEPTH * self.fill / sensor.output_rate()
+
+    def run(self):
+        now = time.monotonic()
+        for entry in self.sensors:
+            entry.due = now
+        while not self.stopped.is_set():
+            entry = min(self.sensors, key=lambda entry: entry.due)
+            wait = entry.due - time.monotonic()
+            if wait > 0:
+                self.stopped.wait(wait)
+                continue
+            self.drain(entry)
+
+    def stop(self):
+        self.stopped.set()
+
+class SensorArray():
+    """
+    Runs several MAX30101s, with one BusWorker thread per physical bus (every channel of a multiplexer is on its
+    parent's bus). Each sensor gets its own ring buffer, read with reader(name) like acquisition.Acquisition, and
+    merged() lines all of them up on one timeline.
+    """
+    def __init__(self, capacity=4096, fill=0.5):
+        """
+        capacity: number of rows each sensor's ring buffer holds
+        fill: FIFO fill level (fraction of its 32 samples) to drain each sensor at; lower leaves more slack for a
+        busy bus, higher means fewer, bigger transfers
+        """
+        self.capacity = capacity
+        self.fill = fill
+        self.sensors = {}
+        # sensors per physical bus, and the SMBus opened for each bus number
+        self.buses = {}
+        self.smbus = {}
+        self.workers = []
+        self.start_time = None
+
+    def open_bus(self, number):
+        """
+        Returns the SMBus for a bus number, opening it the first time
+        """
+        if number not in self.smbus:
+            from smbus import SMBus
+            self.smbus[number] = SMBus(number)
+        return self.smbus[number]
+
+    def mux(self, bus=1, address=MUX_ADDR):
+        """
+        Returns an I2CMux on bus (a bus number or smbus-like object)
+        """
+        return I2CMux(self.open_bus(bus) if isinstance(bus, int) else bus, address)
+
+    def open(self, name, bus=1, **settings):
+        """
+        Creates a MAX30101 on bus (a bus number, a mux channel or any smbus-like object) with settings as for
+        MAX30101(), and adds it
+        """
+        if isinstance(bus, int):
+            bus = self.open_bus(bus)
+        return self.add(name, MAX30101(bus=bus, **settings))
+
+    def add(self, name, sensor):
+        """
+        Adds an already set up MAX30101. Sensors are grouped by the bus they're on
+        """
+        if name in self.sensors:
+            raise ValueError(f'there is already a sensor called {name!r}')
+        entry = ArraySensor(name, sensor, self.capacity)
+        self.sensors[name] = entry
+        # a mux channel's physical bus is its parent's
+        bus = getattr(sensor.bus, 'bus', sensor.bus)
+        self.buses.setdefault(id(bus), []).append(entry)
+        return sensor
+
+    def reader(self, name):
+        """
+        Returns a new RingReader on the named sensor, starting from the newest row
+        """
+        entry = self.sensors[name]
+        reader = RingReader(entry.ring)
+        entry.readers.append(reader)
+        return reader
+
+    def merged(self, rate=None, max_latency=0.5):
+        """
+        Returns a MergedReader over every sensor, resampled to rate Hz (default: the fastest sensor's output rate)
+        """
+        if rate is None:
+            rate = max(entry.sensor.output_rate() for entry in self.sensors.values())
+        return MergedReader(self, rate, max_latency)
+
+    def start(self):
+        self.start_time = time.monotonic()
+        self.workers = [BusWorker(f'bus {i}', sensors, self.fill) for i, sensors in enumerate(self.buses.values())]
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        for worker in self.workers:
+            worker.stop()
+        for worker in self.workers:
+            worker.join()
+
+    def counters(self):
+        """
+        Returns {sensor name: {'samples', 'errors', 'device_drops', 'overruns', 'fill'}}: device_drops are samples lost
+        to FIFO overflow, overruns are rows overwritten before a reader got to them, fill is the histogram of FIFO
+        levels found at each drain (index = samples in the FIFO)
+        """
+        counters = {}
+        for name, entry in self.sensors.items():
+            counters[name] = {
+                'samples' : entry.samples,
+                'errors' : entry.errors,
+                'device_drops' : entry.sensor.overflow_count,
+                'overruns' : sum(reader.overruns for reader in entry.readers),
+                'fill' : entry.fill.copy(),
+            }
+        return counters
+
+class MergedReader():
+    """
+    Reads every sensor of a SensorArray and lines them up on one uniform timeline (see align.StreamAligner)
+    """
+    def __init__(self, array, rate, max_latency=0.5):
+        self.readers = {name : array.reader(name) for name in array.sensors}
+        self.aligner = StreamAligner(rate=rate, max_latency=max_latency)
+        for name in self.readers:
+            self.aligner.add_stream(name)
+
+    def read(self):
+        """
+        Returns tuple (times, {sensor name: (N, channels) array}) of everything that's ready, oldest first
+        """
+        for name, reader in self.readers.items():
+            self.aligner.push(name, *reader.read())
+        return self.aligner.pull()
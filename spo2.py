@@ -0,0 +1,222 @@
+### SpO2 estimation from the reflection pulseOx's red and ir channels
+#
+# the R ratio and calibration curves are the ones used in processing/clean_signal_tests, StreamingSpO2 computes them
+# incrementally (O(1) per sample) instead of redoing SSA + bandpass on a full window for every output sample
+import numpy as np
+from scipy import signal
+from filters import StreamingBandpass
+from quality import SignalQuality
+
+def linear_spo2(R):
+    """
+    Linear calibration curve
+    """
+    return 104 - 17 * R
+
+def quadratic_spo2(R):
+    """
+    Quadratic calibration curve
+    """
+    a = 1.5958422
+    b = -34.6596622
+    c = 112.6898759
+    return a * (R**2) + b * R + c
+
+def rms_ratio(red_ac, red_dc, ir_ac, ir_dc):
+    """
+    R ratio from ac/dc components, as in the sliding_window_rms notebook. Works over the last axis, so it takes a
+    single window or a stack of windows
+    """
+    red_amp = np.sqrt(2) * np.sqrt(np.mean(red_ac ** 2, axis=-1))
+    ir_amp = np.sqrt(2) * np.sqrt(np.mean(ir_ac ** 2, axis=-1))
+
+    redRatio = (red_amp * 2) / np.mean(red_dc - red_amp[..., None], axis=-1)
+    irRatio = (ir_amp * 2) / np.mean(ir_dc - ir_amp[..., None], axis=-1)
+    return redRatio / irRatio
+
+def decaying_max(x, start, decay):
+    """
+    Running envelope p[k] = max(x[k], decay * p[k - 1]) along axis 0, with p[-1] = start, computed without a python
+    loop. Returns the envelope
+    """
+    out = np.empty_like(x)
+    # decay ** -n grows with n, so work in blocks to keep it in a safe range
+    block = 256
+    scale = decay ** -np.arange(block, dtype=np.float64)
+    for i in range(0, len(x), block):
+        chunk = x[i:i + block]
+        n = len(chunk)
+        s = scale[:n].reshape((-1,) + (1,) * (x.ndim - 1))
+        running = np.maximum.accumulate(chunk * s, axis=0)
+        running = np.maximum(running, start * decay)
+        out[i:i + n] = running / s
+        start = out[i + n - 1]
+    return out
+
+class StreamingSpO2():
+    """
+    Incremental SpO2 estimator. Feed it batches of (red, ir) samples, as they come off the MAX30101 or out of a
+    recording, and it returns linear and quadratic SpO2 estimates for every sample.
+
+    dc is tracked with a one-pole low pass, ac is the bandpassed signal (same band as the notebooks), and the RMS of ac
+    over the last window samples (method='rms', a running sum) or its peak-to-peak envelope (method='peak') stands in
+    for the per-window statistics. All of the filters carry their state between calls, so each sample costs the same
+    no matter the window size.
+
+    With min_quality set, the last window of samples is scored by a quality.SignalQuality first and estimates are NaN
+    wherever it scores below min_quality, rather than readings off a detached or moving sensor. A batch with nothing
+    usable in it skips the estimation altogether, and the filters start afresh once the signal is back.
+    """
+    def __init__(self, sample_rate=25, window=100, method='rms', cutoff=(.7, 4), order=4, min_quality=None):
+        """
+        sample_rate: effective sample rate in Hz (sample rate / samples averaged)
+        window: number of samples the running statistics cover, like window_size in the notebooks
+        min_quality: signal quality score an estimate needs (default: no gating). Samples have to be raw ADC values for
+        this
+        """
+        self.sample_rate = sample_rate
+        self.window = window
+        self.method = method
+
+        # dc: one-pole low pass with a time constant of half a window (like L = window_size // 2 in the notebooks)
+        alpha = 1 - np.exp(-2 / window)
+        self.dc_ba = ([alpha], [1, alpha - 1])
+        self.decay = np.exp(-1 / window)
+
+        self.bandpass = StreamingBandpass(sample_rate, cutoff, order)
+        self.quality = None
+        if min_quality is not None:
+            # scored once a second, which is plenty to catch a detached or moving sensor and keeps the gate cheap
+            self.quality = SignalQuality(sample_rate, window=window / sample_rate, hop=1, threshold=min_quality)
+            self.last_score = np.nan
+
+        self.count = 0
+        self.dc_zi = None
+
+    def reset_state(self, first):
+        """
+        Starts all filters in steady state at the first sample, which avoids a long start up transient
+        """
+        channels = len(first)
+        self.dc_zi = signal.lfilter_zi(*self.dc_ba)[:, None] * first
+        self.bandpass.zi = None
+        # sample count at the (re)start, the estimates settle for a window from here
+        self.started = self.count
+        # ac^2 of the last window samples and their running sum
+        self.history = np.zeros((self.window, channels))
+        self.total = np.zeros(channels)
+        self.pos = 0
+        self.since_refresh = 0
+        self.peak = np.zeros(channels)
+        self.trough = np.zeros(channels)
+
+    def process(self, batch, finger_out=None):
+        """
+        batch: (N, 2) array of red, ir samples (extra columns, eg. green, are ignored)
+        finger_out: the transmission pulseOx's finger out flag for each sample, for the quality gate
+
+        Returns tuple (linear SpO2, quadratic SpO2), each a length N array. Estimates are NaN until one window of
+        samples has gone by
+        """
+        x = np.asarray(batch, dtype=np.float64)[:, :2]
+        if len(x) == 0:
+            return (np.empty(0), np.empty(0))
+        low = None
+        if self.quality is not None:
+            index, score, _ = self.quality.process(x, finger_out)
+            # each sample goes by the latest score up to it. NaN scores (the quality window is still filling) don't
+            # hold anything back
+            latest = np.concatenate(([self.last_score], score))
+            self.last_score = latest[-1]
+            low = latest[np.searchsorted(index, self.count + np.arange(1, len(x) + 1), side='right')] < self.quality.threshold
+            if low.all():
+                self.dc_zi = None
+                self.count += len(x)
+                return (np.full(len(x), np.nan), np.full(len(x), np.nan))
+        if self.dc_zi is None:
+            self.reset_state(x[0])
+
+        dc, self.dc_zi = signal.lfilter(*self.dc_ba, x, axis=0, zi=self.dc_zi)
+        ac = self.bandpass.process(x)
+
+        if self.method == 'peak':
+            self.peak_env = decaying_max(ac, self.peak, self.decay)
+            self.trough_env = -decaying_max(-ac, -self.trough, self.decay)
+            self.peak = self.peak_env[-1]
+            self.trough = self.trough_env[-1]
+            # peak-to-peak over dc, as in the sliding_window_peak notebook
+            ratio = (self.peak_env - self.trough_env) / dc
+        else:
+            ms = self.mean_square(ac)
+            amp = np.sqrt(2) * np.sqrt(ms)
+            ratio = (amp * 2) / (dc - amp)
+
+        R = ratio[:, 0] / ratio[:, 1]
+        lin = linear_spo2(R)
+        quad = quadratic_spo2(R)
+
+        # the first window's worth of output is still settling
+        settling = max(0, min(len(x), self.started + self.window - self.count))
+        lin[:settling] = np.nan
+        quad[:settling] = np.nan
+        if low is not None:
+            lin[low] = np.nan
+            quad[low] = np.nan
+        self.count += len(x)
+        return (lin, quad)
+
+    def mean_square(self, ac):
+        """
+        Mean of ac^2 over the window up to each sample, as in the notebooks' sliding windows
+        """
+        square = ac ** 2
+        ms = np.empty_like(square)
+        # a batch longer than the window goes through in window sized steps, so the samples leaving are in history
+        for start in range(0, len(square), self.window):
+            step = square[start:start + self.window]
+            index = (self.pos + np.arange(len(step))) % self.window
+            running = self.total + np.cumsum(step - self.history[index], axis=0)
+            self.history[index] = step
+            self.pos = (self.pos + len(step)) % self.window
+            self.total = running[-1]
+            ms[start:start + len(step)] = running / self.window
+
+            self.since_refresh += len(step)
+            if self.since_refresh >= self.window:
+                # exact sum, so rounding errors in the running one don't build up
+                self.total = self.history.sum(axis=0)
+                self.since_refresh = 0
+        # rounding can leave a window of zeros a hair below 0
+        return np.maximum(ms, 0)
+
+def spo2_from_recording(path, sample_rate=None, window=100, method='rms', chunk_size=4096, min_quality=None):
+    """
+    Runs StreamingSpO2 over a .pox or .csv recording. Returns tuple (time, linear SpO2, quadratic SpO2).
+    sample_rate overrides the recording's own (see recording.recording_sample_rate). min_quality turns on the quality
+    gate, which also goes by the recording's CMS50D finger out flag when it has one
+    """
+    from recording import load_recording, recording_sample_rate
+    from quality import records_finger_out
+    records = load_recording(path)
+    if sample_rate is None:
+        sample_rate = recording_sample_rate(path, records)
+
+    estimator = StreamingSpO2(sample_rate, window, method, min_quality=min_quality)
+    lin = []
+    quad = []
+    for i in range(0, len(records), chunk_size):
+        chunk = records[i:i + chunk_size]
+        results = estimator.process(np.column_stack((chunk['red'], chunk['ir'])), records_finger_out(chunk))
+        lin.append(results[0])
+        quad.append(results[1])
+    return (np.asarray(records['time']), np.concatenate(lin), np.concatenate(quad))
+
+def spo2_from_sensor(sensor, sample_rate=25, window=100, method='rms'):
+    """
+    Generator over a live MAX30101: yields (batch, linear SpO2, quadratic SpO2) for every FIFO batch
+    """
+    estimator = StreamingSpO2(sample_rate, window, method)
+    while True:
+        batch = sensor.read_batch()
+        lin, quad = estimator.process(batch)
+        yield (batch, lin, quad)
@@ -0,0 +1,110 @@
+### batch singular spectrum analysis over every sliding window of a recording at once
+#
+# vectorized version of extract_acdc from the processing/clean_signal_tests notebooks: instead of building a new
+# pyts SingularSpectrumAnalysis per window, all trajectory matrices are strided views of the recording and the
+# leading component of a whole chunk of windows comes out of the same batched matrix products
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import signal
+from spo2 import rms_ratio, linear_spo2, quadratic_spo2
+
+def trajectory_matrices(windows, L):
+    """
+    windows: (..., W) array of windows. Returns an (..., L, W - L + 1) view of each window's trajectory matrix
+    (no copy)
+    """
+    return np.swapaxes(sliding_window_view(windows, L, axis=-1), -1, -2)
+
+def leading_component(windows, L, tol=1e-10, max_iter=100):
+    """
+    Reconstructs the first (largest singular value) SSA component of each window, ie. the dc part. windows is
+    (..., W); returns an array of the same shape
+    """
+    W = windows.shape[-1]
+    K = W - L + 1
+    X = trajectory_matrices(windows, L)
+
+    # the leading left singular vector is the top eigenvector of X X^T. PPG windows are dominated by their dc level,
+    # so power iteration started from a flat vector converges in a handful of steps, far quicker than eigh on every
+    # window
+    C = X @ np.swapaxes(X, -1, -2)
+    u = np.full(C.shape[:-1], 1 / np.sqrt(L))
+    for i in range(max_iter):
+        u_next = np.einsum('...ij,...j->...i', C, u)
+        u_next /= np.linalg.norm(u_next, axis=-1, keepdims=True)
+        converged = np.max(np.abs(u_next - u)) < tol
+        u = u_next
+        if converged:
+            break
+    # rank 1 approximation is outer(u, w)
+    w = np.einsum('...l,...lk->...k', u, X)
+
+    # diagonal averaging of outer(u, w): anti-diagonal sums are the convolution of u and w (length L + K - 1 = W,
+    # so a length W circular convolution doesn't wrap), divided by the number of terms on each anti-diagonal
+    sums = np.fft.irfft(np.fft.rfft(u, W, axis=-1) * np.fft.rfft(w, W, axis=-1), W, axis=-1)
+    k = np.arange(W)
+    counts = np.minimum(np.minimum(k + 1, W - k), min(L, K))
+    return sums / counts
+
+def bandpass_windows(windows, sample_rate, cutoff=(.7, 4), order=4):
+    """
+    Zero phase Butterworth bandpass along the last axis, the same filter hp.filter_signal applies in the notebooks
+    """
+    nyq = sample_rate / 2
+    b, a = signal.butter(order, [cutoff[0] / nyq, cutoff[1] / nyq], btype='bandpass')
+    return signal.filtfilt(b, a, windows, axis=-1)
+
+def iter_acdc(F, window_size, L, sample_rate=None, cutoff=(.7, 4), order=4, chunk_size=256, windows=None):
+    """
+    Decomposes every window_size long sliding window of F into dc and ac, chunk_size windows at a time to bound memory.
+
+    F: (N,) signal or (N, channels) recording (eg. red and ir columns together)
+    sample_rate: if given, ac is bandpassed like in the notebooks; otherwise ac is the raw sum of the other components
+    windows: if given, indices of the only windows to decompose (eg. the ones quality.window_quality passed)
+
+    Yields tuples (index of first window, dc, ac), where dc and ac are (windows, [channels,] window_size). Window i
+    covers F[i:i + window_size]; with windows given, the index is into windows instead
+    """
+    F = np.asarray(F, dtype=np.float64)
+    # (N - window_size + 1, [channels,] window_size) view, no copy
+    view = sliding_window_view(F, window_size, axis=0)
+    count = len(view) if windows is None else len(windows)
+    for start in range(0, count, chunk_size):
+        if windows is None:
+            chunk = view[start:start + chunk_size]
+        else:
+            chunk = view[windows[start:start + chunk_size]]
+        dc = leading_component(chunk, L)
+        # all the components add up to the original signal, so the rest of them is just what's left over
+        ac = chunk - dc
+        if sample_rate is not None:
+            ac = bandpass_windows(ac, sample_rate, cutoff, order)
+        yield (start, dc, ac)
+
+def extract_acdc_batch(F, window_size, L, sample_rate=None, cutoff=(.7, 4), order=4, chunk_size=256, windows=None):
+    """
+    Same as iter_acdc, but returns all of the windows at once as tuple (dc, ac)
+    """
+    F = np.asarray(F, dtype=np.float64)
+    dc = []
+    ac = []
+    for _, dc_chunk, ac_chunk in iter_acdc(F, window_size, L, sample_rate, cutoff, order, chunk_size, windows):
+        dc.append(dc_chunk)
+        ac.append(ac_chunk)
+    if not dc:
+        empty = np.empty((0,) + F.shape[1:] + (window_size,))
+        return (empty, empty.copy())
+    return (np.concatenate(dc), np.concatenate(ac))
+
+def sliding_spo2(red_ir, window_size=100, L=None, sample_rate=25, cutoff=(.7, 4), order=4, chunk_size=256):
+    """
+    SpO2 for every sliding window of a (N, 2) red, ir recording, as in the sliding_window_rms notebook.
+    Returns tuple (linear SpO2, quadratic SpO2), one value per window (window i covers red_ir[i:i + window_size])
+    """
+    if L is None:
+        L = window_size // 2
+    R = []
+    for _, dc, ac in iter_acdc(red_ir, window_size, L, sample_rate, cutoff, order, chunk_size):
+        R.append(rms_ratio(ac[:, 0], dc[:, 0], ac[:, 1], dc[:, 1]))
+    R = np.concatenate(R)
+    return (linear_spo2(R), quadratic_spo2(R))
@@ -0,0 +1,80 @@
+import numpy as np
+import pytest
+from acquisition import RingBuffer, RingReader, SampleClock
+from emulator import EmulatedMAX30101Bus, ManualClock
+from MAX30101 import MAX30101
+
+def rows(first, n):
+    return (np.arange(first, first + n, dtype=np.float64), np.arange(first, first + n)[:, None] * [1, -1])
+
+def test_ring_wraparound():
+    ring = RingBuffer(10, 2, dtype=np.int64)
+    reader = RingReader(ring)
+    seen = []
+    for n in [3, 7, 4, 9, 1, 10, 6]:
+        ring.write(*rows(ring.write_count, n))
+        times, data = reader.read()
+        # any span of up to capacity rows comes back as one contiguous view, wherever it wraps
+        assert np.shares_memory(data, ring.data)
+        seen.append(data[:, 0].copy())
+        assert (times == data[:, 0]).all() and (data[:, 1] == -data[:, 0]).all()
+    assert (np.concatenate(seen) == np.arange(ring.write_count)).all()
+    assert reader.overruns == 0
+
+def test_ring_latest():
+    ring = RingBuffer(8, 2, dtype=np.int64)
+    ring.write(*rows(0, 5))
+    assert ring.latest(10)[1][:, 0].tolist() == list(range(5))
+    ring.write(*rows(5, 6))
+    assert ring.latest(3)[1][:, 0].tolist() == [8, 9, 10]
+    assert ring.latest(100)[1][:, 0].tolist() == list(range(3, 11))
+    times, data = ring.snapshot(4)
+    ring.write(*rows(11, 8))
+    assert data[:, 0].tolist() == [7, 8, 9, 10]
+
+def test_ring_reader_overrun():
+    ring = RingBuffer(10, 2, dtype=np.int64)
+    reader = RingReader(ring)
+    ring.write(*rows(0, 6))
+    assert reader.read(4)[1][:, 0].tolist() == [0, 1, 2, 3]
+    # the producer laps the reader: rows 4-7 are overwritten before it gets to them
+    ring.write(*rows(6, 6))
+    ring.write(*rows(12, 6))
+    assert reader.available() == 10
+    assert reader.read()[1][:, 0].tolist() == list(range(8, 18))
+    assert reader.overruns == 4
+    assert reader.read()[1].shape == (0, 2)
+
+def test_ring_oversized_batch():
+    ring = RingBuffer(10, 2, dtype=np.int64)
+    reader = RingReader(ring)
+    ring.write(*rows(0, 25))
+    assert ring.dropped == 15
+    assert reader.read()[1][:, 0].tolist() == list(range(15, 25))
+    assert reader.overruns == 0
+
+@pytest.mark.parametrize('clock_error', [0.0, 0.01, -0.02])
+def test_sample_clock_rate(clock_error):
+    clock = ManualClock()
+    bus = EmulatedMAX30101Bus(clock=clock, clock_error=clock_error)
+    pulseOx = MAX30101(bus=bus)
+    rate = bus.effective_rate()
+    sample_clock = SampleClock(pulseOx.output_rate())
+    rng = np.random.default_rng(0)
+
+    times = []
+    for _ in range(600):
+        clock.advance(rng.uniform(0.05, 0.15))
+        batch = pulseOx.drain_fifo()
+        # the read lands in python a little (and unpredictably) after the FIFO pointers were read
+        t = clock() + rng.exponential(0.005)
+        times.append(sample_clock.stamp(pulseOx.samples_read + pulseOx.overflow_count, len(batch), t))
+    times = np.concatenate(times)
+
+    assert abs(1 / sample_clock.period / rate - 1) < 2e-4
+    assert sample_clock.resyncs == 0
+    assert (np.diff(times) >= 0).all()
+    # sample k is taken at (k + 1) / rate; once the fit has settled the timestamps are within a few ms of that
+    k = np.arange(len(times))
+    settled = times > sample_clock.min_span * 2
+    assert np.abs(times - (k + 1) / rate)[settled].max() < 0.01
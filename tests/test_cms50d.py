@@ -0,0 +1,70 @@
+import itertools
+import numpy as np
+import pytest
+from CMS50D import CMS50D, CMS50DParser, PACKET_SIZE, finger_out
+from emulator import EmulatedCMS50DPort, ManualClock
+
+def feed_chunks(data, sizes):
+    """
+    Feeds data to a new parser in chunks of the given sizes (over and over), returns (parser, all decoded packets)
+    """
+    parser = CMS50DParser()
+    out = []
+    pos = 0
+    for size in itertools.cycle(sizes):
+        if pos >= len(data):
+            break
+        out.append(parser.feed(data[pos:pos + size]))
+        pos += size
+    return (parser, np.concatenate(out))
+
+@pytest.mark.parametrize('byte_loss', [0.0, 0.02])
+def test_chunking_invariance(byte_loss):
+    data = EmulatedCMS50DPort(byte_loss=byte_loss).packets(0, 500)
+    whole, expected = feed_chunks(data, [len(data)])
+    if byte_loss:
+        # lost bytes cost the packets they were part of, not the ones after
+        assert 300 < len(expected) < 500 and whole.framing_errors > 0
+    else:
+        assert len(expected) == 500 and whole.framing_errors == 0
+
+    rng = np.random.default_rng(1)
+    for sizes in ([1], [PACKET_SIZE], [4, 13], [PACKET_SIZE - 1, PACKET_SIZE + 1], rng.integers(0, 40, 200).tolist()):
+        parser, packets = feed_chunks(data, sizes)
+        np.testing.assert_array_equal(packets, expected)
+        assert parser.packets == whole.packets
+        assert parser.framing_errors == whole.framing_errors
+
+def test_values():
+    port = EmulatedCMS50DPort(heart_rate=64, spo2=95)
+    parser = CMS50DParser()
+    packets = parser.feed(port.packets(0, 120))
+    assert packets.shape == (120, 3)
+    assert (packets[:, 0] == 64).all() and (packets[:, 1] == 95).all()
+    assert ((packets[:, 2] >= 0) & (packets[:, 2] <= 100)).all()
+    assert not finger_out(packets).any()
+
+def test_resync_after_lost_bytes():
+    data = bytearray(EmulatedCMS50DPort().packets(0, 10))
+    # the middle of packet 3 and all of packet 4 go missing
+    del data[3 * PACKET_SIZE + 4:5 * PACKET_SIZE]
+    parser = CMS50DParser()
+    packets = parser.feed(bytes(data))
+    assert len(packets) == 8
+    assert parser.framing_errors == 4
+
+def test_finger_out():
+    port = EmulatedCMS50DPort(rate=60, finger_out=[(1, 2)])
+    packets = CMS50DParser().feed(port.packets(0, 180))
+    out = finger_out(packets)
+    assert not out[:60].any() and out[60:120].all() and not out[120:].any()
+
+def test_get_data():
+    clock = ManualClock()
+    port = EmulatedCMS50DPort(clock=clock)
+    pulseOx = CMS50D(port=port)
+    assert port.handshakes == 1
+    clock.advance(1)
+    readings = [pulseOx.get_data() for _ in range(100)]
+    assert all(bpm == 72 and spo2 == 97 for bpm, spo2, _ in readings)
+    assert pulseOx.parser.framing_errors == 0
@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+from scipy import signal
+from emulator import synthetic_ppg
+from filters import StreamingBandpass, design_bandpass, settling_samples
+
+def ppg(n, sample_rate=25):
+    return 1000 * synthetic_ppg(np.arange(n) / sample_rate, seed=0)
+
+def batches(x, sizes):
+    pos = 0
+    for size in sizes:
+        yield x[pos:pos + size]
+        pos += size
+    yield x[pos:]
+
+@pytest.mark.parametrize('sample_rate', [25, 50])
+def test_causal_matches_sosfilt(sample_rate):
+    x = ppg(2000, sample_rate)
+    bandpass = StreamingBandpass(sample_rate)
+    rng = np.random.default_rng(0)
+    # arbitrary batch sizes, including empty batches and single samples
+    out = np.concatenate([bandpass.process(batch) for batch in batches(x, rng.integers(0, 60, 60))])
+
+    sos = design_bandpass(sample_rate)
+    # the streaming filter starts in steady state at the first sample
+    expected, _ = signal.sosfilt(sos, x, axis=0, zi=signal.sosfilt_zi(sos)[:, :, None] * x[0])
+    assert out.shape == x.shape
+    np.testing.assert_allclose(out, expected, rtol=0, atol=1e-9 * np.abs(x).max())
+    assert bandpass.emitted == len(x)
+
+def test_one_channel():
+    # a 1-D batch comes back 1-D
+    x = ppg(500)[:, 1]
+    assert StreamingBandpass(25).process(x).shape == x.shape
+    assert StreamingBandpass(25).process(x[:0]).shape == (0,)
+    bandpass = StreamingBandpass(25)
+    np.testing.assert_allclose(np.concatenate([bandpass.process(batch) for batch in batches(x, [7, 93, 250])]),
+                               StreamingBandpass(25).process(x))
+
+def test_zero_phase_matches_filtfilt():
+    x = ppg(3000)
+    bandpass = StreamingBandpass(25, mode='zero_phase')
+    out = [bandpass.process(batch) for batch in batches(x, [40] * 74)]
+    out = np.concatenate(out + [bandpass.flush()])
+    assert out.shape == x.shape and bandpass.emitted == len(x)
+
+    sos = design_bandpass(25)
+    expected = signal.sosfiltfilt(sos, x, axis=0)
+    # away from the ends (where filtfilt pads the signal instead), the backward passes have settled
+    middle = slice(settling_samples(sos), -settling_samples(sos))
+    ac = np.abs(expected[middle]).max()
+    np.testing.assert_allclose(out[middle], expected[middle], rtol=0, atol=5e-3 * ac)
+
+def test_unknown_mode():
+    with pytest.raises(ValueError):
+        StreamingBandpass(25, mode='acausal')
@@ -0,0 +1,99 @@
+import numpy as np
+from emulator import EmulatedMAX30101Bus, ManualClock
+from MAX30101 import MAX30101, decode_fifo, ADC_MASK, FIFO_DEPTH
+
+def sequential(n):
+    """
+    Replay records whose red is the sample number and ir is the sample number + 100000, so every sample read back
+    says which one it was
+    """
+    records = np.zeros(n, dtype=[('red', np.uint32), ('ir', np.uint32)])
+    records['red'] = np.arange(n)
+    records['ir'] = np.arange(n) + 100000
+    return records
+
+def sensor(**settings):
+    clock = ManualClock()
+    bus = EmulatedMAX30101Bus(clock=clock, replay=sequential(1 << 16))
+    # default settings: 100 samples/s averaged 4 times, so a sample every 40 ms
+    return (clock, bus, MAX30101(bus=bus, **settings))
+
+def test_decode_fifo_masks_unused_bits():
+    # the top 6 bits of each 3 byte sample aren't part of the reading
+    buf = bytes([0xFF, 0xFF, 0xFF, 0xC0, 0x00, 0x01, 0x03, 0x12, 0x34])
+    samples = decode_fifo(buf, 3)
+    assert samples.dtype == np.uint32
+    assert samples.tolist() == [[ADC_MASK, 1, 0x31234]]
+
+def test_decode_fifo_input_types():
+    buf = [0x01, 0x02, 0x03, 0xFC, 0x05, 0x06, 0x07]
+    expected = [[0x010203, 0x000506]]
+    # a trailing byte that isn't a whole sample is ignored
+    assert decode_fifo(buf, 2).tolist() == expected
+    assert decode_fifo(bytes(buf), 2).tolist() == expected
+    assert decode_fifo(memoryview(bytearray(buf)), 2).tolist() == expected
+    assert decode_fifo(b'', 2).shape == (0, 2)
+
+def test_drain_fifo_wrapped_pointers():
+    clock, bus, pulseOx = sensor()
+    batches = []
+    # 17 samples per read, so the pointers wrap around the 32 slot FIFO at a different place every time
+    for _ in range(40):
+        clock.advance(17 * 0.04 + 0.001)
+        batches.append(pulseOx.drain_fifo())
+    samples = np.concatenate(batches)
+    assert len(samples) > 20 * FIFO_DEPTH
+    assert (samples[:, 0] == np.arange(len(samples))).all()
+    assert (samples[:, 1] == samples[:, 0] + 100000).all()
+    assert pulseOx.overflow_count == 0
+    assert pulseOx.samples_read == len(samples)
+
+def test_drain_fifo_full():
+    clock, bus, pulseOx = sensor()
+    pulseOx.drain_fifo()
+    # one more than fits: the oldest is pushed out and the pointers are equal again, which has to read as full
+    clock.advance((FIFO_DEPTH + 1) * 0.04 + 0.001)
+    samples = pulseOx.drain_fifo()
+    assert samples[:, 0].tolist() == list(range(1, FIFO_DEPTH + 1))
+    assert pulseOx.overflow_count == 1
+
+def test_drain_fifo_overflow():
+    clock, bus, pulseOx = sensor()
+    clock.advance(10 * 0.04 + 0.001)
+    assert pulseOx.drain_fifo()[:, 0].tolist() == list(range(10))
+
+    # rollover is on, so the FIFO keeps the newest samples and counts the ones it lost
+    clock.advance(50 * 0.04)
+    samples = pulseOx.drain_fifo()
+    assert samples[:, 0].tolist() == list(range(60 - FIFO_DEPTH, 60))
+    assert pulseOx.overflow_count == 50 - FIFO_DEPTH
+
+    # and carries on from there
+    clock.advance(5 * 0.04)
+    assert pulseOx.drain_fifo()[:, 0].tolist() == list(range(60, 65))
+    assert pulseOx.samples_read + pulseOx.overflow_count == 65
+
+def test_drain_fifo_overflow_without_rollover():
+    clock, bus, pulseOx = sensor()
+    pulseOx.set_overflow(0)
+    # the FIFO fills up and then drops the new samples
+    clock.advance(40 * 0.04 + 0.001)
+    samples = pulseOx.drain_fifo()
+    assert samples[:, 0].tolist() == list(range(FIFO_DEPTH))
+    assert pulseOx.overflow_count == 40 - FIFO_DEPTH
+
+    clock.advance(5 * 0.04)
+    assert pulseOx.drain_fifo()[:, 0].tolist() == list(range(40, 45))
+
+def test_multi_mode_masks_replay():
+    clock = ManualClock()
+    records = sequential(100)
+    # values wider than the ADC come back masked to 18 bits
+    records['red'] |= 0xFC0000
+    bus = EmulatedMAX30101Bus(clock=clock, replay=records)
+    pulseOx = MAX30101(mode='multi', bus=bus)
+    clock.advance(10 * 0.04 + 0.001)
+    samples = pulseOx.drain_fifo()
+    assert samples.shape == (10, 3)
+    assert samples[:, 0].tolist() == list(range(10))
+    assert (samples[:, 2] == 0).all()
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+from emulator import EmulatedI2CMux, EmulatedMAX30101Bus, ManualClock
+from MAX30101 import MAX30101, PULSEOX_ADDR, PART_ID
+from sensor_array import I2CMux, SensorArray, BusWorker
+
+def replay(offset, n=1000):
+    records = np.zeros(n, dtype=[('red', np.uint32), ('ir', np.uint32)])
+    records['red'] = offset + np.arange(n)
+    records['ir'] = offset + np.arange(n)
+    return records
+
+def mux_sensors(channels):
+    """
+    MAX30101s behind one multiplexer, each replaying its own numbered samples (channel * 10000 + sample number)
+    """
+    clock = ManualClock()
+    devices = {channel : EmulatedMAX30101Bus(clock=clock, replay=replay(channel * 10000)) for channel in channels}
+    mux = I2CMux(EmulatedI2CMux(devices))
+    sensors = {channel : MAX30101(bus=mux.channel(channel)) for channel in channels}
+    return (clock, mux, sensors)
+
+def test_channels_reach_their_own_sensor():
+    clock, mux, sensors = mux_sensors([0, 3, 5])
+    clock.advance(10 * 0.04 + 0.001)
+    for channel, sensor in sensors.items():
+        samples = sensor.drain_fifo()
+        assert samples[:, 0].tolist() == list(channel * 10000 + np.arange(10))
+
+def test_select_only_on_channel_change():
+    clock, mux, sensors = mux_sensors([0, 1])
+    channel = mux.channel(0)
+    channel.read_byte_data(PULSEOX_ADDR, PART_ID)
+    selects = mux.selects
+    for _ in range(5):
+        assert channel.read_byte_data(PULSEOX_ADDR, PART_ID) == 0x15
+    assert mux.selects == selects
+    mux.channel(1).read_byte_data(PULSEOX_ADDR, PART_ID)
+    assert mux.selects == selects + 1
+    assert mux.bus.selects == mux.selects
+
+def test_mux_errors():
+    clock, mux, sensors = mux_sensors([0])
+    with pytest.raises(ValueError):
+        mux.channel(8)
+    # nothing on channel 2 to acknowledge
+    with pytest.raises(OSError):
+        mux.channel(2).read_byte_data(PULSEOX_ADDR, PART_ID)
+    # a failed transfer doesn't leave the mux thinking the channel is connected
+    assert mux.channel(0).read_byte_data(PULSEOX_ADDR, PART_ID) == 0x15
+
+def test_sensors_grouped_by_physical_bus():
+    clock, mux, sensors = mux_sensors([0, 1])
+    array = SensorArray(capacity=64)
+    array.add('wrist', sensors[0])
+    array.add('forearm', sensors[1])
+    array.add('finger', MAX30101(bus=EmulatedMAX30101Bus(clock=clock)))
+    assert sorted(len(entries) for entries in array.buses.values()) == [1, 2]
+    with pytest.raises(ValueError):
+        array.add('wrist', sensors[1])
+
+def test_drain():
+    clock, mux, sensors = mux_sensors([0, 1])
+    array = SensorArray(capacity=64)
+    array.add('wrist', sensors[0])
+    array.add('forearm', sensors[1])
+    reader = array.reader('forearm')
+    worker = BusWorker('bus', list(array.sensors.values()))
+
+    for _ in range(3):
+        clock.advance(12 * 0.04)
+        for entry in array.sensors.values():
+            worker.drain(entry)
+    times, data = reader.read()
+    assert data[:, 0].tolist() == list(10000 + np.arange(36))
+    # stamped from the real clock (the driver times its reads with time.monotonic), so only check they're in order
+    assert (np.diff(times) >= 0).all()
+
+    counters = array.counters()
+    assert counters['wrist']['samples'] == 36 and counters['wrist']['device_drops'] == 0
+    assert counters['forearm']['fill'][12] == 3
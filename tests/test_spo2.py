@@ -0,0 +1,37 @@
+import os
+import numpy as np
+import pytest
+from recording import load_recording
+from spo2 import StreamingSpO2
+from ssa import sliding_spo2
+
+DATA = os.path.join(os.path.dirname(__file__), '..', 'processing', 'data')
+
+def load(name):
+    # load_recording masks the ADC values, as read off the MAX30101
+    records = load_recording(os.path.join(DATA, name + '.csv'))
+    return np.column_stack((records['red'], records['ir'])).astype(np.float64)
+
+# median |StreamingSpO2 - sliding_spo2| allowed, in SpO2 points
+@pytest.mark.parametrize('name', ['trial0', 'trial3'])
+@pytest.mark.parametrize('method, tolerance', [('rms', 0.5), ('peak', 1.0)])
+def test_matches_sliding_spo2(name, method, tolerance):
+    x = load(name)
+    reference, _ = sliding_spo2(x, 100, sample_rate=25)
+    # sliding window i ends at sample i + 99, where the streaming estimate has seen the same samples
+    estimate = StreamingSpO2(25, 100, method).process(x)[0][99:]
+    assert len(estimate) == len(reference)
+    assert np.nanmedian(np.abs(estimate - reference)) < tolerance
+
+@pytest.mark.parametrize('method', ['rms', 'peak'])
+def test_batch_size(method):
+    x = load('trial3')
+    whole = StreamingSpO2(25, 100, method).process(x)[0]
+    estimator = StreamingSpO2(25, 100, method)
+    batches = np.concatenate([estimator.process(x[i:i + 37])[0] for i in range(0, len(x), 37)])
+    np.testing.assert_allclose(batches, whole, rtol=0, atol=1e-6)
+
+def test_settling():
+    lin, quad = StreamingSpO2(25, 100).process(load('trial0'))
+    assert np.isnan(lin[:100]).all() and np.isnan(quad[:100]).all()
+    assert np.isfinite(lin[100:]).all()